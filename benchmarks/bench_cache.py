@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+# =============================================================
+# Time re-running -id-loops and -fix-errors with the cache of
+# transaction sets.
+#
+#   $ python benchmarks/bench_cache.py [segments]
+#
+# Each operation is timed without the cache, on an empty cache,
+# on the same file again and after one service line amount in
+# it is changed, which only leaves that transaction set to be
+# processed again. The outputs have to match the uncached ones.
+# =============================================================
+
+import os
+import sys
+import tempfile
+import time
+
+from common import load_edi_edits
+from synthetic import transactions_for, write_837
+
+edi = load_edi_edits()
+
+OPERATIONS = {
+    "-id-loops": [],
+    "-fix-errors": [edi.OPT_HL_NUM, edi.OPT_LX_NUM, edi.OPT_CLM_AMT],
+}
+
+CLAIMS = 20
+LINES = 5
+
+
+def run(operation: str, input_file: str, output_file: str,
+        cache_dir: None | str) -> tuple[float, str]:
+    '''Run `operation`, return its wall time and the output.'''
+
+    args = ["edi-edits.py", operation, *OPERATIONS[operation], edi.OPT_YES,
+            edi.OPT_OUT_FILE, output_file, input_file]
+    if (cache_dir is None):
+        args.append(edi.OPT_NO_CACHE)
+    else:
+        args += [edi.OPT_CACHE, edi.OPT_CACHE_DIR, cache_dir]
+
+    start = time.perf_counter()
+    edi.process_edi_file(input_file, output_file, edi.parse_arguments(args))
+    seconds = time.perf_counter() - start
+
+    with open(output_file) as f:
+        return seconds, f.read()
+
+
+def edit_one_line(filename: str) -> None:
+    '''Add a cent to the first service line of the middle claim.'''
+
+    with open(filename) as f:
+        lines = f.readlines()
+
+    for i in range(len(lines) // 2, len(lines)):
+        if (lines[i].startswith(("SV1", "SV2"))):
+            elements = lines[i].split(edi.DELIMITER)
+            charge = 3 if lines[i].startswith("SV2") else 2
+            elements[charge] = f"{float(elements[charge]) + 0.01:.2f}"
+            lines[i] = edi.DELIMITER.join(elements)
+            break
+
+    with open(filename, 'w') as f:
+        f.writelines(lines)
+
+
+def main():
+    segments = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, "bench.edi")
+        output_file = os.path.join(directory, "bench-out.edi")
+        transactions = transactions_for(segments, "837P", CLAIMS, LINES)
+
+        print(f"segments: ~{segments}, transaction sets: {transactions}")
+        print(f"{'operation':12}{'no cache':>10}{'empty':>10}"
+              f"{'same file':>11}{'one edit':>10}")
+
+        for operation in OPERATIONS:
+            cache_dir = os.path.join(directory, operation.lstrip("-"))
+            with open(input_file, 'w') as f:
+                write_837(f, "837P", transactions, CLAIMS, LINES)
+
+            no_cache, expected = run(operation, input_file, output_file,
+                                     None)
+            empty, output = run(operation, input_file, output_file,
+                                cache_dir)
+            assert (output == expected)
+            same, output = run(operation, input_file, output_file, cache_dir)
+            assert (output == expected)
+
+            edit_one_line(input_file)
+            _, expected = run(operation, input_file, output_file, None)
+            edited, output = run(operation, input_file, output_file,
+                                 cache_dir)
+            assert (output == expected)
+
+            print(f"{operation:12}{no_cache:9.2f}s{empty:9.2f}s"
+                  f"{same:10.2f}s{edited:9.2f}s")
+
+
+if __name__ == "__main__":
+    main()
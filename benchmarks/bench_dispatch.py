@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# =============================================================
+# Compare the -fix-errors dispatch table with the if-chain it
+# replaced, which checked every enabled handler's option and
+# segment ids on every segment.
+#
+#   $ python benchmarks/bench_dispatch.py [segments]
+#
+# All the -fix-errors options are turned on. The time of a
+# pass that runs no handlers is subtracted, so the numbers are
+# the per-segment cost of dispatching and running handlers.
+# =============================================================
+
+import os
+import sys
+import tempfile
+
+from common import load_edi_edits, timed, write_repeated_sample
+
+edi = load_edi_edits()
+
+OPTS = {
+    edi.OPT_SEG_COUNT: True,
+    edi.OPT_GEN_UUID: True,
+    edi.OPT_CLM_AMT: True,
+    edi.OPT_HL_NUM: True,
+    edi.OPT_HL_LOGIC: True,
+    edi.OPT_LX_NUM: True,
+}
+
+
+def if_chain(index, item, ctx, additions, deletions):
+    '''fix_errors_module as it was before the dispatch table: each handler
+    is called if its option is set and the segment is one of its ids.'''
+
+    if (item.is_empty or item.is_comment()):
+        return item
+
+    for option, segment_ids, handler in edi.FIX_HANDLERS:
+        if ((option is None or ctx.opts[option])
+                and (segment_ids is None or item.id in segment_ids)):
+            item = handler(item, index, ctx)
+
+    return item
+
+
+def no_handlers(index, item, ctx, additions, deletions):
+    if (item.is_empty or item.is_comment()):
+        return item
+
+    return item
+
+
+def run_pass(filename: str, module) -> list[str]:
+    ctx = edi.EdiContext(OPTS)
+    lines = []
+
+    for index, text in enumerate(edi.read_edi_segments(filename)):
+        item = module(index, edi.Segment(*text), ctx, [], [])
+        lines.append(item.to_line())
+
+    return lines
+
+
+def main():
+    segments = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "bench.edi")
+        segments = write_repeated_sample(filename, segments)
+
+        # Both have to agree before timing means anything
+        assert (run_pass(filename, if_chain)
+                == run_pass(filename, edi.fix_errors_module))
+
+        baseline = timed(run_pass, filename, no_handlers)
+        chain = timed(run_pass, filename, if_chain)
+        table = timed(run_pass, filename, edi.fix_errors_module)
+
+    chain -= baseline
+    table -= baseline
+
+    print(f"segments: {segments}")
+    print(f"no handlers:    {baseline:8.3f} s")
+    print(f"if-chain:       {chain:8.3f} s "
+          f"({chain / segments * 1e9:7.1f} ns/segment)")
+    print(f"dispatch table: {table:8.3f} s "
+          f"({table / segments * 1e9:7.1f} ns/segment)")
+    print(f"speed-up:       {chain / table:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
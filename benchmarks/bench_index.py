@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+# =============================================================
+# Time building the -index of a file and -extract-ing one claim
+# with it, against running -fix-errors over the whole file.
+#
+#   $ python benchmarks/bench_index.py [segments]
+#
+# The claim extracted is the one in the middle of the file. Its
+# lookup goes through the index built just before, so the time
+# is that of a seek into a file that is already indexed.
+# =============================================================
+
+import os
+import sys
+import tempfile
+import time
+
+from common import load_edi_edits
+from synthetic import transactions_for, write_837
+
+edi = load_edi_edits()
+
+CLAIMS = 20
+LINES = 5
+FIX_ERRORS = [edi.OPT_FIX_ERRORS, edi.OPT_HL_NUM, edi.OPT_LX_NUM,
+              edi.OPT_CLM_AMT]
+
+
+def run(args: list[str], input_file: str, output_file: str) -> float:
+    '''Wall time of edi-edits.py run with `args` on `input_file`.'''
+
+    args = ["edi-edits.py", *args, edi.OPT_YES, edi.OPT_NO_CACHE]
+    if (edi.OPT_INDEX not in args):
+        args += [edi.OPT_OUT_FILE, output_file]
+    opts = edi.parse_arguments([*args, input_file])
+
+    start = time.perf_counter()
+    edi.process_edi_file(input_file, opts[edi.OPT_OUT_FILE], opts)
+    return time.perf_counter() - start
+
+
+def main():
+    segments = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_file = os.path.join(directory, "bench.edi")
+        output_file = os.path.join(directory, "bench-out.edi")
+        transactions = transactions_for(segments, "837I", CLAIMS, LINES)
+
+        with open(input_file, "w") as f:
+            write_837(f, "837I", transactions, CLAIMS, LINES)
+
+        # write_837 numbers the claims from 1
+        claim = f"{transactions * CLAIMS // 2:09d}"
+
+        index = run([edi.OPT_INDEX], input_file, output_file)
+        extract = run([edi.OPT_EXTRACT, claim, *FIX_ERRORS], input_file,
+                      output_file)
+        whole = run(FIX_ERRORS, input_file, output_file)
+        size = os.path.getsize(input_file)
+        index_size = os.path.getsize(edi.index_file_for(input_file))
+
+    print(f"segments: ~{segments}, {size / 1e6:.1f} MB, "
+          f"index {index_size / 1e6:.1f} MB")
+    print(f"-index:                    {index:8.3f} s "
+          f"({size / index / 1e6:.1f} MB/s)")
+    print(f"-extract of one claim:     {extract * 1e3:8.1f} ms")
+    print(f"-fix-errors, whole file:   {whole:8.3f} s")
+
+
+if __name__ == "__main__":
+    main()
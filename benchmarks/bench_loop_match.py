@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+# =============================================================
+# Compare LoopMatcher with the linear check_loop_start scan.
+#
+#   $ python benchmarks/bench_loop_match.py [segments]
+#
+# A file of `segments` segments (1M by default) is generated in
+# a temporary directory and parsed once. Each matcher is then
+# timed over the parsed segments alone, taking the best of
+# REPEAT runs.
+# =============================================================
+
+import os
+import sys
+import tempfile
+import timeit
+
+from common import load_edi_edits, write_repeated_sample
+
+edi = load_edi_edits()
+MATCHER = edi.loop_matcher("837")
+REPEAT = 5
+
+
+def parse_segments(filename: str) -> list[list[str]]:
+    '''The elements of every segment in `filename` that can start a loop.'''
+
+    segments = []
+    for item in edi.parse_edi_stream(edi.read_edi_segments(filename)):
+        segment = item[edi.SEGMENT]
+        if (len(segment) == 0 or segment[0].startswith(edi.COMMENT)):
+            continue
+        segments.append(segment)
+
+    return segments
+
+
+def best_time(segments: list[list[str]], match) -> float:
+    '''Best wall time in seconds of calling `match` on every segment.'''
+
+    def run_pass():
+        for segment in segments:
+            match(segment)
+
+    return min(timeit.repeat(run_pass, number=1, repeat=REPEAT))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "bench.edi")
+        count = write_repeated_sample(filename, count)
+        segments = parse_segments(filename)
+
+    # Both have to agree before timing means anything
+    for segment in segments:
+        assert (MATCHER.match(segment)
+                is edi.check_loop_start(MATCHER.loops, segment))
+
+    linear = best_time(segments, lambda segment: edi.check_loop_start(
+        MATCHER.loops, segment))
+    indexed = best_time(segments, MATCHER.match)
+
+    print(f"segments: {count}")
+    print(f"check_loop_start: {linear:8.3f} s "
+          f"({linear / len(segments) * 1e9:7.1f} ns/segment)")
+    print(f"LoopMatcher:      {indexed:8.3f} s "
+          f"({indexed / len(segments) * 1e9:7.1f} ns/segment)")
+    print(f"speed-up:         {linear / indexed:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
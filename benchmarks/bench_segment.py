@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# =============================================================
+# Compare the slotted Segment with the {START, SEGMENT, END}
+# dicts it replaced.
+#
+#   $ python benchmarks/bench_segment.py [segments]
+#
+# Times a parse + write round trip of every segment (what
+# happens to segments no handler touches) and measures, with
+# tracemalloc, the memory of holding 100k parsed segments.
+# =============================================================
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from common import load_edi_edits, write_repeated_sample
+
+edi = load_edi_edits()
+
+HELD_SEGMENTS = 100_000
+
+
+def parse_dict(line: str, delims) -> dict:
+    '''The dict form parse_edi_line used to return.'''
+
+    index_start = len(line) - len(line.lstrip(edi.WHITESPACE))
+    if (index_start == len(line)):
+        return {edi.START: "", edi.SEGMENT: "", edi.END: line,
+                edi.DELIMS: delims}
+
+    index_tilda = line.find(delims.terminator, index_start)
+    if (index_tilda == -1):
+        index_tilda = line.find(edi.NEWLINE)
+        if (index_tilda == -1):
+            index_tilda = len(line)-1
+
+    return {
+        edi.START: line[:index_start],
+        edi.SEGMENT: line[index_start:index_tilda].split(delims.element),
+        edi.END: line[index_tilda:],
+        edi.DELIMS: delims
+    }
+
+
+def dict_to_line(item: dict) -> str:
+    segment_str = item[edi.DELIMS].element.join(item[edi.SEGMENT])
+    return item[edi.START] + segment_str + item[edi.END]
+
+
+def round_trip(segments, parse, to_line) -> float:
+    start = time.perf_counter()
+    for text, delims in segments:
+        to_line(parse(text, delims))
+    return time.perf_counter() - start
+
+
+def held_memory(segments, parse) -> int:
+    tracemalloc.start()
+    held = [parse(text, delims) for text, delims in segments]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    return current
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "bench.edi")
+        write_repeated_sample(filename, count)
+        segments = list(edi.read_edi_segments(filename))
+
+    for text, delims in segments[:1000]:
+        assert (edi.Segment(text, delims).to_line()
+                == dict_to_line(parse_dict(text, delims)) == text)
+
+    dict_time = round_trip(segments, parse_dict, dict_to_line)
+    slot_time = round_trip(segments, edi.Segment, edi.Segment.to_line)
+
+    dict_memory = held_memory(segments[:HELD_SEGMENTS], parse_dict)
+    slot_memory = held_memory(segments[:HELD_SEGMENTS], edi.Segment)
+
+    print(f"segments: {len(segments)}")
+    print(f"round trip, dict:    {dict_time:7.3f} s "
+          f"({dict_time / len(segments) * 1e9:6.0f} ns/segment)")
+    print(f"round trip, Segment: {slot_time:7.3f} s "
+          f"({slot_time / len(segments) * 1e9:6.0f} ns/segment)")
+    print(f"{HELD_SEGMENTS} held, dict:    {dict_memory / 1e6:6.1f} MB "
+          f"({dict_memory / HELD_SEGMENTS:4.0f} B/segment)")
+    print(f"{HELD_SEGMENTS} held, Segment: {slot_memory / 1e6:6.1f} MB "
+          f"({slot_memory / HELD_SEGMENTS:4.0f} B/segment)")
+
+
+if __name__ == "__main__":
+    main()
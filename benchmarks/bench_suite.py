@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+# =============================================================
+# Time and memory of -format, -id-loops and -fix-errors on
+# synthetic 837I / 837P files of a few sizes.
+#
+#   $ python benchmarks/bench_suite.py
+#   $ python benchmarks/bench_suite.py --sizes 10k,1M --kinds 837P \
+#         --claims 50 --lines 10 --defects se-count,hl-number \
+#         --output after.json --compare before.json
+#
+# Every operation runs in a fresh process so the peak RSS it
+# reports is its own. Results are printed as a table and saved
+# as JSON, --compare prints the change from an earlier run.
+# =============================================================
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import REPO_DIR, load_edi_edits
+from synthetic import DEFECTS, KINDS, transactions_for, write_837
+
+edi = load_edi_edits()
+
+OPERATIONS = {
+    "-format": [],
+    "-id-loops": [],
+    "-fix-errors": [edi.OPT_HL_NUM, edi.OPT_LX_NUM, edi.OPT_CLM_AMT],
+}
+
+SIZE_SUFFIXES = {"k": 10**3, "M": 10**6, "G": 10**9}
+
+
+def parse_size(size: str) -> int:
+    '''"10k" -> 10000, "1M" -> 1000000.'''
+
+    if (size[-1] in SIZE_SUFFIXES):
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_operation(operation: str, input_file: str, output_file: str) -> dict:
+    '''Run one operation in this process (the child side of measure).'''
+
+    # Without the cache every repeat does the whole file again
+    args = ["edi-edits.py", operation, *OPERATIONS[operation], edi.OPT_YES,
+            edi.OPT_NO_CACHE, edi.OPT_OUT_FILE, output_file, input_file]
+    opts = edi.parse_arguments(args)
+
+    rss_before = peak_rss_bytes()
+    start = time.perf_counter()
+    ctx = edi.process_edi_file(input_file, output_file, opts)
+    seconds = time.perf_counter() - start
+
+    return {"seconds": seconds, "peak_rss": peak_rss_bytes(),
+            "rss_before": rss_before, "logs": ctx.diagnostics.total}
+
+
+def measure(operation: str, input_file: str, output_file: str) -> dict:
+    '''Run `operation` in a new process and return what it measured.'''
+
+    result = subprocess.run(
+        # Without its dash so it isn't taken for an option
+        [sys.executable, os.path.abspath(__file__), "--child",
+         operation.lstrip("-"), input_file, output_file],
+        stdout=subprocess.PIPE, check=True, text=True
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def git_commit() -> None | str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result: dict) -> tuple:
+    return (result["kind"], result["target"], result["operation"])
+
+
+def print_row(result: dict, previous: None | dict) -> None:
+    line = (f"{result['kind']:5} {result['segments']:>10} "
+            f"{result['operation']:12} {result['seconds']:9.3f} s "
+            f"{result['segments_per_second']:>10.0f}/s "
+            f"{result['peak_rss'] / 1e6:8.1f} MB {result['logs']:>7}")
+
+    if (previous is not None):
+        line += (f"   time x{result['seconds'] / previous['seconds']:.2f}"
+                 f" mem x{result['peak_rss'] / previous['peak_rss']:.2f}")
+
+    print(line, flush=True)
+
+
+def run_suite(args) -> list[dict]:
+    previous = {}
+    if (args.compare):
+        with open(args.compare) as f:
+            previous = {result_key(result): result
+                        for result in json.load(f)["results"]}
+
+    print(f"{'kind':5} {'segments':>10} {'operation':12} {'time':>11} "
+          f"{'rate':>12} {'peak RSS':>11} {'logs':>7}")
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as directory:
+        input_file = os.path.join(directory, "bench.edi")
+        output_file = os.path.join(directory, "bench-out.edi")
+
+        for kind in args.kinds:
+            for target in args.sizes:
+                transactions = transactions_for(target, kind, args.claims,
+                                                args.lines)
+                with open(input_file, "w") as f:
+                    written = write_837(f, kind, transactions, args.claims,
+                                        args.lines, args.defects,
+                                        args.defect_every)
+
+                for operation in OPERATIONS:
+                    runs = [measure(operation, input_file, output_file)
+                            for _ in range(args.repeat)]
+                    best = min(runs, key=lambda run: run["seconds"])
+
+                    result = {
+                        "kind": kind,
+                        "target": target,
+                        "segments": written["segments"],
+                        "transactions": transactions,
+                        "claims": args.claims,
+                        "lines": args.lines,
+                        "defects": written["defects"],
+                        "operation": operation,
+                        "flags": OPERATIONS[operation],
+                        "seconds": best["seconds"],
+                        "segments_per_second":
+                            written["segments"] / best["seconds"],
+                        "peak_rss": max(run["peak_rss"] for run in runs),
+                        "rss_before": best["rss_before"],
+                        "logs": best["logs"],
+                    }
+                    results.append(result)
+                    print_row(result, previous.get(result_key(result)))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="10k,1M,10M",
+                        help="segments per file, comma separated")
+    parser.add_argument("--kinds", default=",".join(KINDS),
+                        help="transaction types, comma separated")
+    parser.add_argument("--claims", type=int, default=20,
+                        help="claims per transaction set")
+    parser.add_argument("--lines", type=int, default=5,
+                        help="service lines per claim")
+    parser.add_argument("--defects", default="",
+                        help=f"comma separated, any of {', '.join(DEFECTS)}")
+    parser.add_argument("--defect-every", type=int, default=100,
+                        help="put the defects in every Nth transaction set")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="runs of each operation, the fastest is kept")
+    parser.add_argument("--output", default=None,
+                        help="JSON file for the results")
+    parser.add_argument("--compare", default=None,
+                        help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tmp-dir", default=None,
+                        help="where to write the generated files")
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if (args.child):
+        operation, input_file, output_file = args.child
+        print(json.dumps(run_operation(f"-{operation}", input_file,
+                                       output_file)))
+        return
+
+    args.sizes = [parse_size(size) for size in args.sizes.split(",")]
+    args.kinds = [kind for kind in args.kinds.split(",") if kind]
+    args.defects = tuple(defect for defect in args.defects.split(",")
+                         if defect)
+
+    results = run_suite(args)
+
+    output = args.output or datetime.datetime.now().strftime(
+        "bench-%Y%m%d-%H%M%S.json")
+    with open(output, "w") as f:
+        json.dump({
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results,
+        }, f, indent=2)
+
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+# =============================================================
+# Check that the three tokenizers cut every input the same way.
+#
+#   $ python benchmarks/check_tokenizers.py [inputs] [seed]
+#
+# split_edi_segments (the text reader), split_edi_mapped (mapped
+# files) and CleanRuns / format_mapped (mapped files with -format
+# alone) each find the segments of the input on their own. Every
+# input is run through process_edi_text and through
+# process_edi_file on a mapped file, for each operation, and the
+# outputs and diagnostic records have to be identical.
+#
+# The inputs are random interchanges with dirty segments (missing
+# terminators, characters after them, comments, empty lines, odd
+# whitespace, other separators) in them, and a few of over 2 MB
+# with dirty segments put right at the SEARCH_SIZE boundaries of
+# format_mapped. An input that disagrees is kept to reproduce it.
+#
+# Inputs with one segment per line are also checked against the
+# line by line reader the tokenizers replaced: each line has to be
+# one segment, characters after the terminator included.
+# =============================================================
+
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from common import load_edi_edits
+
+edi = load_edi_edits()
+
+OPERATIONS = [
+    [edi.OPT_FORMAT],
+    [edi.OPT_ID_LOOPS],
+    [edi.OPT_FIX_ERRORS, edi.OPT_HL_NUM, edi.OPT_LX_NUM, edi.OPT_CLM_AMT],
+]
+
+ISA = ("ISA*00*          *00*          *ZZ*TMP0001        *ZZ*617591011CMST  "
+       "*230503*1020*^*00501*000000100*0*P*:~")
+
+# (element, component, repetition, terminator) of each interchange
+SEPARATORS = [
+    ("*", ":", "^", "~"),
+    ("*", ":", "^", "~"),
+    ("|", ">", "^", "'"),
+    ("*", ":", "^", "\n"),
+]
+
+# Segments of a transaction set, {n} is filled with a random number
+BODY = [
+    ["BHT", "0019", "00", "{n}", "20230503", "1020", "CH"],
+    ["NM1", "85", "2", "Westwood Hospital", "", "", "", "", "XX", "{n}"],
+    ["N3", "1101 ARROW POINT DR"],
+    ["REF", "EI", "{n}"],
+    ["HL", "{n}", "", "20", "1"],
+    ["HL", "{n}", "1", "22", "0"],
+    ["SBR", "P", "18", "", "", "", "", "", "", "MC"],
+    ["CLM", "{n}", "34.14", "", "", "11:B:1", "Y", "A", "Y", "Y"],
+    ["LX", "{n}"],
+    ["SV1", "HC:99213", "10.37", "UN", "1", "", "", "1"],
+    ["DTP", "472", "D8", "20151229"],
+    ["NM1", "IL", "1", "Müller", "Pat", "", "", "", "MI", "{n}"],
+]
+
+NOISE = ["\n", "\n\n", "// loop 2300\n", "//\n", "   \n", "\t\n"]
+
+# Boundaries of format_mapped to put dirty segments around
+BOUNDARIES = 2
+
+
+def write_segment(rng, out: list[str], elements: list[str], separators,
+                  dirty: bool, by_line: bool = False) -> None:
+    element, component, repetition, terminator = separators
+    elements = [part.replace(":", component).replace("{n}",
+                                                     str(rng.randint(1, 99)))
+                for part in elements]
+    text = element.join(elements)
+    end = terminator + ("" if terminator == "\n" else "\n")
+
+    if (dirty):
+        choice = rng.randrange(7)
+        if (choice == 0 and terminator != "\n"):
+            end = "\n"                            # missing terminator
+        elif (choice == 1 and terminator != "\n"):
+            end = terminator + "x\n"              # after the terminator
+        elif (choice == 2 and terminator != "\n" and not by_line):
+            end = terminator                      # no line break
+        elif (choice == 3):
+            text = rng.choice([" ", "\t", "  \t"]) + text
+        elif (choice == 4 and terminator != "\n"):
+            end = terminator + rng.choice([" ", "\t ", "  "]) + "\n"
+        elif (choice == 5):
+            out.append(rng.choice(NOISE))
+        elif (choice == 6 and terminator != "\n"):
+            end = terminator + terminator + "\n"   # empty segment
+
+    out.append(text + end)
+
+
+def write_interchange(rng, out: list[str], sets: int, dirt: float,
+                      by_line: bool) -> None:
+    separators = rng.choice(SEPARATORS)
+    element, component, repetition, terminator = separators
+    isa = (ISA.replace("*", element).replace("^", repetition)
+           .replace(":", component).replace("~", terminator))
+    out.append(isa + ("" if terminator == "\n" else "\n"))
+
+    def segment(elements, dirty=None):
+        if (dirty is None):
+            dirty = rng.random() < dirt
+        write_segment(rng, out, elements, separators, dirty, by_line)
+
+    segment(["GS", "HC", "TMP0001", "617591011CMSP", "20230503", "1020", "1",
+             "X", "005010X222A1"], dirty=False)
+    for control in range(1, sets + 1):
+        segment(["ST", "837", f"{control:04d}", "005010X222A1"])
+        count = rng.randint(1, 30)
+        for _ in range(count):
+            segment(rng.choice(BODY))
+        segment(["SE", str(count + 2), f"{control:04d}"])
+    segment(["GE", str(sets), "1"])
+    segment(["IEA", "1", "000000100"])
+
+
+def random_input(rng, by_line: bool = False) -> str:
+    '''Random interchanges, with one segment per line if `by_line`.'''
+
+    out = []
+    if (rng.random() < 0.2):
+        out.append(rng.choice(NOISE))
+    for _ in range(rng.randint(1, 3)):
+        write_interchange(rng, out, rng.randint(1, 5), rng.random() * 0.5,
+                          by_line)
+
+    text = "".join(out)
+    if (rng.random() < 0.3):
+        # Cut off anywhere
+        text = text[:rng.randrange(len(text) + 1)]
+    return text
+
+
+def boundary_input(rng) -> str:
+    '''Clean interchanges of over BOUNDARIES * SEARCH_SIZE bytes, with dirty
+    segments around each multiple of SEARCH_SIZE.'''
+
+    out = []
+    size = 0
+    boundary = edi.SEARCH_SIZE
+
+    while (boundary <= BOUNDARIES * edi.SEARCH_SIZE):
+        separators = ("*", ":", "^", "~")
+        while (size < boundary - rng.randint(0, 64)):
+            start = len(out)
+            write_segment(rng, out, rng.choice(BODY), separators, False)
+            size += sum(len(part.encode()) for part in out[start:])
+
+        start = len(out)
+        for _ in range(rng.randint(1, 4)):
+            write_segment(rng, out, rng.choice(BODY), separators, True)
+        size += sum(len(part.encode()) for part in out[start:])
+        boundary += edi.SEARCH_SIZE
+
+    header = [ISA + "\n", "GS*HC*TMP0001*617591011CMSP*20230503*1020*1*X*"
+              "005010X222A1~\n", "ST*837*0001*005010X222A1~\n"]
+    return "".join(header + out) + "SE*1*0001~\nGE*1*1~\nIEA*1*000000100~\n"
+
+
+def outcome(process):
+    '''(output, records) of the run `process` does, or the error it stopped
+    with.'''
+    try:
+        return process()
+    except (edi.EdiError, ValueError, IndexError) as e:
+        return str(e)
+
+
+def run(args: list[str], text: str, filename: str, output_file: str):
+    '''What `text` gives processed in memory and as the mapped file
+    `filename`, see `outcome`.'''
+
+    with open(filename, "w") as f:
+        f.write(text)
+
+    opts = edi.parse_arguments(["edi-edits.py", *args, edi.OPT_YES,
+                                edi.OPT_NO_CACHE, edi.OPT_LOG_LIMIT,
+                                str(sys.maxsize), edi.OPT_OUT_FILE,
+                                output_file, filename])
+
+    buffer = edi.map_edi_file(filename)
+    if (buffer is not None):
+        buffer.close()
+    elif (text):
+        raise AssertionError(f"{filename} isn't read mapped")
+
+    def in_memory():
+        output, ctx = edi.process_edi_text(text, opts)
+        return output, ctx.diagnostics.records
+
+    def mapped():
+        ctx = edi.process_edi_file(filename, output_file, opts)
+        with open(output_file) as f:
+            return f.read(), ctx.diagnostics.records
+
+    return outcome(in_memory), outcome(mapped)
+
+
+def check(inputs: list[str], directory: str) -> int:
+    '''Run every input through every operation, return the failures.'''
+
+    filename = os.path.join(directory, "input.edi")
+    output_file = os.path.join(directory, "output.edi")
+    failures = 0
+
+    for number, text in enumerate(inputs):
+        for args in OPERATIONS:
+            # Errors included, both have to give up on an input the same way
+            in_memory, mapped = run(args, text, filename, output_file)
+            if (in_memory == mapped):
+                continue
+
+            failures += 1
+            kept = os.path.join(tempfile.gettempdir(),
+                                f"tokenizers-{number}.edi")
+            shutil.copy(filename, kept)
+            print(f"{' '.join(args)}: input {number} differs, kept in {kept}")
+
+            if (isinstance(in_memory, str) or isinstance(mapped, str)):
+                print(f"\tin memory: {str(in_memory)[:200]}")
+                print(f"\tmapped:    {str(mapped)[:200]}")
+            elif (in_memory[0] != mapped[0]):
+                print("\toutputs differ")
+            else:
+                print("\tdiagnostics differ")
+
+    return failures
+
+
+def check_lines(inputs: list[str], directory: str) -> int:
+    '''Check that the tokenizers cut every input of one segment per line
+    like the line by line reader, return the failures.'''
+
+    failures = 0
+
+    for number, text in enumerate(inputs):
+        lines = io.StringIO(text).readlines()
+        data = text.encode()
+        tokenizers = {
+            "split_edi_segments": [
+                piece for piece, delims in edi.split_edi_segments(
+                    io.StringIO(text))],
+            "split_edi_segments (short reads)": [
+                piece for piece, delims in edi.split_edi_segments(
+                    io.StringIO(text), read_size=16)],
+            "split_edi_mapped": [
+                data[pos:end].decode() for pos, body_start, body_end, end,
+                delims in edi.split_edi_mapped(data)],
+        }
+
+        for name, pieces in tokenizers.items():
+            if (pieces == lines):
+                continue
+
+            failures += 1
+            kept = os.path.join(tempfile.gettempdir(),
+                                f"tokenizers-lines-{number}.edi")
+            with open(kept, "w") as f:
+                f.write(text)
+            print(f"{name}: input {number} isn't cut by line, kept in {kept}")
+
+            for line, piece in zip(lines, pieces):
+                if (line != piece):
+                    print(f"\tline:  {line!r:.200}")
+                    print(f"\tpiece: {piece!r:.200}")
+                    break
+
+    return failures
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    rng = random.Random(seed)
+
+    inputs = [random_input(rng) for _ in range(count)]
+    inputs += [boundary_input(rng) for _ in range(3)]
+    line_inputs = [random_input(rng, by_line=True) for _ in range(count)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        failures = check(inputs, directory)
+        failures += check_lines(line_inputs, directory)
+
+    runs = len(inputs) * len(OPERATIONS) + len(line_inputs)
+    print(f"inputs: {len(inputs)} (seed {seed}), runs: {runs}, "
+          f"failures: {failures}")
+    if (failures):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# =============================================================
+# Helpers shared by the benchmarks.
+# =============================================================
+
+import importlib.util
+import os
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EDI_EDITS = os.path.join(REPO_DIR, "edi-edits.py")
+SAMPLE_FILE = os.path.join(REPO_DIR, "final-test-passed.edi")
+
+
+def load_edi_edits():
+    '''Import edi-edits.py (the dash keeps a plain import from working).'''
+
+    spec = importlib.util.spec_from_file_location("edi_edits", EDI_EDITS)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_repeated_sample(filename: str, segments: int) -> int:
+    '''Write an interchange of roughly `segments` segments to `filename`.
+
+    The ST-SE transaction set of the sample file is repeated until the
+    requested size is reached. Returns the number of segments written.
+    '''
+
+    with open(SAMPLE_FILE) as f:
+        lines = f.readlines()
+
+    header, body, trailer = lines[:2], lines[2:-2], lines[-2:]
+    written = 0
+
+    with open(filename, 'w') as f:
+        f.writelines(header)
+        written += len(header)
+
+        while written + len(body) + len(trailer) <= segments:
+            f.writelines(body)
+            written += len(body)
+
+        f.writelines(trailer)
+        written += len(trailer)
+
+    return written
+
+
+def timed(func, *args):
+    '''Return the wall time of func(*args) in seconds.'''
+
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
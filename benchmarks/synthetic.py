@@ -0,0 +1,277 @@
+# =============================================================
+# Synthetic 837I / 837P interchanges for the benchmarks.
+#
+#   from synthetic import write_837
+#   write_837(f, "837P", transactions=100, claims=20, lines=5)
+#
+# The transaction sets are laid out following the loops in
+# loops/837.json: every loop written starts with a segment the loop
+# matcher resolves to that loop, so -id-loops sees the same
+# structure it would in a real file. Defects -fix-errors is
+# meant to catch can be put into every Nth transaction set.
+# =============================================================
+
+import math
+
+from common import load_edi_edits
+
+edi = load_edi_edits()
+
+ISA = ("ISA*00*          *00*          *ZZ*TMP0001        *ZZ*617591011CMST  "
+       "*230503*1020*^*00501*102015234*0*P*:~\n")
+GS = "GS*HC*TMP0001*617591011CMSP*20230503*1020*1*X*{version}~\n"
+GE = "GE*{transactions}*1~\n"
+IEA = "IEA*1*102015234~\n"
+
+ST = "ST*837*{control:04d}*{version}~\n"
+BHT = "BHT*0019*00*{control:08d}*20230503*1020*CH~\n"
+SE = "SE*{count}*{control:04d}~\n"
+
+KINDS = ("837I", "837P")
+
+VERSIONS = {
+    "837I": "005010X223A2",
+    "837P": "005010X222A1",
+}
+
+# (loop name, repeat, children) in the order the loops are written. The
+# repeat is a field of TransactionBuilder. Loops without a template for
+# the kind being written are left out along with their children.
+STRUCTURE = [
+    ("1000A", None, []),
+    ("1000B", None, []),
+    ("2000A", None, [
+        ("2010AA", None, []),
+    ]),
+    ("2000B", "claims", [
+        ("2010BA", None, []),
+        ("2010BB-2", None, []),
+        ("2300", None, [
+            ("2310A", None, []),
+            ("2310D", None, []),
+            ("2400", "lines", []),
+        ]),
+    ]),
+]
+
+# The segments of each loop, the first one starts it
+COMMON_TEMPLATES = {
+    "1000A": [
+        "NM1*41*2*TMHP*****46*617591011CMSP~\n",
+        "PER*IC*J Smith*TE*5123378484~\n",
+    ],
+    "1000B": [
+        "NM1*40*2*TEXAS MEDICAID*****46*617591011CMSP~\n",
+    ],
+    "2000A": [
+        "HL*{hl}**20*1~\n",
+    ],
+    "2010AA": [
+        "NM1*85*2*Westwood Hospital*****XX*1871057331~\n",
+        "N3*1101 ARROW POINT DR~\n",
+        "N4*CEDAR PARK*TX*78613~\n",
+        "REF*EI*708562358~\n",
+    ],
+    "2000B": [
+        "HL*{hl}*{parent}*22*0~\n",
+        "SBR*P*18*******MC~\n",
+    ],
+    "2010BA": [
+        "NM1*IL*1*Member{claim}*Pat****MI*{claim:09d}~\n",
+        "N3*9963 Catherine Drive~\n",
+        "N4*TownA*TX*77075~\n",
+        "DMG*D8*19800605*M~\n",
+    ],
+    "2010BB-2": [
+        "NM1*PR*2*TEXAS MEDICAID*****PI*617591011CMSP~\n",
+    ],
+}
+
+TEMPLATES = {
+    "837I": {
+        **COMMON_TEMPLATES,
+        "2300": [
+            "CLM*{claim:09d}*{total}***31:A:1**C*Y*Y~\n",
+            "DTP*434*RD8*20151229-20151229~\n",
+            "CL1*1*1*01~\n",
+            "HI*ABK:F73~\n",
+        ],
+        "2310A": [
+            "NM1*71*1*Clooney*George****XX*1871057331~\n",
+        ],
+        "2400": [
+            "LX*{line}~\n",
+            "SV2*0100*HC:H2016:UJ*{charge}*UN*1~\n",
+            "DTP*472*D8*20151229~\n",
+        ],
+    },
+    "837P": {
+        **COMMON_TEMPLATES,
+        "2300": [
+            "CLM*{claim:09d}*{total}***11:B:1*Y*A*Y*Y~\n",
+            "HI*ABK:F73~\n",
+        ],
+        "2310D": [
+            "NM1*82*1*LNAME*FNAME****XX*1427123173~\n",
+        ],
+        "2400": [
+            "LX*{line}~\n",
+            "SV1*HC:99213*{charge}*UN*1***1~\n",
+            "DTP*472*D8*20151229~\n",
+        ],
+    },
+}
+
+# Defects and what -fix-errors does about them
+DEFECTS = {
+    "se-count": "SE01 is one more than the segments in the set",
+    "hl-number": "HL01 numbering starts at 2 instead of 1",
+    "claim-total": "CLM02 is 1.00 more than the sum of the lines",
+}
+DEFECT_EVERY = 100
+
+
+def format_cents(cents: int) -> str:
+    return f"{cents // 100}.{cents % 100:02d}"
+
+
+def check_templates() -> None:
+    '''Make sure every loop template starts the loop it is written for.'''
+
+    matcher = edi.loop_matcher("837")
+
+    for kind, templates in TEMPLATES.items():
+        for name, segments in templates.items():
+            elements = segments[0].rstrip("~\n").split(edi.DELIMITER)
+            # Fill the fields with something so the pattern can be matched
+            elements = [element.split("{")[0] or "1" for element in elements]
+            names = [loop.name for loop in matcher.candidates(elements)]
+
+            if (name not in names):
+                raise ValueError(f"{kind} template for loop {name} starts "
+                                 f"with {segments[0].strip()}, which starts "
+                                 f"{names or 'no loop'}")
+
+
+class TransactionBuilder():
+    '''Writes the segments of transaction sets of one kind.'''
+
+    def __init__(self, kind: str, claims: int, lines: int) -> None:
+        self.templates = TEMPLATES[kind]
+        self.version = VERSIONS[kind]
+        self.claims = claims
+        self.lines = lines
+
+        self.claim = 0
+        self.values = {}
+        self.hl = 0
+        self.charges = []
+        self.total_delta = 0
+
+    def enter(self, name: str, repeat: int) -> None:
+        '''Set the values for the `repeat`th time loop `name` is written.'''
+
+        values = self.values
+
+        if (name in ("2000A", "2000B")):
+            values["hl"] = self.hl
+            self.hl += 1
+
+        if (name == "2000A"):
+            values["billing"] = values["hl"]
+
+        elif (name == "2000B"):
+            self.claim += 1
+            values["parent"] = values["billing"]
+            values["claim"] = self.claim
+
+            # Deterministic amounts with cents, the total is exact
+            self.charges = [1000 + (self.claim * 37 + line * 101) % 9000
+                            for line in range(self.lines)]
+            values["total"] = format_cents(sum(self.charges)
+                                           + self.total_delta)
+
+        elif (name == "2400"):
+            values["line"] = repeat + 1
+            values["charge"] = format_cents(self.charges[repeat])
+
+    def write_loop(self, out: list[str], name: str, repeat: None | str,
+                   children: list) -> None:
+        for i in range(getattr(self, repeat) if repeat else 1):
+            self.enter(name, i)
+
+            for template in self.templates[name]:
+                out.append(template.format_map(self.values))
+
+            for child in children:
+                if (child[0] in self.templates):
+                    self.write_loop(out, *child)
+
+    def transaction(self, control: int, defects: tuple = ()) -> list[str]:
+        '''The segments of one transaction set, with `defects` put in.'''
+
+        self.values = {"control": control, "version": self.version}
+        self.hl = 2 if "hl-number" in defects else 1
+        self.total_delta = 100 if "claim-total" in defects else 0
+
+        out = [ST.format_map(self.values), BHT.format_map(self.values)]
+
+        for loop in STRUCTURE:
+            if (loop[0] in self.templates):
+                self.write_loop(out, *loop)
+
+        count = len(out) + 1 + (1 if "se-count" in defects else 0)
+        out.append(SE.format(count=count, control=control))
+        return out
+
+
+def transaction_size(kind: str, claims: int, lines: int) -> int:
+    '''Number of segments in one transaction set.'''
+    return len(TransactionBuilder(kind, claims, lines).transaction(1))
+
+
+def transactions_for(segments: int, kind: str, claims: int,
+                     lines: int) -> int:
+    '''Transaction sets needed for an interchange of about `segments`.'''
+    per_transaction = transaction_size(kind, claims, lines)
+    return max(1, math.ceil((segments - 4) / per_transaction))
+
+
+def write_837(f, kind: str = "837I", transactions: int = 1, claims: int = 1,
+              lines: int = 1, defects: tuple = (),
+              defect_every: int = DEFECT_EVERY) -> dict:
+    '''Write one interchange of `transactions` transaction sets to `f`.
+
+    Every transaction set has `claims` claims with `lines` service lines
+    each. The `defects` (see DEFECTS) are put into every `defect_every`th
+    transaction set. Returns the number of segments written and of each
+    defect put in.
+    '''
+
+    for defect in defects:
+        if (defect not in DEFECTS):
+            raise ValueError(f"Unknown defect {defect}")
+
+    check_templates()
+    builder = TransactionBuilder(kind, claims, lines)
+    injected = {defect: 0 for defect in defects}
+
+    f.write(ISA)
+    f.write(GS.format(version=VERSIONS[kind]))
+    segments = 2
+
+    for control in range(1, transactions + 1):
+        broken = defects if control % defect_every == 0 else ()
+        for defect in broken:
+            injected[defect] += 1
+
+        out = builder.transaction(control, broken)
+        f.writelines(out)
+        segments += len(out)
+
+    f.write(GE.format(transactions=transactions))
+    f.write(IEA)
+    segments += 2
+
+    return {"segments": segments, "transactions": transactions,
+            "defects": injected}
@@ -15,28 +15,175 @@
 # clean edi / X12 files.
 # =============================================================
 
+import asyncio
+import cProfile
+import contextlib
+import glob
+import gzip
+import hashlib
+import io
+import json
+import mmap
+import operator
 import os
+import re
+import shutil
+import signal
+import sqlite3
 import sys
-from random import randint
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows, peak memory isn't reported there
+    resource = None
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        # .zst files can't be read or written without it
+        zstd = None
 
 # Separator for segment parts
 DELIMITER = "*"
 
+# Separator for the parts of a composite element
+COMPONENT = ":"
+
+# Separator for repeated elements
+REPETITION = "^"
+
 # Terminates a segment
 TERMINATOR = "~"
 
+# The ISA segment is fixed width, its separators sit at known positions.
+ISA_ID = "ISA"
+ISA_LENGTH = 106
+ISA_ELEMENT_POS = (3, 6, 17, 20, 31, 34, 50, 53, 69, 76, 81, 83, 89, 99,
+                   101, 103)
+ISA_REPETITION_POS = 82
+ISA_COMPONENT_POS = 104
+ISA_TERMINATOR_POS = 105
+
 WHITESPACE = " \t\n\r"
+LINE_WHITESPACE = " \t\r"
 COMMENT = "//"
 NEWLINE = "\n"
+CARRIAGE_RETURN = "\r"
+CRLF = CARRIAGE_RETURN + NEWLINE
 INDENT_STR = "\t"
 
+# The same, for finding them in the bytes of a mapped input
+ISA_BYTES = ISA_ID.encode()
+NEWLINE_BYTES = NEWLINE.encode()
+NEWLINE_BYTE = NEWLINE_BYTES[0]
+
 # Just used for internal purposes
 START = "start"
 END = "end"
 SEGMENT = "segment"
+DELIMS = "delims"
+
+# Segment attribute behind each of the above
+SEGMENT_PARTS = {START: "start", SEGMENT: "elements", END: "end",
+                 DELIMS: "delims"}
 
 FILE_MARKER = "SSEDI"
 
+# Added to the input name to name its index (-index)
+INDEX_EXT = ".idx"
+
+# Layout of the index, one built by another version is built again
+INDEX_VERSION = 1
+
+# Segments whose place -index records, the others end claims and HL loops
+INDEX_IDS = ("ISA", "IEA", "GS", "GE", "ST", "SE", "HL", "CLM")
+
+# -split writes <name>-part0001.edi, <name>-part0002.edi, ...
+SPLIT_SUFFIX = "-part"
+SPLIT_DIGITS = 4
+
+# Entries written to the index at a time
+INDEX_BATCH = 10_000
+
+# Matches any value in a loop start pattern
+WILDCARD = "*"
+
+# Loops never carry over these segments
+TRANSACTION_BOUNDS = ("ST", "SE")
+
+# Envelope headers, with the element holding their control number
+ENVELOPE_CONTROL = {"ISA": 13, "GS": 6, "ST": 2}
+
+# Envelope trailers, with the header each one closes
+ENVELOPE_TRAILERS = {"SE": "ST", "GE": "GS", "IEA": "ISA"}
+
+# What -split and -merge rebuild around the transaction sets
+ENVELOPE_IDS = ("ISA", "GS", "GE", "IEA")
+
+# The header a GS or ST is counted in by its trailer
+ENVELOPE_PARENTS = {"GS": "ISA", "ST": "GS"}
+
+# HL03 level codes, each only ever under the ones before it: 837 (20, 22,
+# 23), 270/271 (20, 21, 22, 23), 276/277 (20, 21, 19, 22, 23), 278 (down to
+# EV and SS) and 856 (S, O, T, P, I). Others go where their HL02 says.
+HL_LEVELS = ("20", "21", "19", "22", "23", "EV", "SS",
+             "S", "O", "T", "P", "I")
+HL_RANKS = {level: rank for rank, level in enumerate(HL_LEVELS)}
+
+# HL04 values, whether the level has child levels
+HL_CHILD_CODES = ("0", "1")
+
+# Control numbers taken from a -control-file at a time
+CONTROL_BLOCK = 1000
+
+# Control numbers handed out: the table of the -control-file they are
+# counted in and the width they are padded to. ST02 has 4 to 9 characters,
+# ISA13 always 9 and GS06 1 to 9. Numbers past the last start over at 1.
+CONTROL_TABLES = {"ST": "counter", "ISA": "interchange_counter",
+                  "GS": "group_counter"}
+CONTROL_WIDTHS = {"ST": 4, "ISA": 9, "GS": 1}
+CONTROL_MAX = 10**9 - 1
+
+# The counter file a run over several files shares without -control-file
+CONTROL_FILE = "control.sqlite3"
+
+# The loop definitions of each transaction type, see loop_matcher
+LOOPS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loops")
+
+# Whose loops are looked for before the first ST segment
+DEFAULT_TRANSACTION = "837"
+
+# Characters read from the input at a time
+READ_SIZE = 1 << 16
+
+# Bytes collected before each write to the output file
+WRITE_BUFFER = 1 << 20
+
+# Extensions of the compressed files read and written transparently
+GZIP_EXT = ".gz"
+ZSTD_EXT = ".zst"
+COMPRESSED_EXTS = (GZIP_EXT, ZSTD_EXT)
+
+# Between speed and size, 9 (what gzip.open uses) is several times slower
+GZIP_LEVEL = 6
+
+# Characters sent to a worker at a time with -jobs
+BATCH_SIZE = 1 << 20
+
+# Bytes searched at a time by -format for the end of a clean run, and the
+# longest match of the search (a terminator, newline and ISA)
+SEARCH_SIZE = 1 << 20
+CLEAN_RUN_MARGIN = 5
+
 
 class bc:
     '''Class to just keep of terminal colors.'''
@@ -52,6 +199,17 @@ class bc:
     UNDERLINE = '\033[4m'
 
 
+def disable_colors() -> None:
+    for name in list(vars(bc)):
+        if (name.isupper()):
+            setattr(bc, name, "")
+
+
+# Escape codes would end up as garbage in files and pipes
+if (not sys.stdout.isatty() or "NO_COLOR" in os.environ):
+    disable_colors()
+
+
 help_msg = f'''
 edi-edits.py: A utility program for edi files.
 Author: Suchith Sridhar
@@ -62,28 +220,93 @@ Help:
     {bc.OKGREEN}
     $ python edi-edits.py [operator-flags] [options-flags] <filename>.edi
     {bc.ENDC}
+    Several files, directories (every file in them) or "quoted/*.edi" globs
+    can be given at once, they are all processed in this one run.
 
     Operations:
         {bc.OKCYAN}-id-loops{bc.ENDC} : Identify loops in the EDI file by placing "comments".
+                     (the loops of each transaction type are defined in loops/<ST01>.json
+                     or loops/<ST01>-<ST03>.json, next to this program)
 
         {bc.OKCYAN}-fix-errors{bc.ENDC} : Fix basic errors such as count mistakes and unique ids.
                        (further options mentioned below)
 
         {bc.OKCYAN}-format{bc.ENDC} : Format the file by removing "comments" and whitespaces.
 
+        {bc.OKCYAN}-index{bc.ENDC} : Write <filename>.idx, the byte offsets of every interchange,
+                 group, transaction set, HL loop and claim in the file.
+
+        {bc.OKCYAN}-extract{bc.ENDC} <id> : Copy out the transaction sets with control number id, or else
+                      the claims with patient account number id, each in its envelope
+                      (a claim with its HL loops). Goes straight to them through the
+                      index, building it first if needed. The operations above are run
+                      on what is copied out.
+
+        {bc.OKCYAN}-split{bc.ENDC} <n> : Write the file as <filename>-part0001.edi, -part0002.edi, ...
+                    with at most n transaction sets each, in an ISA/GS envelope
+                    of their own with the GE and IEA counts made to match.
+                    Every ISA13 and GS06 written is a new number: 1, 2, ... or,
+                    with -control-file, one no other run sharing the file gave out.
+        {bc.OKCYAN}-split-size{bc.ENDC} <n> : The same, with parts of at most n kilobytes (before any
+                         compression). Can be used with -split.
+
+        {bc.OKCYAN}-merge{bc.ENDC} : Put the transaction sets of all the files given into the one
+                 interchange -o, under the ISA of the first file (the others have to
+                 have the same sender and receiver). Their groups are numbered from 1
+                 (with -control-file, the interchange and groups get new numbers
+                 from it).
+
+    The operations above can be combined with -split, -split-size and -merge,
+    they are run before the file is split or merged.
+
+    Files ending in .gz (or .zst, with the zstandard package installed) are
+    read and written compressed, without decompressing them onto the disk
+    first. -index and -extract need byte offsets in the file, they only work
+    on uncompressed files.
+
     Options:
         (new files are created by default)
         {bc.OKCYAN}-i{bc.ENDC} : (in-place) rewrite the input file and do not create a new one.
         {bc.OKCYAN}-o{bc.ENDC} <filename> : write the output to this specific file.
+        {bc.OKCYAN}-jobs{bc.ENDC} <n> : process ST-SE transaction sets (or files, if there are
+                     several) on n processes.
+        {bc.OKCYAN}-y{bc.ENDC} : don't ask for confirmation before starting.
+        {bc.OKCYAN}-diagnostics{bc.ENDC} <filename> : write everything found to the file as JSON Lines.
+        {bc.OKCYAN}-log-limit{bc.ENDC} <n> : show at most n of them on the terminal (default 100), the
+                          rest are counted by code.
+        {bc.OKCYAN}-stats{bc.ENDC} : print the time spent in each stage and handler at the end.
+        {bc.OKCYAN}-stats-json{bc.ENDC} <filename> : write those numbers to a JSON file instead.
+        {bc.OKCYAN}-profile{bc.ENDC} <filename> : run under cProfile and save the profile to the file
+                         (with -jobs, only the work of the main process is in it).
+        {bc.OKCYAN}-cache{bc.ENDC} : cache the output of each ST-SE transaction set, and reuse it while the
+                 set and the options don't change (not with -jobs, -gen-uuid or -format on
+                 its own). The cache holds the claim data of the files, it is only readable
+                 by you.
+        {bc.OKCYAN}-no-cache{bc.ENDC} : don't use the cache, even with -cache.
+        {bc.OKCYAN}-cache-dir{bc.ENDC} <directory> : where to keep the cache (default ~/.cache/edi-edits).
+        {bc.OKCYAN}-cache-size{bc.ENDC} <n> : keep it under n megabytes (default 256), dropping what was
+                           used least recently.
+        {bc.OKCYAN}-serve{bc.ENDC} : keep running, processing each file put into the directories given
+                 (in place of files) once it stops changing, n at a time with -jobs n.
+                 Outputs go next to the inputs, or into the directory given with -o.
+        {bc.OKCYAN}-poll{bc.ENDC} <n> : with -serve, look for new files every n seconds (default 1).
 
     Fix Error Options (only applies for -fix-errors):
-        {bc.OKCYAN}-gen-uuid{bc.ENDC} : generate unique ID's for ST and SE control numbers.
+        {bc.OKCYAN}-gen-uuid{bc.ENDC} : number the ST and SE control numbers 0001, 0002, ... in file order.
+        {bc.OKCYAN}-control-file{bc.ENDC} <filename> : with -gen-uuid (and -split or -merge), keep counting
+                                 from the numbers already given out by the runs that used this
+                                 file, so no number is given out twice (gaps are left between
+                                 runs).
         {bc.OKCYAN}-claim-amount{bc.ENDC} : Validate the total claim amount.
-        {bc.OKCYAN}-hl-num{bc.ENDC} : Number the HL segments within ST-SE according to their occurance order.
+        {bc.OKCYAN}-hl-num{bc.ENDC} : Number the HL segments within ST-SE according to their occurance order
+                  (the HL02 parent numbers follow).
         {bc.OKCYAN}-lx-num{bc.ENDC} : Number the LX segments within CLM according to their occurance order.
 
-        {bc.OKCYAN}-hl-logic-off{bc.ENDC} : Don't fix HL segment logic (on by default).
-        {bc.OKCYAN}-seg-count-off{bc.ENDC} : Don't update segment count (on by default).
+        {bc.OKCYAN}-hl-logic-off{bc.ENDC} : Don't fix HL segment logic (on by default): HL02 pointing at the
+                         parent level, found from the HL03 level codes, and HL04 saying
+                         whether child levels follow.
+        {bc.OKCYAN}-seg-count-off{bc.ENDC} : Don't update the SE, GE and IEA counts and control numbers to
+                          match their ST, GS and ISA (on by default).
 '''
 
 OPT_ID_LOOPS = '-id-loops'
@@ -97,15 +320,89 @@ OPT_CLM_AMT = '-claim-amount'
 OPT_HL_LOGIC = '-hl-logic-off'
 OPT_SEG_COUNT = '-seg-count-off'
 OPT_INPUT_FILE = 'input-file'
+OPT_INPUT_FILES = 'input-files'
 OPT_LX_NUM = '-lx-num'
+OPT_JOBS = '-jobs'
+OPT_YES = '-y'
+OPT_STATS = '-stats'
+OPT_STATS_JSON = '-stats-json'
+OPT_PROFILE = '-profile'
+OPT_DIAGNOSTICS = '-diagnostics'
+OPT_LOG_LIMIT = '-log-limit'
+OPT_CACHE = '-cache'
+OPT_NO_CACHE = '-no-cache'
+OPT_CACHE_DIR = '-cache-dir'
+OPT_CACHE_SIZE = '-cache-size'
+OPT_SERVE = '-serve'
+OPT_POLL = '-poll'
+OPT_WATCH_DIRS = 'watch-dirs'
+OPT_INDEX = '-index'
+OPT_EXTRACT = '-extract'
+OPT_CONTROL_FILE = '-control-file'
+OPT_SPLIT = '-split'
+OPT_SPLIT_SIZE = '-split-size'
+OPT_MERGE = '-merge'
+
+# Options followed by a value, with what the value is in error messages
+VALUE_OPTS = {
+    OPT_OUT_FILE: "an output file",
+    OPT_STATS_JSON: "a file for the stats",
+    OPT_PROFILE: "a file for the profile",
+    OPT_DIAGNOSTICS: "a file for the diagnostics",
+    OPT_CACHE_DIR: "a directory for the cache",
+    OPT_EXTRACT: "a control number or patient account number",
+    OPT_CONTROL_FILE: "a file for the control numbers",
+}
+
+# Options followed by a whole number: (what it is, smallest value)
+INT_OPTS = {
+    OPT_JOBS: ("a number of processes", 1),
+    OPT_LOG_LIMIT: ("a number of logs to show", 0),
+    OPT_CACHE_SIZE: ("a size in megabytes", 1),
+    OPT_POLL: ("a number of seconds", 1),
+    OPT_SPLIT: ("a number of transaction sets", 1),
+    OPT_SPLIT_SIZE: ("a size in kilobytes", 1),
+}
+
+# Diagnostics shown on the terminal by default
+LOG_LIMIT = 100
+
+# Options that change the output of a transaction set, part of its key in
+# the cache
+CACHE_OPTS = (OPT_ID_LOOPS, OPT_FIX_ERRORS, OPT_FORMAT, OPT_HL_NUM,
+              OPT_CLM_AMT, OPT_HL_LOGIC, OPT_SEG_COUNT, OPT_LX_NUM)
+CACHE_FILE = "cache.sqlite3"
+
+# Megabytes the cache is kept under
+CACHE_SIZE = 256
+
+# Seconds to wait for another run holding the cache
+CACHE_TIMEOUT = 30
+
+# Seconds between two looks at the directories watched by -serve
+POLL_INTERVAL = 1
+
+SEVERITY_INFO = 'info'
+SEVERITY_WARNING = 'warning'
+SEVERITY_ERROR = 'error'
+
+# Diagnostic codes
+DIAG_SE_COUNT = 'se-count'
+DIAG_GE_COUNT = 'ge-count'
+DIAG_IEA_COUNT = 'iea-count'
+DIAG_CONTROL_NUMBER = 'control-number'
+DIAG_CLAIM_TOTAL = 'claim-total'
+DIAG_HL_PARENT = 'hl-parent'
+DIAG_HL_CHILD = 'hl-child'
+DIAG_LEADING_WHITESPACE = 'leading-whitespace'
+DIAG_MISSING_TERMINATOR = 'missing-terminator'
+DIAG_AFTER_TERMINATOR = 'after-terminator'
 
 LOG_WARN = 'warn'
 LOG_ERROR = 'error'
 LOG_INFO = 'info'
 LOG_SUCC = 'success'
 
-logs = []
-
 
 def print_help():
     print(help_msg)
@@ -155,30 +452,46 @@ class LoopObject():
         return string
 
 
-def get_parent_loop(items, name):
-    '''Find the parent object from the name of the loop.'''
-
-    for item in items:
-        if name == item.name:
-            return item
-    return None
+def resolve_parents(loops: list[LoopObject]) -> None:
+    '''Replace the parent names of `loops` with the parent objects.'''
 
+    by_name = {}
+    for loop in loops:
+        by_name.setdefault(loop.name, loop)
 
-def set_parent(loops):
-    '''Update the string parent name to the parent object.'''
     for loop in loops:
         if loop.parent is not None and isinstance(loop.parent, str):
-            loop.parent = get_parent_loop(loops, loop.parent)
+            loop.parent = by_name.get(loop.parent)
+
+
+def pattern_matches(pattern: tuple, segment: list[str]) -> bool:
+    '''Check `segment` against a single start/end pattern.'''
+
+    if (len(pattern) > len(segment)):
+        return False
+
+    for expected, value in zip(pattern, segment):
+        if (expected != WILDCARD and expected != value):
+            return False
+
+    return True
 
 
 def check_loop_start(loops: list[LoopObject], segment) -> None | LoopObject:
+    '''Linear scan for the first loop `segment` starts.
+
+    Kept as the reference for `LoopMatcher`, which gives the same answers.
+    '''
     for loop in loops:
         for possible_start in loop.start:
+            if (len(possible_start) > len(segment)):
+                continue
+
             flag = True
             for i in range(len(possible_start)):
                 flag = (flag and
                         (possible_start[i] == segment[i]
-                         or possible_start[i] == "*"))
+                         or possible_start[i] == WILDCARD))
 
             if flag:
                 return loop
@@ -186,615 +499,4324 @@ def check_loop_start(loops: list[LoopObject], segment) -> None | LoopObject:
     return None
 
 
-LOOP_INFO = [
-    # name, start, end, situ, desc, repeat, required, parent
-    LoopObject(
-        "1000A",  [("NM1", "41")], [("PER",)], [], "Submitter Name", 1,
-        True, None
-    ),
-    LoopObject(
-        "1000B",  [("NM1", "40")], [], [], "Receiver Name",
-        1, True, None
-    ),
-    LoopObject(
-        "2000A",  [("HL", "*", "*", "20")], [], [("PRV",), ("CUR",)],
-        "Provider Hierarchical Level", 1, True, None
-    ),
-    LoopObject(
-        "2010AA", [("NM1", "85")], [("REF",)], [("PER",)],
-        "Billing Provider Name", 1, True, "2000A"
-    ),
-    LoopObject(
-        "2010AB", [("NM1", "87")], [("REF",)], [],
-        "Pay to address name", 1, False, "2000A"
-    ),
-    LoopObject(
-        "2010AC", [("NM1", "PE")], [("REF",), ("REF",)], [],
-        "Pay to plan name", 1, False, "2000A"
-    ),
-
-    LoopObject(
-        "2000B",  [("HL", "*", "*", "22")], [("SBR",)], [],
-        "Subscriber Hierarchial Level", -1, True, None
-    ),
-    LoopObject(
-        "2010BA", [("NM1", "IL")], [("REF",), ("REF",)], [],
-        "Subscriber Name", 1, True, "2000B"
-    ),
-    LoopObject(
-        "2010BB-1", [("NM1", "AO")], [("REF",)], [],
-        "Account Holder Name", 1, True, "2000B"
-    ),
-    LoopObject(
-        "2010BB-2", [("NM1", "PR")], [("REF",), ("REF",)], [],
-        "Payer Name", 1, True, "2000B"
-    ),
-    LoopObject(
-        "2010BD", [("NM1", "QD")], [("N3",), ("N4",)], [],
-        "Responsible Party Name", 1, False, "2000B"
-    ),
-
-    LoopObject(
-        "2000C", [("HL", "*", "*", "23")], [("N3",), ("N4",)], [],
-        "Patient Hierarchical Level", 1, False, None
-    ),
-    LoopObject(
-            "2010CA", [("NM1", "QC")], [], [],
-            "Patient Name", 1, False, "2000C"
-    ),
-    LoopObject(
-            "2300", [("CLM",)], [], [],
-            "Claim Information", 1, True, "2000C"
-    ),
-    LoopObject(
-            "2310A", [("NM1", "71")], [], [],
-            "Attending Provider", 1, False, "2300"
-    ),
-    LoopObject(
-            "2310A", [("NM1", "72")], [], [],
-            "Operating Physician", 1, False, "2300"
-    ),
-    LoopObject(
-            "2310D", [("NM1", "82")], [], [],
-            "Rendering Provider", 1, False, "2300"
-    ),
-    LoopObject(
-            "2310E", [("NM1", "77")], [], [],
-            "Service Location", 1, False, "2300"
-    ),
-    LoopObject(
-            "2310F", [("NM1", "DN")], [], [],
-            "Referring Provider", 1, False, "2300"
-    ),
-    LoopObject(
-            "2320", [("SBR", "S")], [], [],
-            "Other Subscriber Info", 1, False, "2300"
-    ),
-    LoopObject(
-            "2330A", [("NM1", "IL")], [], [],
-            "Other Subscriber Name", 1, False, "2320"
-    ),
-    LoopObject(
-            "2400", [("LX",)], [], [],
-            "Service Line", 1, False, "2300"
-    ),
-    LoopObject(
-            "2410", [("LIN",)], [], [],
-            "Drug Information", 1, False, "2400"
-    ),
-    LoopObject(
-            "2430", [("SVD",)], [], [],
-            "Line Adjudication Info", 1, False, "2400"
-    ),
-]
+class LoopMatcher():
+    '''Precompiled lookup of the loop a segment starts.
 
+    The start patterns of `loops` are grouped by segment ID. Consecutive
+    patterns of an ID that fix the same element positions (and have the
+    same length) share one dict keyed on the values at those positions, so
+    a lookup is one dict access per group (usually a single group) instead
+    of a scan over every loop.
+    Patterns are kept in `loops` order and the first match wins, exactly
+    like `check_loop_start`.
+    '''
 
-def find_non_whitespace_character(string: str):
-    for index, char in enumerate(string):
-        if char not in WHITESPACE:
-            return index
+    def __init__(self, loops: list[LoopObject]) -> None:
+        self.loops = loops
 
-    # For empty lines
-    raise ValueError("non-whitespace character not found.")
+        patterns = []
+        for loop in loops:
+            for possible_start in loop.start:
+                patterns.append((possible_start, loop))
 
+        ids = {start[0] for start, _ in patterns if start[0] != WILDCARD}
 
-def parse_edi_to_array(lines: list[str]):
-    # Example line: "\t\t SE*1393*3013~\n\r"
-    data = []
-    for line in lines:
-        try:
-            index_start = find_non_whitespace_character(line)
-        except ValueError:
-            # Empty line
-            parts = {
-                START: "",
-                SEGMENT: "",
-                END: line
-            }
-            data.append(parts)
+        # segment id -> [(positions, getter, length, {key: loop}), ...]
+        self.table = {}
+        for segment_id in ids:
+            self.table[segment_id] = self.compile_groups(
+                [(start, loop) for start, loop in patterns
+                 if start[0] in (segment_id, WILDCARD)])
+
+        # Used for IDs that no pattern names explicitly
+        self.wildcard_groups = self.compile_groups(
+            [(start, loop) for start, loop in patterns
+             if start[0] == WILDCARD])
+
+    @staticmethod
+    def compile_groups(patterns: list) -> list[tuple]:
+        groups = []
+        for start, loop in patterns:
+            positions = tuple(i for i in range(1, len(start))
+                              if start[i] != WILDCARD)
+
+            # The segment needs at least as many elements as the pattern
+            length = len(start)
+
+            if (not groups or groups[-1][0] != positions
+                    or groups[-1][2] != length):
+                getter = None
+                if (positions):
+                    getter = operator.itemgetter(*positions)
+
+                groups.append((positions, getter, length, {}))
+
+            _, getter, length, lookup = groups[-1]
+            key = getter(start) if getter is not None else None
+            candidates = lookup.setdefault(key, [])
+            if (loop not in candidates):
+                candidates.append(loop)
+
+        return groups
+
+    def candidates(self, segment: list[str]) -> list[LoopObject]:
+        '''All the loops `segment` could start, in `loops` order.'''
+
+        groups = self.table.get(segment[0], self.wildcard_groups)
+
+        if (len(groups) == 1):
+            # The usual case, no merging needed
+            _, getter, length, lookup = groups[0]
+            if (len(segment) < length):
+                return []
+            key = getter(segment) if getter is not None else None
+            return lookup.get(key, [])
+
+        found = []
+        for _, getter, length, lookup in groups:
+            if (len(segment) < length):
+                continue
+
+            key = getter(segment) if getter is not None else None
+            for loop in lookup.get(key, ()):
+                if (loop not in found):
+                    found.append(loop)
+
+        return found
+
+    def match(self, segment: list[str]) -> None | LoopObject:
+        '''The first loop `segment` starts, like `check_loop_start`.'''
+
+        groups = self.table.get(segment[0], self.wildcard_groups)
+
+        for _, getter, length, lookup in groups:
+            if (len(segment) < length):
+                continue
+
+            key = getter(segment) if getter is not None else None
+            candidates = lookup.get(key)
+            if (candidates):
+                return candidates[0]
+
+        return None
+
+
+class LoopTracker():
+    '''Keeps the stack of open loops while walking a transaction set.
+
+    The loops looked for are those of the type of the transaction set, read
+    from its ST segment (DEFAULT_TRANSACTION until there is one).
+    A segment that could start several loops (NM1*IL is both 2010BA and
+    2330A) is resolved to the one whose parent is the innermost open loop.
+    Starting a loop closes everything opened below its parent, and the
+    innermost loop is closed once its last `end` segment is seen. Each
+    segment costs at most O(depth) work.
+    '''
+
+    def __init__(self) -> None:
+        self.matcher: None | LoopMatcher = None
+        self.stack: list[LoopObject] = []
+
+    def feed(self, segment: list[str]) -> None | LoopObject:
+        '''Update the open loops with `segment`, return the loop it starts.'''
+
+        if (segment[0] in TRANSACTION_BOUNDS):
+            self.stack.clear()
+            if (segment[0] == "ST"):
+                self.matcher = loop_matcher(
+                    segment[1] if len(segment) > 1 else "",
+                    segment[3] if len(segment) > 3 else "")
+            return None
+
+        if (self.matcher is None):
+            self.matcher = loop_matcher(DEFAULT_TRANSACTION)
+
+        candidates = self.matcher.candidates(segment)
+
+        if (not candidates):
+            top = self.stack[-1] if self.stack else None
+            if (top is not None and top.end
+                    and pattern_matches(top.end[-1], segment)):
+                self.stack.pop()
+            return None
+
+        loop = self.resolve(candidates)
+        self.open(loop)
+        return loop
+
+    def anchor(self, loop: LoopObject) -> tuple[bool, None | LoopObject]:
+        '''Whether `loop` can be opened here, and the open loop it goes
+        under (None for the top level).
+
+        Parents that aren't open can only be skipped when they are optional
+        (no 2000C before a 2300). A loop whose missing parent is required
+        (a 2320 with no 2300 open) can't be part of the open loops.
+        '''
+        parent = loop.parent
+        while (parent is not None and parent not in self.stack):
+            if (parent.required):
+                return False, None
+            parent = parent.parent
+
+        return True, parent
+
+    def resolve(self, candidates: list[LoopObject]) -> LoopObject:
+        if (len(candidates) == 1):
+            return candidates[0]
+
+        candidates = ([loop for loop in candidates if self.anchor(loop)[0]]
+                      or candidates)
+
+        for open_loop in reversed(self.stack):
+            for loop in candidates:
+                if (loop.parent is open_loop):
+                    return loop
+
+        for loop in candidates:
+            if (loop.parent is None):
+                return loop
+
+        return candidates[0]
+
+    def open(self, loop: LoopObject) -> None:
+        stack = self.stack
+        placeable, anchor = self.anchor(loop)
+
+        if (not placeable):
+            # Still named, but what is open stays as it is
+            return
+
+        if (loop.parent is None):
+            stack.clear()
+
+        elif (anchor is not None):
+            while (stack[-1] is not anchor):
+                stack.pop()
+
+        else:
+            # The optional parents were left out, hang the loop under the
+            # closest top level loop.
+            while (stack and stack[-1].parent is not None):
+                stack.pop()
+
+        stack.append(loop)
+
+
+def read_loop_file(filename: str) -> list[LoopObject]:
+    '''The loops defined in the JSON file `filename`, parents resolved.'''
+
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+
+        loops = [
+            LoopObject(
+                loop["name"], [tuple(start) for start in loop["start"]],
+                [tuple(end) for end in loop["end"]],
+                [tuple(segment) for segment in loop["situational"]],
+                loop["desc"], loop["repeat"], loop["required"],
+                loop["parent"]
+            )
+            for loop in data["loops"]
+        ]
+    except (ValueError, KeyError, TypeError) as e:
+        raise EdiError(f"Bad loop definitions in {filename} ({e!r}). "
+                       "Exiting.") from None
+
+    resolve_parents(loops)
+    return loops
+
+
+def loop_matcher(transaction: str, version: str = "") -> LoopMatcher:
+    '''The compiled loops of transaction sets of type `transaction` (ST01).
+
+    A file for the implementation guide `version` (ST03), such as
+    loops/837-005010X222A1.json, is used over the one for the type,
+    loops/837.json. Each file is read and compiled the first time a
+    transaction set needs it and kept for the rest of the process, so only
+    the types in the input are ever loaded. Types without a file have no
+    loops.
+    '''
+    key = (transaction, version)
+    matcher = LOOP_MATCHERS.get(key)
+    if (matcher is not None):
+        return matcher
+
+    matcher = NO_LOOPS
+    names = [f"{transaction}-{version}", transaction]
+
+    # The values come from the input, keep them from naming other paths
+    for name in names if version.isalnum() else names[1:]:
+        filename = os.path.join(LOOPS_DIR, f"{name}.json")
+        if (not transaction.isalnum() or not os.path.isfile(filename)):
             continue
 
-        try:
-            index_tilda = line.index(TERMINATOR)
-        except ValueError:
-            if (NEWLINE in line):
-                index_tilda = line.index(NEWLINE)
+        matcher = LOOP_FILES.get(filename)
+        if (matcher is None):
+            matcher = LoopMatcher(read_loop_file(filename))
+            LOOP_FILES[filename] = matcher
+        break
+
+    LOOP_MATCHERS[key] = matcher
+    return matcher
+
+
+def loop_files() -> list[str]:
+    '''Every loop definition file, for the cache key.'''
+    return sorted(glob.glob(os.path.join(LOOPS_DIR, "*.json")))
+
+
+class Delimiters():
+    '''Separators used by one interchange.'''
+
+    def __init__(self, element: str = DELIMITER, component: str = COMPONENT,
+                 repetition: str = REPETITION,
+                 terminator: str = TERMINATOR) -> None:
+
+        self.element = element
+        self.component = component
+        self.repetition = repetition
+        self.terminator = terminator
+
+        # For finding them in the raw bytes of a mapped file
+        self.element_bytes = element.encode()
+        self.terminator_bytes = terminator.encode()
+
+
+# Used for anything before the first ISA segment
+DEFAULT_DELIMS = Delimiters()
+
+
+def read_isa_delimiters(isa: str) -> None | Delimiters:
+    '''Read the separators out of the (fixed width) ISA segment `isa`.'''
+
+    if (len(isa) < ISA_LENGTH or not isa.startswith(ISA_ID)):
+        return None
+
+    element = isa[len(ISA_ID)]
+    for pos in ISA_ELEMENT_POS:
+        if (isa[pos] != element):
+            return None
+
+    terminator = isa[ISA_TERMINATOR_POS]
+    if (terminator == element or terminator.isalnum()):
+        return None
+
+    return Delimiters(element, isa[ISA_COMPONENT_POS],
+                      isa[ISA_REPETITION_POS], terminator)
+
+
+# Compiled loops by (ST01, ST03) and by file, see loop_matcher
+LOOP_MATCHERS: dict[tuple[str, str], LoopMatcher] = {}
+LOOP_FILES: dict[str, LoopMatcher] = {}
+NO_LOOPS = LoopMatcher([])
+
+
+def byte_length(text: str) -> int:
+    '''Length of `text` once written out, in bytes.'''
+    return len(text) if text.isascii() else len(text.encode())
+
+
+class Segment():
+    '''One segment of the input, split into its elements only when needed.
+
+    Holds the source text of the segment and where its START, SEGMENT and
+    END parts are in it. The parts are sliced out when read and SEGMENT is
+    split into its elements on first use, so a segment that no handler
+    looks into costs a string and two ints, and is written out as the
+    original text. Indexing with START / SEGMENT / END / DELIMS works like
+    it did on the dicts this replaces.
+    '''
+
+    __slots__ = ("text", "delims", "body_start", "body_end",
+                 "_start", "_elements", "_end")
+
+    def __init__(self, text: str, delims: Delimiters = DEFAULT_DELIMS) -> None:
+        self.text = text
+        self.delims = delims
+        self._start = None
+        self._elements = None
+        self._end = None
+
+        # Example line: "\t\t SE*1393*3013~\n\r"
+        body_start = len(text) - len(text.lstrip(WHITESPACE))
+
+        if (body_start == len(text)):
+            # Empty line, everything is END
+            self.body_start = self.body_end = -1
+            return
+
+        body_end = text.find(delims.terminator, body_start)
+        if (body_end == -1):
+            body_end = text.find(NEWLINE, body_start)
+            if (body_end == -1):
+                body_end = len(text)-1
+
+        self.body_start = body_start
+        self.body_end = body_end
+
+    @classmethod
+    def from_parts(cls, start: str, elements: list[str], end: str,
+                   delims: Delimiters = DEFAULT_DELIMS) -> "Segment":
+        segment = cls("", delims)
+        segment._start = start
+        segment._elements = elements
+        segment._end = end
+        return segment
+
+    @property
+    def is_empty(self) -> bool:
+        if (self._elements is None):
+            return self.body_end == -1
+        return len(self._elements) == 0
+
+    @property
+    def start(self) -> str:
+        if (self._start is None):
+            return self.text[:self.body_start] if self.body_start > 0 else ""
+        return self._start
+
+    @start.setter
+    def start(self, value: str) -> None:
+        self._start = value
+
+    @property
+    def end(self) -> str:
+        if (self._end is None):
+            return self.text if self.body_end == -1 else \
+                self.text[self.body_end:]
+        return self._end
+
+    @end.setter
+    def end(self, value: str) -> None:
+        self._end = value
+
+    @property
+    def elements(self) -> list[str]:
+        if (self._elements is None):
+            if (self.body_end == -1):
+                self._elements = []
             else:
-                index_tilda = len(line)-1
+                self._elements = self.text[
+                    self.body_start:self.body_end].split(self.delims.element)
+        return self._elements
 
-        parts = {
-            START: line[:index_start],
-            SEGMENT: line[index_start:index_tilda].split(DELIMITER),
-            END: line[index_tilda:]
-        }
-        data.append(parts)
+    @elements.setter
+    def elements(self, value: list[str]) -> None:
+        self._elements = value
 
-    return data
+    def peek_elements(self) -> list[str]:
+        '''The elements, for reading only.
 
+        Unlike `elements` they aren't kept, so the segment still counts as
+        unchanged and is written out as it was read.
+        '''
+        if (self._elements is not None or self.body_end == -1):
+            return self.elements
+        return self.text[self.body_start:self.body_end].split(
+            self.delims.element)
 
-def edi_array_to_lines(edi_array):
-    lines = []
+    @property
+    def id(self) -> str:
+        '''The segment ID (first element), without splitting the rest.'''
 
-    for item in edi_array:
-        segment_str = DELIMITER.join(item[SEGMENT])
-        line = item[START] + segment_str + item[END]
-        lines.append(line)
+        if (self._elements is not None):
+            return self._elements[0] if self._elements else ""
 
-    return lines
+        if (self.body_end == -1):
+            return ""
+
+        end = self.text.find(self.delims.element, self.body_start,
+                             self.body_end)
+        return self.text[self.body_start:end if end != -1 else self.body_end]
+
+    def is_comment(self) -> bool:
+        return self.id.startswith(COMMENT)
+
+    def id_startswith(self, prefix: str) -> bool:
+        '''Quick check before comparing `id`, no slicing or splitting.'''
+
+        if (self._elements is not None):
+            return self.id.startswith(prefix)
+        return self.text.startswith(prefix, self.body_start)
+
+    @property
+    def size(self) -> int:
+        '''Length of the segment in the input, in bytes.'''
+
+        return byte_length(self.text)
+
+    def source_range(self) -> None | tuple[int, int]:
+        '''Where the unchanged segment is in the mapped input, see
+        `MappedSegment`. None for segments that have to be written out.
+        '''
+        return None
+
+    def to_line(self) -> str:
+        if (self._elements is None and self._start is None
+                and self._end is None):
+            return self.text
+
+        segment_str = self.delims.element.join(self.elements)
+        return self.start + segment_str + self.end
+
+    def __getitem__(self, key: str):
+        return getattr(self, SEGMENT_PARTS[key])
+
+    def __setitem__(self, key: str, value) -> None:
+        setattr(self, SEGMENT_PARTS[key], value)
+
+
+class CrlfSegment(Segment):
+    '''A segment read with carriage returns, which are dropped from it.
+
+    Its line breaks are written out as LF like the rest of the file, but
+    its `size` still counts the CRs, so the offsets of the diagnostics are
+    byte positions in the file as it is.
+    '''
+
+    __slots__ = ("dropped",)
+
+    def __init__(self, text: str, delims: Delimiters = DEFAULT_DELIMS) -> None:
+        lf = text.replace(CRLF, NEWLINE)
+        self.dropped = len(text) - len(lf)
+        super().__init__(lf.replace(CARRIAGE_RETURN, NEWLINE), delims)
+
+    @property
+    def size(self) -> int:
+        return super().size + self.dropped
+
+
+class MappedSegment(Segment):
+    '''A segment of a memory-mapped input, kept as positions in the bytes.
+
+    Only the parts that are looked at are decoded: `id` decodes just the
+    segment ID, START and END only their few characters. A segment that is
+    never changed is not decoded at all and is copied to the output straight
+    from the mapped file (see `write_edi_items`). Positions are absolute
+    byte offsets, -1 for the body of an empty line.
+    '''
+
+    __slots__ = ("buffer", "pos", "end_pos")
+
+    def __init__(self, buffer, pos: int, body_start: int, body_end: int,
+                 end_pos: int, delims: Delimiters) -> None:
+        self.buffer = buffer
+        self.pos = pos
+        self.end_pos = end_pos
+        self.body_start = body_start
+        self.body_end = body_end
+        self.delims = delims
+        self._start = None
+        self._elements = None
+        self._end = None
+
+    @property
+    def text(self) -> str:
+        return self.buffer[self.pos:self.end_pos].decode()
+
+    @property
+    def start(self) -> str:
+        if (self._start is None):
+            if (self.body_end == -1 or self.body_start == self.pos):
+                return ""
+            return self.buffer[self.pos:self.body_start].decode()
+        return self._start
+
+    @start.setter
+    def start(self, value: str) -> None:
+        self._start = value
+
+    @property
+    def end(self) -> str:
+        if (self._end is None):
+            if (self.body_end == -1):
+                return self.text
+            return self.buffer[self.body_end:self.end_pos].decode()
+        return self._end
+
+    @end.setter
+    def end(self, value: str) -> None:
+        self._end = value
+
+    @property
+    def elements(self) -> list[str]:
+        if (self._elements is None):
+            if (self.body_end == -1):
+                self._elements = []
+            else:
+                self._elements = self.buffer[
+                    self.body_start:self.body_end].decode().split(
+                        self.delims.element)
+        return self._elements
 
+    @elements.setter
+    def elements(self, value: list[str]) -> None:
+        self._elements = value
 
-class SegmentCounter:
-    counting = False
-    count = 0
-    start = 0
+    def peek_elements(self) -> list[str]:
+        if (self._elements is not None or self.body_end == -1):
+            return self.elements
+        return self.buffer[self.body_start:self.body_end].decode().split(
+            self.delims.element)
 
+    @property
+    def id(self) -> str:
+        if (self._elements is not None):
+            return self._elements[0] if self._elements else ""
 
-def handle_segment_count(item, index):
-    if (item[SEGMENT][0] == "ST"):
-        if (SegmentCounter.counting):
-            print(f"Recieved ST 2x in a row at {SegmentCounter.start + 1}"
-                  f" and {index + 1}. Exiting.")
-            exit(1)
+        if (self.body_end == -1):
+            return ""
 
-        SegmentCounter.counting = True
-        SegmentCounter.start = index
-        SegmentCounter.count = 0
+        end = self.buffer.find(self.delims.element_bytes, self.body_start,
+                               self.body_end)
+        return self.buffer[self.body_start:
+                           end if end != -1 else self.body_end].decode()
 
-    if (SegmentCounter.counting):
-        SegmentCounter.count += 1
+    def id_startswith(self, prefix: str) -> bool:
+        if (self._elements is not None or self.body_end == -1):
+            return self.id.startswith(prefix)
 
-    if (item[SEGMENT][0] == "SE"):
-        if (not SegmentCounter.counting):
-            print(f"Recieved SE before ST at {index + 1}. Exiting.")
-            exit(1)
+        start = self.body_start
+        return self.buffer[start:start + len(prefix)] == prefix.encode()
 
-        count = int(item[SEGMENT][1])
-        if (count != SegmentCounter.count):
-            logs.append((index, f"Segment Count for SE mismatch, "
-                                f"updating to {SegmentCounter.count}"))
-            item[SEGMENT][1] = str(SegmentCounter.count)
+    @property
+    def size(self) -> int:
+        return self.end_pos - self.pos
 
-        SegmentCounter.counting = False
+    def source_range(self) -> None | tuple[int, int]:
+        if (self._elements is None and self._start is None
+                and self._end is None):
+            return self.pos, self.end_pos
+        return None
 
-    return item
 
+def parse_edi_line(line: str, delims: Delimiters = DEFAULT_DELIMS) -> Segment:
+    '''Parse a single segment into its {START, SEGMENT, END} parts.'''
+    if (CARRIAGE_RETURN in line):
+        return CrlfSegment(line, delims)
+    return Segment(line, delims)
 
-class SegmentIDTracker:
-    generated_id = 0
 
+def parse_edi_stream(segments):
+    '''Lazily parse (segment, delims) pairs, one item at a time.'''
+    for line, delims in segments:
+        yield parse_edi_line(line, delims)
 
-def handle_segment_uuid(item, index):
 
-    if (item[SEGMENT][0] == "ST"):
-        # Random 9 digit number
-        SegmentIDTracker.generated_id = randint(10**8, 10**9 - 1)
-        item[SEGMENT][2] = str(SegmentIDTracker.generated_id)
+def edi_item_to_line(item: Segment) -> str:
+    return item.to_line()
 
-    if (item[SEGMENT][0] == "SE"):
-        item[SEGMENT][2] = str(SegmentIDTracker.generated_id)
 
-    return item
+class EdiError(Exception):
+    '''The input can't be processed any further.'''
 
 
-class ClaimAmountCheck:
-    clm_pos = 0
-    clm_total = 0.0
-    sv2_sum = 0.0
-    sv2_pos = []
-    active = False
-
-
-def handle_claim_sum(item, index):
-    if (item[SEGMENT][0] == "CLM"):
-        if (ClaimAmountCheck.active):
-            print(f"Recieved two CLMs in a row at "
-                  f"{ClaimAmountCheck.clm_pos+1} and {index+1}. Exiting.")
-            exit(1)
-
-        ClaimAmountCheck.active = True
-        ClaimAmountCheck.clm_pos = index
-        ClaimAmountCheck.clm_total = float(item[SEGMENT][2])  # Total amount
-        ClaimAmountCheck.sv2_sum = 0
-        ClaimAmountCheck.sv2_pos.clear()
-
-    if (item[SEGMENT][0] == "SV2"):
-        if (not ClaimAmountCheck.active):
-            print(f"Recieved SV2 without CLM at {index+1}. Exiting.")
-            exit(1)
-
-        ClaimAmountCheck.sv2_sum += float(item[SEGMENT][3])
-        ClaimAmountCheck.sv2_pos.append(index)
-
-    if (item[SEGMENT][0] == "SE"):
-        if (not ClaimAmountCheck.active):
-            print(f"Recieved SE without CLM at {index+1}. Exiting.")
-            exit(1)
-
-        if (ClaimAmountCheck.sv2_sum != ClaimAmountCheck.clm_total):
-            print(f"{bc.FAIL}CLM total mismatch. SV2 total: "
-                  f"{ClaimAmountCheck.sv2_sum}, CLM total: "
-                  f"{ClaimAmountCheck.clm_total}{bc.ENDC}")
-            print(f"\t SV2 segments lines: {ClaimAmountCheck.sv2_pos} "
-                  f"and CLM segment line: {ClaimAmountCheck.clm_pos}")
-
-        ClaimAmountCheck.active = False
+# (option, segment ids, handler) for every -fix-errors handler, in the
+# order they run.
+FIX_HANDLERS: list[tuple] = []
 
-    return item
 
+def register_handler(option: None | str, segment_ids: None | tuple = None):
+    '''Decorator registering a -fix-errors handler.
 
-class HLNumber:
-    counter = 1
+    The handler is called as handler(item, index, ctx) for the segments
+    with one of `segment_ids` (every segment if None), when `option` is set
+    in the run options (always if None), and returns the item. Handlers
+    run in the order they were registered. State a handler keeps between
+    segments goes in `ctx.handler_state`.
+    '''
 
+    def decorator(handler):
+        FIX_HANDLERS.append((option, segment_ids, handler))
+        return handler
 
-def handle_hl_num(item, index):
-    if (item[SEGMENT][0] == "SE"):
-        HLNumber.counter = 1
+    return decorator
 
-    if (item[SEGMENT][0] == "HL"):
-        item[SEGMENT][1] = str(HLNumber.counter)
-        HLNumber.counter += 1
 
-        if (len(item[SEGMENT]) != 5):
-            item[SEGMENT] = item[SEGMENT].insert(2, "")
+def build_dispatch(opts: dict) -> tuple[dict, tuple]:
+    '''Compile the handlers enabled by `opts` into a table by segment ID.
 
-    return item
+    Returns ({segment id: handlers}, handlers for any other segment), so
+    finding the handlers of a segment takes a single dict lookup.
+    '''
 
+    enabled = [(segment_ids, handler)
+               for option, segment_ids, handler in FIX_HANDLERS
+               if option is None or opts.get(option)]
 
-def handle_hl_logic(item, index):
-    if (item[SEGMENT][0] == "HL" and item[SEGMENT][3] == "20"):
-        if (item[SEGMENT][2] != ""):
-            logs.append((index, "HL Billing Provider Level had value "
-                                "for 2nd element, removed."))
-            item[SEGMENT][2] = ""
+    any_handlers = tuple(handler for segment_ids, handler in enabled
+                         if segment_ids is None)
 
-        if (item[SEGMENT][4] != "1"):
-            logs.append((index, "HL Billing Provider Level 4th element "
-                                "was NOT set to 1. Updated."))
-            item[SEGMENT][4] = "1"
+    table = {}
+    for segment_ids, _ in enabled:
+        for segment_id in (segment_ids or ()):
+            table[segment_id] = tuple(
+                handler for ids, handler in enabled
+                if ids is None or segment_id in ids)
 
-    if (item[SEGMENT][0] == "HL" and item[SEGMENT][3] == "22"):
-        if (item[SEGMENT][2] != "1"):
-            logs.append((index, "HL Subscriber Level 2nd element was "
-                                "NOT set to 1, updated."))
-            item[SEGMENT][2] = "1"
+    return table, any_handlers
 
-        if (item[SEGMENT][4] != "0"):
-            logs.append((index, "HL Subscriber Level 4th element was "
-                                "NOT set to 0. Updated."))
-            item[SEGMENT][4] = "0"
 
-    return item
+def envelope_tokens(delims: Delimiters) -> dict[str, str]:
+    '''The text each envelope segment starts with -> its segment ID.'''
 
+    return {(segment_id if segment_id == ISA_ID
+             else segment_id + delims.element): segment_id
+            for segment_id in [*ENVELOPE_CONTROL, *ENVELOPE_TRAILERS]}
 
-class LXNumber:
-    counter = 1
 
+def starts_segment(text: str, pos: int, delims: Delimiters) -> bool:
+    '''Whether `pos` is at the start of a segment (after whitespace).'''
 
-def handle_lx_num(item, index):
-    if (item[SEGMENT][0] == "CLM"):
-        LXNumber.counter = 1
+    while (pos > 0 and text[pos - 1] in LINE_WHITESPACE):
+        pos -= 1
 
-    if (item[SEGMENT][0] == "LX"):
-        item[SEGMENT][1] = str(LXNumber.counter)
-        LXNumber.counter += 1
+    return (pos == 0 or text[pos - 1] == NEWLINE
+            or text.endswith(delims.terminator, 0, pos))
 
-    return item
 
+class Envelope:
+    '''The interchange, group and transaction set a stream is in.
 
-def parse_arguments(args: list[str]):
-    opts = {
-        OPT_ID_LOOPS: False,
-        OPT_FIX_ERRORS: False,
-        OPT_FORMAT: False,
-        OPT_INPLACE: False,
-        OPT_OUT_FILE: "",
-        OPT_GEN_UUID: False,
-        OPT_HL_NUM: False,
-        OPT_CLM_AMT: False,
-        OPT_LX_NUM: False,
+    `stack` holds [segment ID, control number, count, index] for each open
+    ISA, GS and ST, outermost first. The count is what the trailer closing
+    it counts: the GS in an ISA, the ST in a GS, the segments in an ST.
+    '''
 
-        # Note that the string may have contridictor name
-        # This being true imples we perform HL logic.
-        OPT_HL_LOGIC: True,
-        OPT_SEG_COUNT: True,
+    def __init__(self) -> None:
+        self.stack: list[list] = []
+        self.transactions = 0
 
-        OPT_INPUT_FILE: ""
-    }
+    def copy(self) -> "Envelope":
+        envelope = Envelope()
+        envelope.stack = [list(frame) for frame in self.stack]
+        envelope.transactions = self.transactions
+        return envelope
 
-    recieved_flags = []
+    def open(self, segment_id: str, control: None | str,
+             index: None | int = None) -> None:
+        '''Push the header `segment_id`, closing what it can't be inside.'''
 
-    for key in opts:
-        if key in args and key not in recieved_flags:
-            recieved_flags.append(key)
+        stack = self.stack
+        levels = list(ENVELOPE_CONTROL)
+        level = levels.index(segment_id)
+        while (stack and levels.index(stack[-1][0]) >= level):
+            stack.pop()
 
-            if key == OPT_OUT_FILE:
-                index = args.index(key)
-                outfile = args[index+1]
+        if (stack and stack[-1][0] == ENVELOPE_PARENTS.get(segment_id)):
+            stack[-1][2] += 1
 
-                if (outfile in opts):
-                    print_log(
-                        "ERROR: Please provide an "
-                        f"output file with {OPT_OUT_FILE}.",
-                        LOG_ERROR
-                    )
-                    sys.exit(1)
+        if (segment_id == "ST"):
+            self.transactions += 1
 
-                opts[OPT_OUT_FILE] = outfile
-                args.pop(index+1)
-                args.pop(index)
+        # An ST counts itself
+        stack.append([segment_id, control, int(segment_id == "ST"), index])
+
+    def close(self, segment_id: str) -> None | list:
+        '''Pop the header the trailer `segment_id` closes and return it.
+
+        Anything left open inside it is dropped. None if it isn't open.
+        '''
+        stack = self.stack
+        header = ENVELOPE_TRAILERS[segment_id]
+
+        for depth in range(len(stack) - 1, -1, -1):
+            if (stack[depth][0] == header):
+                frame = stack[depth]
+                del stack[depth:]
+                return frame
 
+        return None
+
+    def scan(self, text: str, delims: Delimiters) -> bool:
+        '''Move the envelope past `text` without processing it.
+
+        Only the envelope segments are looked at, found with str.find. This
+        is how a piece of the file processed on its own (with -jobs or the
+        cache) gets the envelope at its start: the main process scans the
+        pieces before it. Returns whether `text` has a GE or IEA segment,
+        whose output then depends on that envelope.
+        '''
+        tokens = envelope_tokens(delims)
+        found = {token: text.find(token) for token in tokens}
+        trailers = False
+
+        while (True):
+            start, token = min(((pos, token) for token, pos in found.items()
+                                if pos != -1), default=(-1, None))
+            if (start == -1):
+                break
+
+            found[token] = text.find(token, start + 1)
+            if (not starts_segment(text, start, delims)):
+                continue
+
+            segment_id = tokens[token]
+
+            if (segment_id == ISA_ID):
+                isa_delims = read_isa_delimiters(
+                    text[start:start + ISA_LENGTH])
+                if (isa_delims is None):
+                    continue
+
+                if (isa_delims.element != delims.element):
+                    tokens = envelope_tokens(isa_delims)
+                    found = {token: text.find(token, start + 1)
+                             for token in tokens}
+                delims = isa_delims
+
+            end = text.find(delims.terminator, start)
+            if (end == -1):
+                end = len(text)
+            newline = text.find(NEWLINE, start, end)
+            if (newline != -1):
+                end = newline
+
+            if (segment_id in ENVELOPE_CONTROL):
+                elements = text[start:end].split(delims.element)
+                self.open(segment_id, element_at(elements,
+                                                 ENVELOPE_CONTROL[segment_id]))
             else:
-                args.remove(key)
-                opts[key] = not opts[key]
+                trailers = trailers or segment_id != "SE"
+                self.close(segment_id)
 
-        elif key in recieved_flags:
-            print_log(f"Recieved {key} twice. Ignoring.", LOG_WARN)
-            continue
+        return trailers
 
-    if (OPT_INPLACE in recieved_flags and OPT_OUT_FILE in recieved_flags):
-        print_log("Recieved both -i and -o. Not valid arguments. Exiting.",
-                  LOG_ERROR)
 
-    if len(args) != 2:
-        print_log("Improper number of arguments.", LOG_ERROR)
-        sys.exit(1)
+def tracks_envelope(opts: dict) -> bool:
+    '''Whether a run with `opts` has handlers that need the envelope.'''
+    return (opts[OPT_FIX_ERRORS]
+            and (opts[OPT_SEG_COUNT] or opts[OPT_GEN_UUID]))
 
-    input_file = args[1]
-    if (not os.path.isfile(input_file)):
-        print_log(f"Unable to find file {input_file}. Exiting", LOG_ERROR)
-        sys.exit(1)
 
-    opts[OPT_INPUT_FILE] = input_file
-    fname_without_ext, ext = os.path.splitext(input_file)
+def element_at(elements: list[str], position: int) -> None | str:
+    return elements[position] if position < len(elements) else None
 
-    if (opts[OPT_INPLACE]):
-        opts[OPT_OUT_FILE] = input_file
 
-    if (opts[OPT_OUT_FILE] == ""):
-        if (opts[OPT_FORMAT]):
-            opts[OPT_OUT_FILE] = f"{fname_without_ext}-formatted{ext}"
+def elements_with(item, position: int, index: int) -> list[str]:
+    '''The elements of `item` (at `index`), which has to have one at
+    `position`.'''
 
-        elif (opts[OPT_ID_LOOPS]):
-            opts[OPT_OUT_FILE] = f"{fname_without_ext}-withloops{ext}"
+    segment = item[SEGMENT]
+    if (position >= len(segment)):
+        raise EdiError(f"Recieved {item.id} without {item.id}"
+                       f"{position:02d} at {index + 1}. Exiting.")
+    return segment
+
+
+# What the count of each trailer is, for the diagnostics
+ENVELOPE_COUNTS = {
+    "SE": (DIAG_SE_COUNT, "Segment Count"),
+    "GE": (DIAG_GE_COUNT, "Transaction set count"),
+    "IEA": (DIAG_IEA_COUNT, "Group count"),
+}
+
+
+def reconcile_trailer(item, index, ctx, frame: list) -> None:
+    '''Make the count and control number of a trailer match its header.'''
+
+    header, control, count, _ = frame
+    trailer = item.id
+    elements = item.peek_elements()
+
+    value = element_at(elements, 1)
+    if (value is None or not value.isdigit() or int(value) != count):
+        code, what = ENVELOPE_COUNTS[trailer]
+        ctx.report(index, code, SEVERITY_WARNING,
+                   f"{what} for {trailer} mismatch, updating to {count}")
+        segment = item[SEGMENT]
+        segment.extend([""] * (2 - len(segment)))
+        segment[1] = str(count)
+
+    if (control is not None and element_at(elements, 2) != control):
+        position = ENVELOPE_CONTROL[header]
+        ctx.report(index, DIAG_CONTROL_NUMBER, SEVERITY_WARNING,
+                   f"{trailer}02 doesn't match {header}{position:02d}, "
+                   f"updating to {control}")
+        segment = item[SEGMENT]
+        segment.extend([""] * (3 - len(segment)))
+        segment[2] = control
+
+
+# Every segment, the open ST counts them
+@register_handler(OPT_SEG_COUNT)
+def handle_envelope(item, index, ctx):
+    envelope = ctx.envelope
+    stack = envelope.stack
+
+    if (stack and stack[-1][0] == "ST"):
+        stack[-1][2] += 1
+
+    segment_id = item.id
+
+    if (segment_id in ENVELOPE_CONTROL):
+        if (segment_id == "ST" and stack and stack[-1][0] == "ST"):
+            raise EdiError(f"Recieved ST 2x in a row at {stack[-1][3] + 1}"
+                           f" and {index + 1}. Exiting.")
+
+        control = element_at(item.peek_elements(),
+                             ENVELOPE_CONTROL[segment_id])
+        envelope.open(segment_id, control, index)
+
+    elif (segment_id in ENVELOPE_TRAILERS):
+        frame = envelope.close(segment_id)
+
+        if (frame is None):
+            if (segment_id == "SE"):
+                raise EdiError(f"Recieved SE before ST at {index + 1}. "
+                               "Exiting.")
+        else:
+            reconcile_trailer(item, index, ctx, frame)
 
-        elif (opts[OPT_FIX_ERRORS]):
-            opts[OPT_OUT_FILE] = f"{fname_without_ext}-fixed{ext}"
+    return item
 
-    if (not opts[OPT_FIX_ERRORS]
-            and not opts[OPT_ID_LOOPS]
-            and not opts[OPT_FORMAT]):
 
-        print_log("No operation was selected. Exiting.", LOG_WARN)
-        sys.exit(1)
+class ControlNumbers:
+    '''Hands out the control numbers of one `kind` of segment: the ST02 of
+    -gen-uuid, or the ISA13 and GS06 of the envelopes -split writes.
 
-    return opts
+    The nth number of a file is n, so the same input always gets the same
+    numbers (runs over several files share a counter file, see
+    `run_control_file`). With a counter file (-control-file) the numbers
+    are reserved from it CONTROL_BLOCK at a time instead, under a lock, so
+    runs sharing the file (in turn or at the same time) never hand out the
+    same number.
+    Each kind is counted on its own in the file.
+    '''
 
+    def __init__(self, counter_file: None | str = None,
+                 kind: str = "ST") -> None:
+        self.counter_file = counter_file or None
+        self.kind = kind
+        self.count = 0
+        self.current = None
 
-def print_opts(opts: dict):
-    print("The following options have been set:")
-    print(f"\tInput File :: {bc.OKGREEN}{opts[OPT_INPUT_FILE]}{bc.ENDC}")
-    print(f"\tOutput File :: {bc.OKGREEN}{opts[OPT_OUT_FILE]}{bc.ENDC}")
+        # First number of each block reserved from the counter file
+        self.blocks: list[int] = []
 
-    rest_of_opts = [OPT_FORMAT, OPT_ID_LOOPS, OPT_FIX_ERRORS,
-                    OPT_GEN_UUID, OPT_HL_NUM, OPT_HL_LOGIC, OPT_SEG_COUNT,
-                    OPT_LX_NUM]
+    def starting_at(self, count: int) -> "ControlNumbers":
+        '''A copy handing out numbers from the `count`th transaction set on.'''
 
-    for key in rest_of_opts:
-        value = opts[key]
-        off_value = key.endswith("off")
-        if (value and not off_value):
-            print(f"\t{key} :: {bc.OKGREEN}{value}{bc.ENDC}")
-        elif (not value and off_value):
-            print(f"\t{key} :: {bc.OKGREEN}{not value}{bc.ENDC}")
+        numbers = ControlNumbers(self.counter_file, self.kind)
+        numbers.blocks = list(self.blocks)
+        numbers.count = count
+        return numbers
 
-    if opts[OPT_ID_LOOPS] and opts[OPT_FORMAT]:
-        print("You really want me to ID loops AND format the file??")
-        print("Format would remove all the loop comments...")
+    def reserve(self, count: int) -> None:
+        '''Make sure the numbers of the first `count` sets are reserved.'''
 
+        if (self.counter_file is None):
+            return
 
-def fix_errors_module(index, item, opts, additions, deletions):
+        while (len(self.blocks) * CONTROL_BLOCK < count):
+            self.blocks.append(self.reserve_block())
 
-    # Empty line
-    if (len(item[SEGMENT]) == 0):
-        return item
+    def reserve_block(self) -> int:
+        table = CONTROL_TABLES[self.kind]
+        try:
+            db = sqlite3.connect(self.counter_file, timeout=CACHE_TIMEOUT,
+                                 isolation_level=None)
+            try:
+                db.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                           "(next INTEGER)")
+                db.execute("BEGIN IMMEDIATE")
+                row = db.execute(f"SELECT next FROM {table}").fetchone()
+                first = 1 if row is None else row[0]
+
+                if (row is None):
+                    db.execute(f"INSERT INTO {table} VALUES (?)",
+                               (first + CONTROL_BLOCK,))
+                else:
+                    db.execute(f"UPDATE {table} SET next = ?",
+                               (first + CONTROL_BLOCK,))
+                db.execute("COMMIT")
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            raise EdiError(f"Unable to use the control number file "
+                           f"{self.counter_file}: {e}. Exiting.")
+
+        return first
+
+    def peek(self) -> str:
+        '''The number `next` hands out, without taking it.'''
+
+        self.reserve(self.count + 1)
+
+        if (self.counter_file is None):
+            number = self.count + 1
+        else:
+            block, position = divmod(self.count, CONTROL_BLOCK)
+            number = self.blocks[block] + position
 
-    # Comment line
-    if item[SEGMENT][0].startswith("//"):
-        return item
+        number = (number - 1) % CONTROL_MAX + 1
+        return f"{number:0{CONTROL_WIDTHS[self.kind]}d}"
 
-    if (opts[OPT_SEG_COUNT]):
-        item = handle_segment_count(item, index)
+    def next(self) -> str:
+        number = self.peek()
+        self.count += 1
+        return number
 
-    if (opts[OPT_GEN_UUID]):
-        item = handle_segment_uuid(item, index)
 
-    if (opts[OPT_CLM_AMT]):
-        item = handle_claim_sum(item, index)
+@contextlib.contextmanager
+def run_control_file(opts: dict):
+    '''`opts` with one counter file (see `ControlNumbers`) for the run.
 
-    if (opts[OPT_HL_NUM]):
-        item = handle_hl_num(item, index)
+    Without -control-file each file numbers its sets and envelopes from 1,
+    so a run over several files (a batch or -serve) would give every output
+    the same ST02 and ISA13. Those runs share a counter file in a
+    temporary directory instead, which keeps the numbers apart across the
+    files and the worker processes.
+    '''
+    if (opts[OPT_CONTROL_FILE] or not (opts[OPT_GEN_UUID] or is_split(opts))):
+        yield opts
+        return
 
-    if (opts[OPT_HL_LOGIC]):
-        item = handle_hl_logic(item, index)
+    with tempfile.TemporaryDirectory() as directory:
+        yield dict(opts, **{OPT_CONTROL_FILE: os.path.join(
+            directory, CONTROL_FILE)})
 
-    if (opts[OPT_LX_NUM]):
-        item = handle_lx_num(item, index)
+
+@register_handler(OPT_GEN_UUID, ("ST", "SE"))
+def handle_segment_uuid(item, index, ctx):
+    state = ctx.control_numbers
+
+    if (item.id == "ST"):
+        state.current = state.next()
+        elements_with(item, 2, index)[2] = state.current
+
+    if (item.id == "SE"):
+        elements_with(item, 2, index)[2] = state.current
 
     return item
 
 
-class IdLoopsState:
-    loop_line = ""
-    item_ref = {}
+class ClaimAmountCheck:
 
+    def __init__(self) -> None:
+        self.clm_pos = 0
+        self.clm_offset = 0
+        self.clm_total = Decimal(0)
+        self.line_sum = Decimal(0)
+        self.line_count = 0
+        self.active = False
 
-def id_loops_module(index, item: dict, opts, additions, deletions):
 
-    segment: list[str] = item[SEGMENT]
+def parse_amount(value: str, index: int) -> Decimal:
+    '''The monetary amount `value` of the segment at `index`, exactly.'''
 
-    if (len(segment) == 0):
-        return item
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise EdiError(f"Invalid amount '{value}' at {index+1}. Exiting.")
 
-    if segment[0].startswith("//"):
-        return item
 
-    if (segment[0].startswith(f"// {FILE_MARKER}")):
-        IdLoopsState.loop_line = segment[0]
-        IdLoopsState.item_ref = item
-        return item
+def close_claim(state: ClaimAmountCheck, ctx) -> None:
+    '''Compare the total of the open claim with the sum of its lines.'''
 
-    loop = check_loop_start(LOOP_INFO, segment)
+    if (state.line_sum != state.clm_total):
+        ctx.report(state.clm_pos, DIAG_CLAIM_TOTAL, SEVERITY_ERROR,
+                   f"CLM total mismatch. CLM total: {state.clm_total}, "
+                   f"total of its {state.line_count} service lines: "
+                   f"{state.line_sum}",
+                   state.clm_offset)
 
-    if (loop is not None):
-        marker = f"// {FILE_MARKER} Loop: {loop.name} :: {loop.desc}"
+    state.active = False
 
-        # Out-dated marker present
-        if (IdLoopsState.loop_line != "" and IdLoopsState.loop_line != marker):
-            IdLoopsState.item_ref[SEGMENT][0] = marker
 
-        # Marker not present
-        if (IdLoopsState.loop_line == ""):
-            additions.append((index, "\n", marker, "\n"))
+# A claim runs from its CLM up to the next CLM, HL or SE
+@register_handler(OPT_CLM_AMT, ("CLM", "SV1", "SV2", "HL", "SE"))
+def handle_claim_sum(item, index, ctx):
+    state = ctx.claim_amount
+    segment_id = item.id
+
+    if (segment_id == "SV1" or segment_id == "SV2"):
+        if (not state.active):
+            raise EdiError(f"Recieved {segment_id} without CLM at "
+                           f"{index+1}. Exiting.")
+
+        # SV1 (professional) has the charge in 02, SV2 (institutional) in 03
+        position = 2 if segment_id == "SV1" else 3
+        state.line_sum += parse_amount(
+            elements_with(item, position, index)[position], index)
+        state.line_count += 1
+        return item
+
+    if (state.active):
+        close_claim(state, ctx)
+
+    if (segment_id == "CLM"):
+        state.active = True
+        state.clm_pos = index
+        state.clm_offset = ctx.offset
+        state.clm_total = parse_amount(elements_with(item, 2, index)[2],
+                                       index)
+        state.line_sum = Decimal(0)
+        state.line_count = 0
 
     return item
 
 
-def format_module(index, item, opts, additions, deletions):
+def hl_elements(item) -> list[str]:
+    '''The elements of an HL segment, with a missing HL02 or HL04 put in.'''
 
     segment = item[SEGMENT]
 
-    if (len(segment) == 0):
-        # logs.append((index+1, "Removed empty line."))
-        deletions.append(index)
-        return item
+    # HL*1*20*1, a top level without its empty HL02
+    if (len(segment) == 4 and segment[3] in HL_CHILD_CODES):
+        segment.insert(2, "")
 
-    if segment[0].startswith("//"):
-        # logs.append((index+1, "Removed comment line."))
-        deletions.append(index)
-        return item
+    segment.extend([""] * (5 - len(segment)))
+    return segment
 
-    if (item[START] != ""):
-        item[START] = ""
-        logs.append((index+1, "Removed whitespace from start."))
 
-    if (item[END][0] != TERMINATOR):
-        item[END] = TERMINATOR + item[END]
-        logs.append((index+1, "Added missing terminator."))
+class HLNumber:
 
-    if (NEWLINE in item[END] and item[END].index(NEWLINE) != 1):
-        # There isn't a newline right after ~
-        item[END] = TERMINATOR + NEWLINE
-        logs.append((index+1, "Removed character after terminator."))
+    def __init__(self) -> None:
+        self.counter = 1
+
+        # HL01 as read -> as numbered, in the open transaction set
+        self.numbers: dict[str, str] = {}
+
+
+@register_handler(OPT_HL_NUM, ("HL", "SE"))
+def handle_hl_num(item, index, ctx):
+    state = ctx.hl_number
+
+    if (item.id == "SE"):
+        state.counter = 1
+        state.numbers = {}
+
+    if (item.id == "HL"):
+        segment = hl_elements(item)
+        number = str(state.counter)
+        state.counter += 1
+
+        state.numbers[segment[1]] = number
+        segment[1] = number
+
+        # The parent was numbered before its children
+        segment[2] = state.numbers.get(segment[2], segment[2])
 
     return item
 
 
-def main():
-    args = sys.argv
+class HLLevels:
+    '''The open HL levels of a transaction set, for handle_hl_logic.
 
-    if ("-help" in args or "--help" in args or len(args) == 1):
-        print_help()
-        exit(0)
+    `stack` holds [HL01, rank of HL03] for each open level, outermost
+    first. `pending` is [item, index, offset, level] of the last HL, whose
+    HL04 (does it have child levels?) is known once the next HL or the SE
+    is seen. Until then it is held back along with what follows it.
+    '''
 
-    opts = parse_arguments(args)
-    print()
-    print_opts(opts)
+    def __init__(self) -> None:
+        self.stack: list[list] = []
+        self.pending: None | list = None
 
-    if opts[OPT_ID_LOOPS] and opts[OPT_FORMAT]:
-        opts[OPT_ID_LOOPS] = False
 
-    choice = ""
-    while (choice.lower() != "y" and choice.lower() != "n"):
-        print()
-        choice = input("Continue with the above configuration? (Y/N): ")
-        print()
+def close_hl(ctx, children: bool) -> None:
+    '''Set the HL04 of the pending HL and let go of the items held back.'''
 
-    if (choice == "n"):
-        print_log("Aborted.", LOG_ERROR)
-        sys.exit(1)
+    state = ctx.hl_levels
+    pending = state.pending
+    if (pending is None):
+        return
 
-    with open(opts[OPT_INPUT_FILE]) as f:
-        lines = f.readlines()
+    item, index, offset, _ = pending
+    segment = item[SEGMENT]
+    child = "1" if children else "0"
 
-    data = parse_edi_to_array(lines)
+    if (segment[4] != child):
+        ctx.report(index, DIAG_HL_CHILD, SEVERITY_WARNING,
+                   f"HL {segment[1]} 4th element was '{segment[4]}', it has "
+                   f"{'' if children else 'no '}child levels. Updated to "
+                   f"{child}.", offset)
+        segment[4] = child
 
-    # data format: [ {0}, {1}, {2}, {}, ... ]
-    # {n}: START: All the whitespace at the start of segment
-    #      SEGMENT: The actual segment in the form of an array of it's parts
-    #      END: The end string of the segment ("~\n\r")
-    #
-    # Example: data[2][SEGMENT]: ["SE", "102102", "AB201"]
-    # Example: data[0][SEGMENT][0]: "ISA"
-    #               ^     ^     ^
-    #     line number  segment part-of-segment
+    state.pending = None
+    ctx.released.extend(ctx.held)
+    ctx.held = None
 
-    # ------------ Modify `data` to be written -------------------
 
-    # 4-tuple (index, start, segment, end)
-    additions: list[tuple] = []
+@register_handler(OPT_HL_LOGIC, ("HL", "ST", "SE"))
+def handle_hl_logic(item, index, ctx):
+    state = ctx.hl_levels
+    stack = state.stack
 
-    # Indices of the items to be deleted
-    deletions: list[int] = []
+    if (item.id != "HL"):
+        close_hl(ctx, False)
+        stack.clear()
+        return item
 
-    for index, item in enumerate(data):
+    segment = hl_elements(item)
+    hl_id, parent_id = segment[1], segment[2]
+    rank = HL_RANKS.get(segment[3])
+
+    if (rank is not None):
+        # Up to the closest open level it can be under
+        while (stack and (stack[-1][1] is None or stack[-1][1] >= rank)):
+            stack.pop()
+    elif (parent_id == ""):
+        stack.clear()
+    else:
+        # A level of unknown rank goes where its HL02 says, if that is
+        # open, else under the last HL
+        for depth in range(len(stack) - 1, -1, -1):
+            if (stack[depth][0] == parent_id):
+                del stack[depth + 1:]
+                break
+
+    pending = state.pending
+    close_hl(ctx, pending is not None and bool(stack)
+             and stack[-1] is pending[3])
+
+    parent = stack[-1][0] if stack else ""
+    if (parent_id != parent):
+        ctx.report(index, DIAG_HL_PARENT, SEVERITY_WARNING,
+                   f"HL {hl_id} 2nd element was '{parent_id}', its parent "
+                   f"is {f'HL {parent}' if parent else 'none'}. Updated.")
+        segment[2] = parent
+
+    level = [hl_id, rank]
+    stack.append(level)
+
+    # The stream holds back this HL, and what follows, until close_hl
+    state.pending = [item, index, ctx.offset, level]
+    ctx.held = []
+
+    return item
 
-        if (opts[OPT_FIX_ERRORS]):
-            item = fix_errors_module(index, item, opts, additions, deletions)
 
-        if (opts[OPT_ID_LOOPS]):
-            item = id_loops_module(index, item, opts, additions, deletions)
+class LXNumber:
 
-        if (opts[OPT_FORMAT]):
-            item = format_module(index, item, opts, additions, deletions)
+    def __init__(self) -> None:
+        self.counter = 1
 
-    for index in reversed(deletions):
-        data.pop(index)
 
-    offset = len(deletions)
+@register_handler(OPT_LX_NUM, ("CLM", "LX"))
+def handle_lx_num(item, index, ctx):
+    state = ctx.lx_number
 
-    for addition in reversed(additions):
-        data.insert(addition[0] - offset, {
-            START: addition[1],
-            SEGMENT: [addition[2],],
-            END: addition[3]
-        })
+    if (item.id == "CLM"):
+        state.counter = 1
+
+    if (item.id == "LX"):
+        elements_with(item, 1, index)[1] = str(state.counter)
+        state.counter += 1
+
+    return item
+
+
+def split_compression(filename: str) -> tuple[str, str]:
+    '''`filename` without its compression extension, and that extension.'''
+    for ext in COMPRESSED_EXTS:
+        if (filename.endswith(ext)):
+            return filename[:-len(ext)], ext
+    return filename, ""
+
+
+def split_part_base(filename: str) -> str:
+    '''The file a -split part `filename` is named after, see
+    `split_part_name`. `filename` itself if it isn't a part.'''
+
+    # x-part0001.edi.gz -> x.edi.gz
+    name, compression = split_compression(filename)
+    stem, ext = os.path.splitext(name)
+    base, suffix, number = stem.rpartition(SPLIT_SUFFIX)
+    if (suffix == "" or not number.isdigit()):
+        return filename
+    return f"{base}{ext}{compression}"
+
+
+def run_outputs(input_files: list[str], output_for,
+                split: bool) -> set[str]:
+    '''Those of `input_files` that this run writes itself.
+
+    `output_for(input_file)` is the output of each input, the parts named
+    after it if `split`. Leaving these out keeps a run on a directory (x.edi
+    next to the x-fixed.edi of the last run) from taking in its own
+    outputs, while files that only look like outputs are processed as any
+    other.
+    '''
+    outputs = set()
+    for input_file in input_files:
+        output = output_for(input_file)
+        if (output and (split or output != input_file)):
+            outputs.add(os.path.realpath(output))
+
+    written = set()
+    for input_file in input_files:
+        if (split):
+            base = split_part_base(input_file)
+            if (base != input_file and os.path.realpath(base) in outputs):
+                written.add(input_file)
+        elif (os.path.realpath(input_file) in outputs):
+            written.add(input_file)
 
-    # ------------------------------------------------------------
+    return written
+
+
+def split_part_name(output_file: str, number: int) -> str:
+    '''Name of the `number`th file -split writes for `output_file`.'''
+
+    # x.edi.gz -> x-part0001.edi.gz
+    name, compression = split_compression(output_file)
+    stem, ext = os.path.splitext(name)
+    return f"{stem}{SPLIT_SUFFIX}{number:0{SPLIT_DIGITS}d}{ext}{compression}"
+
+
+def is_split(opts: dict) -> bool:
+    return bool(opts.get(OPT_SPLIT) or opts.get(OPT_SPLIT_SIZE))
+
+
+def expand_input_path(path: str) -> list[str]:
+    '''The input files named by `path`: a file, a directory or a glob.
+
+    Directories give every file directly inside them, except hidden files
+    and the indexes -index writes. See `drop_run_outputs` for leaving out
+    the outputs of the run itself.
+    '''
+    if (os.path.isfile(path)):
+        return [path]
+
+    if (os.path.isdir(path)):
+        return sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if not name.startswith(".") and not name.endswith(INDEX_EXT)
+            and os.path.isfile(os.path.join(path, name)))
+
+    if (glob.has_magic(path)):
+        return sorted(name for name in glob.glob(path)
+                      if os.path.isfile(name)
+                      and not name.endswith(INDEX_EXT))
+
+    return []
+
+
+def opts_for_file(opts: dict, input_file: str) -> dict:
+    '''Copy of `opts` with the input and output set for `input_file`.'''
+    opts = dict(opts)
+    opts[OPT_INPUT_FILE] = input_file
+
+    # x.edi.gz -> x-fixed.edi.gz
+    name, compression = split_compression(input_file)
+    fname_without_ext, ext = os.path.splitext(name)
+    ext += compression
+
+    if (opts[OPT_INPLACE]):
+        opts[OPT_OUT_FILE] = input_file
+
+    if (opts.get(OPT_INDEX)):
+        opts[OPT_OUT_FILE] = index_file_for(input_file)
+
+    if (opts[OPT_OUT_FILE] == ""):
+        if (is_split(opts)):
+            # The parts are named after it, see split_part_name
+            opts[OPT_OUT_FILE] = input_file
+
+        elif (opts.get(OPT_EXTRACT)):
+            opts[OPT_OUT_FILE] = f"{fname_without_ext}-extract{ext}"
+
+        elif (opts[OPT_FORMAT]):
+            opts[OPT_OUT_FILE] = f"{fname_without_ext}-formatted{ext}"
+
+        elif (opts[OPT_ID_LOOPS]):
+            opts[OPT_OUT_FILE] = f"{fname_without_ext}-withloops{ext}"
+
+        elif (opts[OPT_FIX_ERRORS]):
+            opts[OPT_OUT_FILE] = f"{fname_without_ext}-fixed{ext}"
+
+    return opts
+
+
+def parse_arguments(args: list[str]):
+    opts = {
+        OPT_ID_LOOPS: False,
+        OPT_FIX_ERRORS: False,
+        OPT_FORMAT: False,
+        OPT_INPLACE: False,
+        OPT_OUT_FILE: "",
+        OPT_GEN_UUID: False,
+        OPT_HL_NUM: False,
+        OPT_CLM_AMT: False,
+        OPT_LX_NUM: False,
+        OPT_JOBS: 1,
+        OPT_YES: False,
+        OPT_STATS: False,
+        OPT_STATS_JSON: "",
+        OPT_PROFILE: "",
+        OPT_DIAGNOSTICS: "",
+        OPT_LOG_LIMIT: LOG_LIMIT,
+        OPT_CACHE: False,
+        OPT_NO_CACHE: False,
+        OPT_CACHE_DIR: "",
+        OPT_CACHE_SIZE: CACHE_SIZE,
+        OPT_SERVE: False,
+        OPT_POLL: POLL_INTERVAL,
+        OPT_INDEX: False,
+        OPT_EXTRACT: "",
+        OPT_CONTROL_FILE: "",
+        OPT_SPLIT: 0,
+        OPT_SPLIT_SIZE: 0,
+        OPT_MERGE: False,
+
+        # Note that the string may have contridictor name
+        # This being true imples we perform HL logic.
+        OPT_HL_LOGIC: True,
+        OPT_SEG_COUNT: True,
+
+        OPT_INPUT_FILE: "",
+        OPT_INPUT_FILES: [],
+        OPT_WATCH_DIRS: []
+    }
+
+    recieved_flags = []
+
+    for key in opts:
+        if key in args and key not in recieved_flags:
+            recieved_flags.append(key)
+
+            if key in VALUE_OPTS:
+                index = args.index(key)
+                value = args[index+1] if index+1 < len(args) else ""
+
+                if (value == "" or value in opts):
+                    print_log(
+                        f"ERROR: Please provide {VALUE_OPTS[key]} "
+                        f"with {key}.",
+                        LOG_ERROR
+                    )
+                    sys.exit(1)
+
+                opts[key] = value
+                args.pop(index+1)
+                args.pop(index)
+
+            elif key in INT_OPTS:
+                index = args.index(key)
+                value = args[index+1] if index+1 < len(args) else ""
+                what, smallest = INT_OPTS[key]
+
+                if (not value.isdigit() or int(value) < smallest):
+                    print_log(
+                        f"ERROR: Please provide {what} with {key}.",
+                        LOG_ERROR
+                    )
+                    sys.exit(1)
+
+                opts[key] = int(value)
+                args.pop(index+1)
+                args.pop(index)
+
+            else:
+                args.remove(key)
+                opts[key] = not opts[key]
+
+        elif key in recieved_flags:
+            print_log(f"Recieved {key} twice. Ignoring.", LOG_WARN)
+            continue
+
+    if (OPT_INPLACE in recieved_flags and OPT_OUT_FILE in recieved_flags):
+        print_log("Recieved both -i and -o. Not valid arguments. Exiting.",
+                  LOG_ERROR)
+
+    if len(args) < 2:
+        print_log("Improper number of arguments.", LOG_ERROR)
+        sys.exit(1)
+
+    if (opts[OPT_INDEX] and (opts[OPT_EXTRACT] or opts[OPT_FORMAT]
+                             or opts[OPT_ID_LOOPS] or opts[OPT_FIX_ERRORS])):
+        print_log(f"{OPT_INDEX} only builds the index, run the other "
+                  "operations without it. Exiting.", LOG_ERROR)
+        sys.exit(1)
+
+    if ((opts[OPT_INDEX] or opts[OPT_EXTRACT])
+            and (opts[OPT_INPLACE] or opts[OPT_INDEX] and opts[OPT_OUT_FILE])):
+        print_log(f"{OPT_INDEX} and {OPT_EXTRACT} write files of their own, "
+                  f"{OPT_INPLACE} (or {OPT_OUT_FILE} with {OPT_INDEX}) can't "
+                  "be used. Exiting.", LOG_ERROR)
+        sys.exit(1)
+
+    if (opts[OPT_CONTROL_FILE] and not opts[OPT_GEN_UUID]
+            and not is_split(opts) and not opts[OPT_MERGE]):
+        print_log(f"{OPT_CONTROL_FILE} only applies to {OPT_GEN_UUID}, "
+                  f"{OPT_SPLIT} and {OPT_MERGE}. Exiting.", LOG_ERROR)
+        sys.exit(1)
+
+    if ((is_split(opts) or opts[OPT_MERGE])
+            and (opts[OPT_INPLACE] or opts[OPT_INDEX] or opts[OPT_EXTRACT]
+                 or opts[OPT_SERVE] or is_split(opts) and opts[OPT_MERGE])):
+        print_log(f"{OPT_SPLIT} and {OPT_MERGE} write files of their own, "
+                  f"they can't be used together or with {OPT_INPLACE}, "
+                  f"{OPT_INDEX}, {OPT_EXTRACT} or {OPT_SERVE}. Exiting.",
+                  LOG_ERROR)
+        sys.exit(1)
+
+    if (opts[OPT_MERGE] and not opts[OPT_OUT_FILE]):
+        print_log(f"{OPT_MERGE} needs the file to merge into, given with "
+                  f"{OPT_OUT_FILE}. Exiting.", LOG_ERROR)
+        sys.exit(1)
+
+    if (opts[OPT_SERVE]):
+        return parse_serve_arguments(opts, args)
+
+    input_files = []
+    for arg in args[1:]:
+        found = expand_input_path(arg)
+        if (not found):
+            print_log(f"Unable to find file {arg}. Exiting", LOG_ERROR)
+            sys.exit(1)
+
+        for input_file in found:
+            if (input_file not in input_files):
+                input_files.append(input_file)
+
+    if (opts[OPT_MERGE]):
+        written = run_outputs(input_files,
+                              lambda input_file: opts[OPT_OUT_FILE], False)
+    else:
+        written = run_outputs(
+            input_files,
+            lambda input_file: opts_for_file(opts, input_file)[OPT_OUT_FILE],
+            is_split(opts))
+
+    for input_file in input_files:
+        if (input_file in written):
+            print_log(f"Skipping {input_file}, this run writes it.",
+                      LOG_WARN)
+    input_files = [input_file for input_file in input_files
+                   if input_file not in written]
+
+    if (not input_files):
+        print_log("Every input is written by this run, nothing is left to "
+                  "process. Exiting.", LOG_ERROR)
+        sys.exit(1)
+
+    if (len(input_files) > 1 and opts[OPT_OUT_FILE] != ""
+            and not opts[OPT_MERGE]):
+        print_log(f"{OPT_OUT_FILE} can only be used with a single input "
+                  "file. Exiting.", LOG_ERROR)
+        sys.exit(1)
+
+    opts[OPT_INPUT_FILES] = input_files
+
+    if (len(input_files) == 1):
+        opts = opts_for_file(opts, input_files[0])
+
+    check_operation(opts)
+    return opts
+
+
+def parse_serve_arguments(opts: dict, args: list[str]) -> dict:
+    '''The rest of `parse_arguments` for -serve: the arguments left in
+    `args` are the directories to watch and -o, if given, is a directory.
+    '''
+    for arg in args[1:]:
+        if (not os.path.isdir(arg)):
+            print_log(f"{OPT_SERVE} watches directories, {arg} isn't one. "
+                      "Exiting.", LOG_ERROR)
+            sys.exit(1)
+
+    if (opts[OPT_INPLACE]):
+        print_log(f"{OPT_INPLACE} can't be used with {OPT_SERVE}, the files "
+                  "would be seen as new again. Exiting.", LOG_ERROR)
+        sys.exit(1)
+
+    if (opts[OPT_OUT_FILE] and not os.path.isdir(opts[OPT_OUT_FILE])):
+        print_log(f"With {OPT_SERVE}, {OPT_OUT_FILE} is the directory to "
+                  "write the outputs to. Exiting.", LOG_ERROR)
+        sys.exit(1)
+
+    opts[OPT_WATCH_DIRS] = list(dict.fromkeys(args[1:]))
+
+    check_operation(opts)
+    return opts
+
+
+def check_operation(opts: dict) -> None:
+    if (not opts[OPT_FIX_ERRORS]
+            and not opts.get(OPT_ID_LOOPS)
+            and not opts[OPT_FORMAT]
+            and not opts[OPT_INDEX]
+            and not opts[OPT_EXTRACT]
+            and not is_split(opts)
+            and not opts[OPT_MERGE]):
+
+        print_log("No operation was selected. Exiting.", LOG_WARN)
+        sys.exit(1)
+
+
+def print_opts(opts: dict):
+    print("The following options have been set:")
+
+    if (opts[OPT_SERVE]):
+        for directory in opts[OPT_WATCH_DIRS]:
+            print(f"\tWatching :: {bc.OKGREEN}{directory}{bc.ENDC}")
+        if (opts[OPT_OUT_FILE]):
+            print(f"\tOutput Directory :: "
+                  f"{bc.OKGREEN}{opts[OPT_OUT_FILE]}{bc.ENDC}")
+
+    elif (len(opts[OPT_INPUT_FILES]) == 1):
+        print(f"\tInput File :: {bc.OKGREEN}{opts[OPT_INPUT_FILE]}{bc.ENDC}")
+        if (is_split(opts)):
+            first = split_part_name(opts[OPT_OUT_FILE], 1)
+            print(f"\tOutput Files :: {bc.OKGREEN}{first}, ...{bc.ENDC}")
+        else:
+            print(f"\tOutput File :: {bc.OKGREEN}{opts[OPT_OUT_FILE]}"
+                  f"{bc.ENDC}")
+    else:
+        count = len(opts[OPT_INPUT_FILES])
+        print(f"\tInput Files :: {bc.OKGREEN}{count} files{bc.ENDC}")
+        if (opts[OPT_MERGE]):
+            print(f"\tOutput File :: {bc.OKGREEN}{opts[OPT_OUT_FILE]}"
+                  f"{bc.ENDC}")
+
+    rest_of_opts = [OPT_INDEX, OPT_EXTRACT, OPT_SPLIT, OPT_SPLIT_SIZE,
+                    OPT_MERGE, OPT_FORMAT, OPT_ID_LOOPS, OPT_FIX_ERRORS,
+                    OPT_GEN_UUID, OPT_HL_NUM, OPT_HL_LOGIC, OPT_SEG_COUNT,
+                    OPT_LX_NUM]
+
+    for key in rest_of_opts:
+        value = opts[key]
+        off_value = key.endswith("off")
+        if (value and not off_value):
+            print(f"\t{key} :: {bc.OKGREEN}{value}{bc.ENDC}")
+        elif (not value and off_value):
+            print(f"\t{key} :: {bc.OKGREEN}{not value}{bc.ENDC}")
+
+    if opts[OPT_JOBS] > 1:
+        print(f"\t{OPT_JOBS} :: {bc.OKGREEN}{opts[OPT_JOBS]}{bc.ENDC}")
+
+    for key in [OPT_CONTROL_FILE, OPT_DIAGNOSTICS, OPT_STATS, OPT_STATS_JSON,
+                OPT_PROFILE, OPT_CACHE, OPT_NO_CACHE, OPT_CACHE_DIR]:
+        if (opts[key]):
+            print(f"\t{key} :: {bc.OKGREEN}{opts[key]}{bc.ENDC}")
+
+    for key, default in [(OPT_LOG_LIMIT, LOG_LIMIT),
+                         (OPT_CACHE_SIZE, CACHE_SIZE),
+                         (OPT_POLL, POLL_INTERVAL)]:
+        if opts[key] != default:
+            print(f"\t{key} :: {bc.OKGREEN}{opts[key]}{bc.ENDC}")
+
+    if opts[OPT_ID_LOOPS] and opts[OPT_FORMAT]:
+        print("You really want me to ID loops AND format the file??")
+        print("Format would remove all the loop comments...")
+
+
+def fix_errors_module(index, item, ctx, additions, deletions):
+    # Empty line
+    if (item.is_empty):
+        return item
+
+    # Comment line
+    if item.is_comment():
+        return item
+
+    for handler in ctx.fix_handlers.get(item.id, ctx.fix_any_handlers):
+        item = handler(item, index, ctx)
+
+    return item
+
+
+class IdLoopsState:
+
+    def __init__(self) -> None:
+        self.loop_line = ""
+        self.item_ref = None
+        self.tracker = LoopTracker()
+
+
+def id_loops_module(index, item: Segment, ctx, additions, deletions):
+    state = ctx.id_loops
+
+    if (item.is_empty):
+        return item
+
+    if item.is_comment():
+        return item
+
+    if (item.id.startswith(f"// {FILE_MARKER}")):
+        state.loop_line = item.id
+        state.item_ref = item
+        return item
+
+    loop = state.tracker.feed(item.peek_elements())
+
+    if (loop is not None):
+        marker = f"// {FILE_MARKER} Loop: {loop.name} :: {loop.desc}"
+
+        # Out-dated marker present
+        if (state.loop_line != "" and state.loop_line != marker):
+            state.item_ref[SEGMENT][0] = marker
+
+        # Marker not present
+        if (state.loop_line == ""):
+            additions.append((index, "\n", marker, "\n"))
+
+    return item
+
+
+def format_module(index, item, ctx, additions, deletions):
+
+    if (item.is_empty):
+        # ctx.report(index, ..., "Removed empty line.")
+        deletions.append(index)
+        return item
+
+    if item.is_comment():
+        # ctx.report(index, ..., "Removed comment line.")
+        deletions.append(index)
+        return item
+
+    if (item.start != ""):
+        item.start = ""
+        ctx.report(index, DIAG_LEADING_WHITESPACE, SEVERITY_INFO,
+                   "Removed whitespace from start.")
+
+    terminator = item.delims.terminator
+    end = item.end
+
+    if (not end.startswith(terminator)):
+        end = item.end = terminator + end
+        ctx.report(index, DIAG_MISSING_TERMINATOR, SEVERITY_INFO,
+                   "Added missing terminator.")
+
+    if (terminator != NEWLINE and NEWLINE in end
+            and end.index(NEWLINE) != len(terminator)):
+        # There isn't a newline right after ~
+        item.end = terminator + NEWLINE
+        ctx.report(index, DIAG_AFTER_TERMINATOR, SEVERITY_INFO,
+                   "Removed character after terminator.")
+
+    return item
+
+
+# (module, option) in the order they run on each segment
+MODULES = [
+    (fix_errors_module, OPT_FIX_ERRORS),
+    (id_loops_module, OPT_ID_LOOPS),
+    (format_module, OPT_FORMAT),
+]
+
+
+# Stages of a run timed by -stats
+STAGE_READ = "read"
+STAGE_PARSE = "parse"
+STAGE_LOOP_MATCH = "loop match"
+STAGE_EDITS = "edits"
+STAGE_CACHE = "cache"
+STAGE_SERIALIZE = "serialize"
+STAGE_WRITE = "write"
+
+
+def peak_memory() -> None | int:
+    '''Peak resident memory of this process and its children, in bytes.'''
+
+    if (resource is None):
+        return None
+
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # Kilobytes everywhere but macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RunStats():
+    '''Calls and wall time of each stage of a run, for -stats.
+
+    Stages are timed by wrapping the functions that do them (see `timed`),
+    which is only done when -stats is given, so a run without it runs the
+    exact same code as before. Modules include the time of their handlers,
+    which are listed under them.
+    '''
+
+    def __init__(self) -> None:
+        # name -> [calls, seconds, depth], in the order they are listed
+        self.stages: dict[str, list] = {}
+        self.start = time.perf_counter()
+        self.seconds = 0.0
+        self.peak_memory = None
+
+        # Set when segments are counted without being parsed (-format)
+        self.segment_count = None
+
+    def stage(self, name: str, depth: int = 0) -> list:
+        return self.stages.setdefault(name, [0, 0.0, depth])
+
+    def timed(self, func, name: str, depth: int = 0):
+        '''Wrap `func` so its calls are added to stage `name`.'''
+
+        entry = self.stage(name, depth)
+        perf_counter = time.perf_counter
+
+        def timed_func(*args):
+            start = perf_counter()
+            result = func(*args)
+            entry[0] += 1
+            entry[1] += perf_counter() - start
+            return result
+
+        return timed_func
+
+    def timed_iter(self, iterable, name: str):
+        '''Yield from `iterable`, adding the time to get each to `name`.'''
+
+        entry = self.stage(name)
+        perf_counter = time.perf_counter
+        iterator = iter(iterable)
+
+        while (True):
+            start = perf_counter()
+            try:
+                value = next(iterator)
+            except StopIteration:
+                entry[1] += perf_counter() - start
+                return
+
+            entry[0] += 1
+            entry[1] += perf_counter() - start
+            yield value
+
+    def merge(self, stages: dict) -> None:
+        '''Add the stages of another run (a worker or another file).'''
+
+        for name, (calls, seconds, depth) in stages.items():
+            entry = self.stage(name, depth)
+            entry[0] += calls
+            entry[1] += seconds
+
+    def finish(self) -> None:
+        self.seconds = time.perf_counter() - self.start
+        self.peak_memory = peak_memory()
+
+    @property
+    def segments(self) -> int:
+        if (self.segment_count is not None):
+            return self.segment_count
+        return self.stages.get(STAGE_PARSE, [0])[0]
+
+    def to_dict(self) -> dict:
+        return {
+            "segments": self.segments,
+            "seconds": self.seconds,
+            "segments_per_second": self.segments / self.seconds
+            if self.seconds else None,
+            "peak_memory": self.peak_memory,
+            "stages": [
+                {"name": name, "calls": calls, "seconds": seconds,
+                 "per_second": calls / seconds if seconds else None,
+                 "parent": depth > 0}
+                for name, (calls, seconds, depth) in self.stages.items()
+            ],
+        }
+
+    def print_table(self) -> None:
+        print(f"\n{'Stage':<28}{'Calls':>12}{'Time (s)':>12}"
+              f"{'% of run':>10}{'Per second':>14}")
+
+        for name, (calls, seconds, depth) in self.stages.items():
+            share = seconds / self.seconds * 100 if self.seconds else 0
+            rate = f"{calls / seconds:14.0f}" if seconds else f"{'-':>14}"
+            print(f"{'  ' * depth + name:<28}{calls:>12}{seconds:>12.3f}"
+                  f"{share:>9.1f}%{rate}")
+
+        rate = self.segments / self.seconds if self.seconds else 0
+        print(f"\n{self.segments} segments in {self.seconds:.3f}s "
+              f"({rate:.0f} segments/s)")
+
+        if (self.peak_memory is not None):
+            print(f"Peak memory: {self.peak_memory / 1e6:.1f} MB")
+
+
+def stats_enabled(opts: dict) -> bool:
+    return bool(opts.get(OPT_STATS) or opts.get(OPT_STATS_JSON))
+
+
+def print_stats(stats: RunStats, opts: dict) -> None:
+    '''Print `stats` and/or write them as JSON, as `opts` ask.'''
+
+    if (opts[OPT_STATS]):
+        stats.print_table()
+
+    if (opts[OPT_STATS_JSON]):
+        with open(opts[OPT_STATS_JSON], 'w') as f:
+            json.dump(stats.to_dict(), f, indent=2)
+        print_log(f"Stats written to {opts[OPT_STATS_JSON]}", LOG_INFO)
+
+
+class Diagnostics():
+    '''What a run found, in the order it was found.
+
+    Every record is written to `stream` as a line of JSON when there is one
+    and counted by its code, but only the first `keep` are held on to (for
+    the terminal), so a badly broken file doesn't fill the memory.
+    '''
+
+    def __init__(self, keep: int = LOG_LIMIT, stream=None) -> None:
+        self.keep = keep
+        self.stream = stream
+        self.records: list[dict] = []
+        self.counts: dict[str, int] = {}
+        self.total = 0
+
+    def add(self, record: dict) -> None:
+        self.total += 1
+        code = record["code"]
+        self.counts[code] = self.counts.get(code, 0) + 1
+
+        if (len(self.records) < self.keep):
+            self.records.append(record)
+
+        if (self.stream is not None):
+            self.stream.write(json.dumps(record) + NEWLINE)
+
+    def print_records(self) -> None:
+        '''Print the records held, then how many of each code there were.'''
+
+        max_comment = 0
+        for record in self.records:
+            if (len(record["message"])) > max_comment:
+                max_comment = len(record["message"])
+
+        max_comment += 2
+
+        for record in self.records:
+            message = record["message"]
+            print(f"{message}: {'.' * (max_comment - len(message))}"
+                  f"{bc.WARNING}{record['index'] + 1}{bc.ENDC}")
+
+        if (self.total > len(self.records)):
+            print(f"\n{self.total - len(self.records)} more not shown "
+                  f"({OPT_LOG_LIMIT} / {OPT_DIAGNOSTICS}). By code:")
+
+            for code, count in sorted(self.counts.items()):
+                print(f"\t{code} :: {bc.WARNING}{count}{bc.ENDC}")
+
+
+class EdiContext():
+    '''Everything one run over an EDI stream keeps track of.
+
+    A new context is made for every run and handed to the modules, nothing
+    is kept at module level, so runs in different threads (or one after the
+    other in the same process) can't see each other's state.
+    '''
+
+    def __init__(self, opts: dict) -> None:
+        self.opts = opts
+
+        # Where the current segment is, for the diagnostics
+        self.offset = 0
+        self.control_number = None
+
+        self.diagnostics = Diagnostics(opts.get(OPT_LOG_LIMIT, LOG_LIMIT))
+
+        self.envelope = Envelope()
+        self.control_numbers = ControlNumbers(opts.get(OPT_CONTROL_FILE))
+        self.claim_amount = ClaimAmountCheck()
+        self.hl_number = HLNumber()
+        self.hl_levels = HLLevels()
+        self.lx_number = LXNumber()
+        self.id_loops = IdLoopsState()
+        self.handler_state = {}
+
+        self.fix_handlers, self.fix_any_handlers = build_dispatch(opts)
+
+        # Items a handler holds back (None when it isn't), and those it let
+        # go of, see `process_edi_stream`
+        self.held: None | list = None
+        self.released: list = []
+
+        # Set by process_edi_file when the run used one
+        self.cache = None
+
+        # Files written by -split
+        self.parts: None | list[str] = None
+
+        self.stats = RunStats() if stats_enabled(opts) else None
+        if (self.stats is not None):
+            self.time_stages()
+
+    def report(self, index: int, code: str, severity: str, message: str,
+               offset: None | int = None) -> None:
+        '''Add a diagnostic about the segment at `index`.
+
+        `offset` is its position in the input in bytes, by default that of
+        the segment being processed.
+        '''
+        self.diagnostics.add({
+            "code": code,
+            "severity": severity,
+            "index": index,
+            "offset": self.offset if offset is None else offset,
+            "control_number": self.control_number,
+            "message": message,
+            "file": self.opts.get(OPT_INPUT_FILE) or None,
+        })
+
+    def time_stages(self) -> None:
+        '''Set up the timing of every stage of the run, in listing order.'''
+
+        stats = self.stats
+        stats.stage(STAGE_READ)
+        stats.stage(STAGE_PARSE)
+
+        for module, option in MODULES:
+            if (not self.opts[option]):
+                continue
+
+            stats.stage(option)
+
+            if (module is fix_errors_module):
+                self.time_handlers()
+
+            elif (module is id_loops_module):
+                tracker = self.id_loops.tracker
+                tracker.feed = stats.timed(tracker.feed, STAGE_LOOP_MATCH, 1)
+
+        stats.stage(STAGE_EDITS)
+        if (cache_enabled(self.opts)):
+            stats.stage(STAGE_CACHE)
+        stats.stage(STAGE_SERIALIZE)
+        stats.stage(STAGE_WRITE)
+
+    def time_handlers(self) -> None:
+        '''Swap the handlers in the dispatch table for timed ones.'''
+
+        enabled = set(self.fix_any_handlers)
+        for handlers in self.fix_handlers.values():
+            enabled.update(handlers)
+
+        timed = {handler: self.stats.timed(handler, handler.__name__, 1)
+                 for _, _, handler in FIX_HANDLERS if handler in enabled}
+
+        self.fix_handlers = {
+            segment_id: tuple(timed[handler] for handler in handlers)
+            for segment_id, handlers in self.fix_handlers.items()
+        }
+        self.fix_any_handlers = tuple(timed[handler] for handler
+                                      in self.fix_any_handlers)
+
+
+def process_edi_stream(data, ctx: EdiContext):
+    '''Run the selected modules over `data`, yielding the items to write.
+
+    `data` is any iterable of items (see `parse_edi_stream`), it is consumed
+    one item at a time so memory use does not grow with the file size.
+    '''
+
+    # data format: ( {0}, {1}, {2}, {}, ... ), each a `Segment`
+    # {n}: START: All the whitespace at the start of segment
+    #      SEGMENT: The actual segment in the form of an array of it's parts
+    #      END: The end string of the segment ("~\n\r")
+    #
+    # Example: item[SEGMENT]: ["SE", "102102", "AB201"]
+    # Example: item[SEGMENT][0]: "ISA"
+
+    # 4-tuple (index, start, segment, end), inserted before `index`
+    additions: list[tuple] = []
+
+    # Indices of the items to be deleted
+    deletions: list[int] = []
+
+    modules = [module for module, option in MODULES if ctx.opts[option]]
+    add, delete = take_additions, take_deletion
+
+    if (ctx.stats is not None):
+        modules = [ctx.stats.timed(module, option)
+                   for module, option in MODULES if ctx.opts[option]]
+        add = ctx.stats.timed(take_additions, STAGE_EDITS)
+        delete = ctx.stats.timed(take_deletion, STAGE_EDITS)
+
+    item = None
+    offset = 0
+
+    for index, item in enumerate(data):
+
+        # Keep track of where we are for the diagnostics
+        ctx.offset = offset
+        offset += item.size
+
+        if (item.id_startswith("ST") and item.id == "ST"):
+            elements = item.elements
+            ctx.control_number = elements[2] if len(elements) > 2 else None
+
+        for module in modules:
+            item = module(index, item, ctx, additions, deletions)
+
+        # What a handler held back and let go of while on this item
+        if (ctx.released):
+            yield from ctx.released
+            ctx.released = []
+
+        # Edits are merged in as the stream goes: every addition up to
+        # this index goes before the item, then the item is dropped if
+        # it was deleted. Edits for later indices wait for their turn.
+        held = ctx.held
+        if (held is None):
+            if (additions):
+                yield from add(additions, index, item.delims)
+
+            if (deletions and delete(deletions, index)):
+                continue
+
+            yield item
+        else:
+            if (additions):
+                held.extend(add(additions, index, item.delims))
+
+            if (deletions and delete(deletions, index)):
+                continue
+
+            held.append(item)
+
+    # The size of the input in bytes
+    ctx.offset = offset
+
+    if (ctx.held):
+        yield from ctx.held
+        ctx.held = None
+
+    # Additions past the last item go at the end
+    if (additions):
+        delims = DEFAULT_DELIMS if item is None else item.delims
+        yield from take_additions(additions, sys.maxsize, delims)
+
+
+def take_additions(additions: list[tuple], index: int,
+                   delims: Delimiters) -> list[Segment]:
+    '''Remove the additions up to `index` and return their items.'''
+
+    # Stable, additions for the same index keep the order they were made in
+    additions.sort(key=lambda addition: addition[0])
+
+    items = []
+    for addition in additions:
+        if (addition[0] > index):
+            break
+
+        items.append(Segment.from_parts(addition[1], [addition[2],],
+                                        addition[3], delims))
+
+    del additions[:len(items)]
+    return items
+
+
+def take_deletion(deletions: list[int], index: int) -> bool:
+    '''Remove the deletions up to `index`, True if `index` is deleted.'''
+
+    deleted = index in deletions
+    deletions[:] = [i for i in deletions if i > index]
+    return deleted
+
+
+def edi_stream_items(segments, ctx: EdiContext):
+    '''Parse and process (segment, delims) pairs into the items to write.'''
+
+    stats = ctx.stats
+    if (stats is None):
+        return process_edi_stream(parse_edi_stream(segments), ctx)
+
+    segments = stats.timed_iter(segments, STAGE_READ)
+    parse = stats.timed(parse_edi_line, STAGE_PARSE)
+
+    return process_edi_stream(
+        (parse(line, delims) for line, delims in segments), ctx)
+
+
+def edi_stream_lines(segments, ctx: EdiContext):
+    '''Parse, process and write back (segment, delims) pairs as text.'''
+
+    items = edi_stream_items(segments, ctx)
+    if (ctx.stats is None):
+        return (edi_item_to_line(item) for item in items)
+
+    to_line = ctx.stats.timed(edi_item_to_line, STAGE_SERIALIZE)
+    return (to_line(item) for item in items)
+
+
+def edi_mapped_items(buffer, ctx: EdiContext):
+    '''Parse and process the segments of a mapped input `buffer`.'''
+
+    segments = split_edi_mapped(buffer)
+    parse = MappedSegment
+
+    if (ctx.stats is not None):
+        segments = ctx.stats.timed_iter(segments, STAGE_READ)
+        parse = ctx.stats.timed(MappedSegment, STAGE_PARSE)
+
+    return process_edi_stream(
+        (parse(buffer, *positions) for positions in segments), ctx)
+
+
+def find_delimiters(text: str, delims: Delimiters) -> Delimiters:
+    '''The separators in effect at the end of `text`.
+
+    `delims` is what was in effect at its start.
+    '''
+    pos = len(text)
+    while (True):
+        pos = text.rfind(ISA_ID, 0, pos)
+        if (pos == -1):
+            return delims
+
+        isa_delims = read_isa_delimiters(text[pos:pos + ISA_LENGTH])
+        if (isa_delims is not None):
+            return isa_delims
+
+
+def follows_transaction(text: str, pos: int, delims: Delimiters) -> bool:
+    '''Whether the ST at `pos` directly follows a terminated SE segment.'''
+
+    terminator = delims.terminator
+
+    # Only whitespace may sit between the terminator and the ST
+    before_end = pos
+    while (before_end > 0 and text[before_end - 1] in WHITESPACE):
+        before_end -= 1
+
+    if (terminator not in WHITESPACE):
+        if (not text.endswith(terminator, 0, before_end)):
+            return False
+        before_end -= len(terminator)
+
+    previous = text.rfind(terminator, 0, before_end)
+    previous_segment = text[previous + 1:before_end].lstrip(WHITESPACE)
+    return previous_segment.startswith("SE" + delims.element)
+
+
+def find_transaction_cut(text: str, delims: Delimiters) -> int:
+    '''Find the last point in `text` between two ST-SE transaction sets.
+
+    That is the start of the last ST segment that directly follows a
+    terminated SE segment. Returns -1 if there is no such point.
+    '''
+    pos = len(text)
+
+    while (True):
+        pos = text.rfind("ST" + delims.element, 0, pos)
+        if (pos == -1):
+            return -1
+
+        if (follows_transaction(text, pos, delims)):
+            return pos
+
+
+def split_transaction_batches(f, batch_size: int = BATCH_SIZE):
+    '''Cut the text read from `f` into batches of whole transaction sets.
+
+    Only the raw text is searched for the cut points, the segments are
+    split by whoever processes the batch. Yields (text, delims) where
+    `delims` are the separators in effect at the start of `text`.
+    '''
+    delims = DEFAULT_DELIMS
+    buf = ""
+
+    while (True):
+        chunk = f.read(max(batch_size, len(buf)))
+        if (not chunk):
+            if (buf):
+                yield buf, delims
+            return
+
+        buf += chunk
+        batch_delims = find_delimiters(buf, delims)
+        cut = find_transaction_cut(buf, batch_delims)
+
+        if (cut <= 0):
+            # A single transaction set bigger than the batch, keep reading
+            continue
+
+        batch = buf[:cut]
+        yield batch, delims
+
+        delims = find_delimiters(batch, delims)
+        buf = buf[cut:]
+
+
+def split_transaction_sets(text: str, delims: Delimiters):
+    '''Cut a batch from `split_transaction_batches` into transaction sets.
+
+    The cuts are the points `find_transaction_cut` looks for, anything
+    before the first ST or after the last SE (ISA, GS, GE, IEA) stays with
+    the transaction set next to it. Yields (text, delims) the same way.
+    '''
+
+    # Where the separators change, with the ones in effect from there on
+    regions = [(0, delims)]
+    pos = text.find(ISA_ID)
+    while (pos != -1):
+        isa_delims = read_isa_delimiters(text[pos:pos + ISA_LENGTH])
+        if (isa_delims is not None):
+            regions.append((pos, isa_delims))
+        pos = text.find(ISA_ID, pos + 1)
+
+    start, start_delims = 0, delims
+
+    for i, (region_start, region_delims) in enumerate(regions):
+        region_end = (regions[i + 1][0] if i + 1 < len(regions)
+                      else len(text))
+        st = "ST" + region_delims.element
+
+        pos = text.find(st, region_start, region_end)
+        while (pos != -1):
+            if (pos > start and follows_transaction(text, pos,
+                                                    region_delims)):
+                yield text[start:pos], start_delims
+                start, start_delims = pos, region_delims
+
+            pos = text.find(st, pos + 1, region_end)
+
+    if (start < len(text)):
+        yield text[start:], start_delims
+
+
+def process_edi_batch(text: str, delims: Delimiters, opts,
+                      envelope: None | Envelope = None,
+                      control_numbers: None | ControlNumbers = None
+                      ) -> tuple[str, int, int, list, None | dict]:
+    '''Process one batch from `split_transaction_batches` in a worker.
+
+    `envelope` and `control_numbers` are where the file is at the start of
+    the batch. Returns the output text of the batch, the number of segments
+    and bytes in it, the diagnostics it produced (positions relative to the
+    start of the batch) and the stages timed with -stats.
+    '''
+
+    ctx = EdiContext(opts)
+    if (envelope is not None):
+        ctx.envelope = envelope
+    if (control_numbers is not None):
+        ctx.control_numbers = control_numbers
+
+    # All of them go back to the main process, which caps them
+    ctx.diagnostics.keep = sys.maxsize
+
+    segments = list(split_edi_segments(io.StringIO(text), delims=delims))
+    output = "".join(edi_stream_lines(segments, ctx))
+    stages = ctx.stats.stages if ctx.stats is not None else None
+    return (output, len(segments), ctx.offset, ctx.diagnostics.records,
+            stages)
+
+
+def process_edi_parallel(filename: str, ctx: EdiContext, jobs: int):
+    '''Process `filename` on `jobs` processes, yielding the output text.
+
+    Transaction sets are sent to the workers in batches and the results are
+    put back together in input order, with the diagnostics moved back to
+    where they are in the whole file. Each batch starts from the envelope
+    and control numbers where it is in the file, found by scanning the
+    batches before it. Only a few batches per worker are in flight at any
+    time so memory stays bounded.
+    '''
+    envelope = ctx.envelope if tracks_envelope(ctx.opts) else None
+    numbers = ctx.control_numbers if ctx.opts[OPT_GEN_UUID] else None
+    pending = deque()
+    offset = 0
+    byte_offset = 0
+
+    def collect():
+        nonlocal offset, byte_offset
+        text, count, size, records, stages = pending.popleft().result()
+        for record in records:
+            record["index"] += offset
+            record["offset"] += byte_offset
+            ctx.diagnostics.add(record)
+        if (stages is not None):
+            ctx.stats.merge(stages)
+        offset += count
+        byte_offset += size
+        return text
+
+    with (open_input(filename) as f, ProcessPoolExecutor(jobs) as pool):
+
+        for text, delims in split_transaction_batches(f):
+            start = None
+            if (envelope is not None):
+                start = envelope.copy()
+                envelope.scan(text, delims)
+
+            start_numbers = None
+            if (numbers is not None and start is not None):
+                numbers.reserve(envelope.transactions)
+                start_numbers = numbers.starting_at(start.transactions)
+
+            pending.append(pool.submit(process_edi_batch, text, delims,
+                                       ctx.opts, start, start_numbers))
+
+            if (len(pending) >= jobs * 2):
+                yield collect()
+
+        while (pending):
+            yield collect()
+
+
+def default_cache_dir() -> str:
+    base = (os.environ.get("XDG_CACHE_HOME")
+            or os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "edi-edits")
+
+
+def cache_enabled(opts: dict) -> bool:
+    '''Whether the run `opts` describe uses the cache.
+
+    Only with -cache, and then not with -gen-uuid (the numbers depend on
+    every set before), on several processes, where transaction sets are
+    sent out in batches, or for -format alone, which takes less time than
+    looking them up.
+    '''
+    return bool(opts.get(OPT_CACHE) and not opts.get(OPT_NO_CACHE)
+                and not opts.get(OPT_GEN_UUID) and opts.get(OPT_JOBS, 1) <= 1
+                and not is_format_only(opts))
+
+
+class EdiCache():
+    '''Output and diagnostics of transaction sets processed before.
+
+    Kept in an SQLite database under a hash of the text of the transaction
+    set, the separators it was read with, the options in CACHE_OPTS and the
+    source of this program, so an entry is only ever found for a run that
+    would produce the exact same thing. New entries and the times entries
+    were used are written once per batch, which keeps the database locked
+    only briefly when several files are processed at once. Once it holds
+    more than `max_size` bytes the least recently used entries go.
+    '''
+
+    def __init__(self, directory: str, opts: dict, max_size: int) -> None:
+        # What it holds is claim data, only for the user running it. SQLite
+        # gives its journal files the mode of the database.
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        filename = os.path.join(directory, CACHE_FILE)
+        os.close(os.open(filename, os.O_CREAT | os.O_WRONLY, 0o600))
+
+        self.db = sqlite3.connect(filename, timeout=CACHE_TIMEOUT)
+        self.max_size = max_size
+
+        # Readers don't wait for the writers
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS blocks (key BLOB PRIMARY KEY, "
+            "output TEXT, segments INTEGER, bytes INTEGER, records TEXT, "
+            "size INTEGER, used REAL)")
+
+        prefix = hashlib.blake2b(digest_size=16)
+        for filename in [__file__, *loop_files()]:
+            prefix.update(os.path.basename(filename).encode())
+            with open(filename, 'rb') as f:
+                prefix.update(f.read())
+        prefix.update(json.dumps([opts[key] for key in CACHE_OPTS]).encode())
+        self.prefix = prefix.digest()
+
+        self.added: list[tuple] = []
+        self.used: list[tuple] = []
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text: str, delims: Delimiters,
+            envelope: None | Envelope = None) -> bytes:
+        '''The key of `text`, and of `envelope` if its output depends on it.'''
+
+        key = hashlib.blake2b(self.prefix, digest_size=16)
+        key.update((delims.element + delims.component + delims.repetition
+                    + delims.terminator).encode())
+        if (envelope is not None):
+            key.update(json.dumps(envelope.stack).encode())
+        key.update(text.encode())
+        return key.digest()
+
+    def get(self, key: bytes) -> None | tuple[str, int, int, list]:
+        '''(output, segments, bytes, diagnostics) stored under `key`.'''
+
+        row = self.db.execute(
+            "SELECT output, segments, bytes, records FROM blocks "
+            "WHERE key = ?", (key,)).fetchone()
+
+        if (row is None):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.used.append((time.time(), key))
+        output, segments, size, records = row
+        return output, segments, size, json.loads(records)
+
+    def put(self, key: bytes, output: str, segments: int, size: int,
+            records: list[dict]) -> None:
+        records = json.dumps(records)
+        self.added.append((key, output, segments, size, records,
+                           len(output) + len(records), time.time()))
+
+    def flush(self) -> None:
+        if (not self.added and not self.used):
+            return
+
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self.added)
+            self.db.executemany("UPDATE blocks SET used = ? WHERE key = ?",
+                                self.used)
+
+        self.added.clear()
+        self.used.clear()
+
+    def evict(self) -> None:
+        '''Drop the least recently used entries over `max_size` bytes.'''
+
+        total = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM blocks").fetchone()[0]
+        if (total <= self.max_size):
+            return
+
+        dropped = []
+        for key, size in self.db.execute(
+                "SELECT key, size FROM blocks ORDER BY used"):
+            if (total <= self.max_size):
+                break
+            dropped.append((key,))
+            total -= size
+
+        with self.db:
+            self.db.executemany("DELETE FROM blocks WHERE key = ?", dropped)
+
+    def close(self) -> None:
+        try:
+            self.flush()
+            if (self.misses):
+                self.evict()
+        finally:
+            self.db.close()
+
+
+def open_cache(opts: dict) -> None | EdiCache:
+    '''The cache for a run with `opts`, None if it isn't to be used.'''
+
+    if (not cache_enabled(opts)):
+        return None
+
+    directory = opts.get(OPT_CACHE_DIR) or default_cache_dir()
+    size = opts.get(OPT_CACHE_SIZE, CACHE_SIZE) * 1_000_000
+
+    try:
+        return EdiCache(directory, opts, size)
+    except (OSError, sqlite3.Error) as e:
+        print_log(f"Not using the cache in {directory}: {e}", LOG_WARN)
+        return None
+
+
+def process_edi_cached(filename: str, ctx: EdiContext, cache: EdiCache):
+    '''Process `filename` one transaction set at a time, yielding the output.
+
+    Transaction sets found in `cache` aren't processed again, their output
+    and diagnostics are taken from it. The others are processed on their
+    own, the way -jobs does it, and stored. Diagnostics are moved back to
+    where they are in the whole file either way. Transaction sets with a GE
+    or IEA after them are stored along with the envelope they start in,
+    which their output depends on.
+    '''
+    envelope = ctx.envelope if tracks_envelope(ctx.opts) else None
+    get, put = cache.get, cache.put
+    if (ctx.stats is not None):
+        get = ctx.stats.timed(cache.get, STAGE_CACHE)
+        put = ctx.stats.timed(cache.put, STAGE_CACHE)
+
+    input_file = ctx.opts.get(OPT_INPUT_FILE) or None
+    offset = 0
+    byte_offset = 0
+
+    with open_input(filename) as f:
+        for batch, delims in split_transaction_batches(f):
+            for text, text_delims in split_transaction_sets(batch, delims):
+                start = trailers = None
+                if (envelope is not None):
+                    start = envelope.copy()
+                    trailers = envelope.scan(text, text_delims)
+                key = cache.key(text, text_delims, start if trailers else None)
+                cached = get(key)
+
+                if (cached is None):
+                    output, count, size, records, stages = process_edi_batch(
+                        text, text_delims, ctx.opts, start)
+                    put(key, output, count, size, records)
+
+                    if (stages is not None):
+                        ctx.stats.merge(stages)
+                else:
+                    output, count, size, records = cached
+
+                for record in records:
+                    record["index"] += offset
+                    record["offset"] += byte_offset
+                    record["file"] = input_file
+                    ctx.diagnostics.add(record)
+
+                offset += count
+                byte_offset += size
+                yield output
+
+            cache.flush()
+
+
+def split_edi_segments(f, read_size: int = READ_SIZE,
+                       delims: Delimiters = DEFAULT_DELIMS):
+    '''Split the text read from `f` into (segment, delims) pairs.
+
+    Segments are split on the terminator of the interchange they are in,
+    the separators are read from each ISA segment as it comes along so
+    concatenated interchanges using different separators split correctly.
+
+    Every piece keeps the whitespace in front of its segment and the
+    terminator plus any whitespace up to the end of that line after it, so
+    joining the pieces gives back the exact input. Characters after the
+    terminator that run up to the end of the line without another segment
+    are kept too, as in the line by line reader, for -format to remove.
+    Lines that have no terminator (empty lines, comments, segments missing
+    their `~`) end at the newline instead, which keeps one-segment-per-line
+    files as they are.
+
+    `delims` are the separators in effect until an ISA segment is seen.
+
+    The input is read `read_size` characters at a time and only the
+    unfinished tail is carried over, so a single-line interchange of any
+    size is split in linear time with bounded memory.
+    '''
+    buf = ""
+    pos = 0
+    eof = False
+
+    # Next terminator at or after `pos` (-1 if none is left in `buf`) and
+    # how far `buf` has been searched for one. Cached so that a run of lines
+    # without terminators doesn't rescan the rest of the buffer every time.
+    next_term = -1
+    term_scanned = 0
+
+    terminator = delims.terminator
+
+    while True:
+        n = len(buf)
+        end = -1
+
+        start = pos
+        while start < n and buf[start] in LINE_WHITESPACE:
+            start += 1
+
+        if (start < n and buf[start] == ISA_ID[0]
+                and start + ISA_LENGTH > n and not eof):
+            # Could be an ISA, wait until all of it is read
+            pass
+
+        elif start == n:
+            # Nothing but whitespace left
+            if eof and pos < n:
+                end = n
+
+        elif buf[start] == NEWLINE:
+            # Empty line
+            end = start + 1
+
+        elif (buf.startswith(COMMENT, start)
+              or (buf[start] == COMMENT[0] and start + 1 == n)):
+            # Comments run to the end of the line, whatever they contain
+            newline = buf.find(NEWLINE, start)
+            if newline != -1:
+                end = newline + 1
+            elif eof:
+                end = n
+
+        else:
+            if (buf.startswith(ISA_ID, start)):
+                isa_delims = read_isa_delimiters(
+                    buf[start:start + ISA_LENGTH])
+
+                if (isa_delims is not None):
+                    delims = isa_delims
+                    terminator = delims.terminator
+                    next_term = -1
+                    term_scanned = start
+
+            if next_term < pos:
+                next_term = buf.find(terminator, max(pos, term_scanned))
+                term_scanned = n if next_term == -1 else next_term
+
+            newline = buf.find(NEWLINE, start,
+                               n if next_term == -1 else next_term)
+
+            if newline != -1:
+                # Segment without a terminator
+                end = newline + 1
+
+            elif terminator == NEWLINE and next_term != -1:
+                end = next_term + len(terminator)
+
+            elif next_term != -1:
+                after = next_term + len(terminator)
+
+                # Whitespace and empty segments after the terminator, up to
+                # the newline, stay at the end of this segment
+                index = after
+                while index < n:
+                    if buf[index] in LINE_WHITESPACE:
+                        index += 1
+                    elif buf.startswith(terminator, index):
+                        index += len(terminator)
+                    else:
+                        break
+
+                if index < n and buf[index] == NEWLINE:
+                    end = index + 1
+
+                elif index < n:
+                    # Either the next segment on the same line, or left
+                    # over characters up to the end of the line that stay
+                    # at the end of this segment for -format to remove
+                    following = buf.find(terminator, index)
+                    newline = buf.find(NEWLINE, index,
+                                       n if following == -1 else following)
+
+                    if newline != -1:
+                        end = newline + 1
+                    elif following != -1:
+                        end = after
+                    elif eof:
+                        end = n
+
+                elif eof:
+                    end = n
+
+            elif eof:
+                end = n
+
+        if end == -1:
+            if eof:
+                return
+
+            # Grow the read with the carried-over tail so that a very long
+            # segment is still read in a linear number of steps.
+            chunk = f.read(max(read_size, n - pos))
+            eof = not chunk
+
+            buf = buf[pos:] + chunk
+            term_scanned = max(term_scanned - pos, 0)
+            next_term = -1
+            pos = 0
+            continue
+
+        yield buf[pos:end], delims
+        pos = end
+
+
+def read_edi_segments(filename: str):
+    '''Yield the segments of `filename` without reading it all at once.'''
+    with open_input(filename) as f:
+        yield from split_edi_segments(f)
+
+
+def segment_pattern(terminator: bytes) -> re.Pattern:
+    '''Regex matching one piece of input the way `split_edi_segments` cuts
+    it, for segments ending in `terminator`. Group 1 is the whitespace in
+    front of the segment.
+    '''
+    if (terminator == NEWLINE.encode()):
+        body = rb"[^\n]*(?:\n|\Z)"
+    else:
+        t = re.escape(terminator)
+        # After the terminator, the rest of the line if no other segment
+        # is on it
+        rest = (rb"(?:[ \t\r]|" + t + rb")*(?:[^\n \t\r" + t + rb"][^\n"
+                + t + rb"]*)?(?:\n|\Z)")
+        body = rb"[^\n" + t + rb"]*(?:\n|" + t + rb"(?:" + rest + rb")?|\Z)"
+
+    return re.compile(rb"([ \t\r]*)(?:\n|//[^\n]*(?:\n|\Z)|" + body + rb")")
+
+
+def next_mapped_piece(buffer, pos: int, delims: Delimiters,
+                      pattern: re.Pattern) -> tuple:
+    '''The piece of `buffer` starting at `pos`, see `split_edi_mapped`.
+
+    `pattern` is the `segment_pattern` of `delims`. Returns (body start,
+    body end, end, delims, pattern), the last two changed by an ISA segment
+    with other separators.
+    '''
+    n = len(buffer)
+    match = pattern.match(buffer, pos)
+    body_start = match.end(1)
+
+    if (body_start < n and buffer[body_start] == ISA_BYTES[0]
+            and buffer[body_start:body_start + len(ISA_BYTES)] == ISA_BYTES):
+        isa_delims = read_isa_delimiters(
+            buffer[body_start:body_start + ISA_LENGTH].decode("latin-1"))
+
+        if (isa_delims is not None):
+            if (isa_delims.terminator != delims.terminator):
+                pattern = segment_pattern(isa_delims.terminator_bytes)
+                match = pattern.match(buffer, pos)
+            delims = isa_delims
+
+    end = match.end()
+
+    if (body_start == end or buffer[body_start] == NEWLINE_BYTE):
+        # Nothing but whitespace
+        return -1, -1, end, delims, pattern
+
+    # Where Segment would put the end of the body
+    body_end = buffer.find(delims.terminator_bytes, body_start, end)
+    if (body_end == -1):
+        body_end = buffer.find(NEWLINE_BYTES, body_start, end)
+        if (body_end == -1):
+            # The last character, which can take more than one byte
+            body_end = end - 1
+            while (body_end > body_start
+                   and buffer[body_end] & 0xC0 == 0x80):
+                body_end -= 1
+
+    return body_start, body_end, end, delims, pattern
+
+
+def split_edi_mapped(buffer, delims: Delimiters = DEFAULT_DELIMS):
+    '''Split the bytes of `buffer` (a mapped file) like `split_edi_segments`.
+
+    Yields (start, body start, body end, end, delims) byte positions for
+    each segment, the body being -1 for empty lines. The pieces are found
+    by a regex so nothing is copied or decoded here.
+    '''
+    n = len(buffer)
+    pos = 0
+    pattern = segment_pattern(delims.terminator_bytes)
+
+    while pos < n:
+        body_start, body_end, end, delims, pattern = next_mapped_piece(
+            buffer, pos, delims, pattern)
+        yield pos, body_start, body_end, end, delims
+        pos = end
+
+
+class CleanRuns():
+    '''Finds the runs of segments -format leaves as they are.
+
+    Those have no whitespace in front, aren't comments and end in the
+    terminator, followed by a newline or the next segment. Rather than
+    matching them one by one, the input is searched for what can't be in
+    such a run: a terminator followed by whitespace, a comment, another
+    terminator or an ISA segment (which can change the separators), and a
+    newline without a terminator in front. Everything up to the last
+    terminator before the first of those is a clean run. The input is
+    searched `SEARCH_SIZE` bytes at a time, and again only once the run
+    gets past what was searched, so every byte is looked at once.
+    '''
+
+    def __init__(self, buffer, delims: Delimiters) -> None:
+        self.buffer = buffer
+        self.terminator = delims.terminator_bytes
+        t = re.escape(self.terminator)
+
+        # The runs end before the match, or at the empty group if there is
+        # one: the segment ending there is fine, the next one isn't
+        if (self.terminator == NEWLINE_BYTES):
+            self.patterns = [re.compile(rb"\n()(?:[ \t\r/\n]|ISA)")]
+        else:
+            self.patterns = [
+                re.compile(t + rb"(?:[ \t\r]|()(?:[/" + t + rb"]|ISA|\n(?:"
+                           + rb"[ \t\r/\n" + t + rb"]|ISA)))"),
+                re.compile(rb"\n(?<!" + t + rb"\n)"),
+            ]
+
+        # Where each pattern matches next (or how far it was searched)
+        self.found = [-1] * len(self.patterns)
+
+    def end(self, pos: int) -> int:
+        '''End of the clean run starting at `pos`, `pos` if there is none.'''
+
+        buffer = self.buffer
+        n = len(buffer)
+
+        first = buffer[pos]
+        if (first in b" \t\r\n/" or first == self.terminator[0]
+                or buffer[pos:pos + len(ISA_BYTES)] == ISA_BYTES):
+            return pos
+
+        limit = n
+        for i, pattern in enumerate(self.patterns):
+            if (self.found[i] < pos):
+                window = min(n, pos + SEARCH_SIZE)
+                match = pattern.search(buffer, pos, window)
+
+                if (match is None):
+                    # A match could start in the last few bytes and run
+                    # past the window, so only what's before them is clean
+                    self.found[i] = (n if window == n
+                                     else window - CLEAN_RUN_MARGIN)
+                elif (match.lastindex):
+                    self.found[i] = match.start(1)
+                else:
+                    self.found[i] = match.start()
+
+            limit = min(limit, self.found[i])
+
+        last = buffer.rfind(self.terminator, pos, limit)
+        if (last == -1):
+            return pos
+
+        end = last + 1
+        if (end < n and buffer[end] != NEWLINE_BYTE
+                and self.terminator != NEWLINE_BYTES):
+            # What follows could run into a newline before the next
+            # terminator, making it part of this segment, so the run ends
+            # at the segment before
+            last = buffer.rfind(self.terminator, pos, last)
+            if (last == -1):
+                return pos
+            end = last + 1
+
+        if (end < n and buffer[end] == NEWLINE_BYTE
+                and self.terminator != NEWLINE_BYTES):
+            end += 1
+        return end
+
+
+def clean_runs(buffer, delims: Delimiters) -> None | CleanRuns:
+    '''`CleanRuns` for `delims`, None unless the terminator is one byte.'''
+
+    if (len(delims.terminator_bytes) != 1):
+        return None
+    return CleanRuns(buffer, delims)
+
+
+# Runs of empty lines and comments, cut the way `split_edi_segments` cuts
+# them: it looks for these before it looks for a terminator, so they don't
+# depend on the separators. A "//" ending the input isn't a comment, the
+# segment it makes keeps its last character as the end.
+DROPPED_LINES = re.compile(
+    rb"(?:[ \t\r]*(?:\n|//(?:[^\n]*\n|[^\n]+\Z)))+|[ \t\r]+\Z")
+
+
+def control_number_pattern(delims: Delimiters) -> None | re.Pattern:
+    '''Regex matching the ST segments in a clean run, with their ST02.'''
+
+    t, e = delims.terminator_bytes, delims.element_bytes
+    if (len(t) != 1 or len(e) != 1):
+        return None
+
+    t, e = re.escape(t), re.escape(e)
+    # Starting with ST (checked to be at the start of a segment after it)
+    # lets the regex engine jump from one ST to the next
+    return re.compile(rb"ST(?<![^" + t + rb"\n]ST)(?:" + e + rb"[^" + e
+                      + t + rb"\n]*(?:" + e + rb"([^" + e + t + rb"\n]*))?)?"
+                      + rb"(?=[" + e + t + rb"])")
+
+
+def format_mapped(buffer, ctx: EdiContext):
+    '''-format on the bytes of a mapped input, without splitting elements.
+
+    Runs of segments that are already clean (see `CleanRuns`) are skipped
+    over without looking at the segments and yielded as (start, end) byte
+    positions to copy. Everything else is made a `MappedSegment` and goes
+    through `format_module` as usual, yielding its text if it changed. The
+    diagnostics come out the same as on the normal path.
+    '''
+    n = len(buffer)
+    pos = 0
+    index = 0
+    delims = DEFAULT_DELIMS
+    pattern = segment_pattern(delims.terminator_bytes)
+    clean = clean_runs(buffer, delims)
+    st = control_number_pattern(delims)
+
+    # Start of the clean runs not yet searched for ST segments
+    scanned = 0
+
+    deletions: list[int] = []
+    format_item = format_module
+    if (ctx.stats is not None):
+        format_item = ctx.stats.timed(format_module, OPT_FORMAT)
+
+    while pos < n:
+        if (clean is not None):
+            end = clean.end(pos)
+            if (end > pos):
+                index += buffer[pos:end].count(delims.terminator_bytes)
+                yield pos, end
+                pos = end
+                continue
+
+        # Keep track of where we are for the diagnostics
+        if (scanned < pos and st is not None):
+            for match in st.finditer(buffer, scanned, pos):
+                number = match.group(1)
+                ctx.control_number = (None if number is None
+                                      else number.decode())
+        ctx.offset = pos
+
+        # Empty lines and comments are all dropped
+        if (COMMENT[0] != delims.element):
+            match = DROPPED_LINES.match(buffer, pos)
+            if (match is not None):
+                end = match.end()
+                lines = buffer[pos:end]
+                index += lines.count(NEWLINE_BYTES)
+                if (not lines.endswith(NEWLINE_BYTES)):
+                    index += 1
+                pos = scanned = end
+                continue
+
+        body_start, body_end, end, piece_delims, pattern = next_mapped_piece(
+            buffer, pos, delims, pattern)
+        scanned = end
+
+        if (piece_delims is not delims):
+            delims = piece_delims
+            clean = clean_runs(buffer, delims)
+            st = control_number_pattern(delims)
+
+        item = MappedSegment(buffer, pos, body_start, body_end, end, delims)
+
+        if (item.id_startswith("ST") and item.id == "ST"):
+            elements = item.peek_elements()
+            ctx.control_number = elements[2] if len(elements) > 2 else None
+
+        item = format_item(index, item, ctx, None, deletions)
+        index += 1
+        pos = end
+
+        if (deletions):
+            deletions.clear()
+            continue
+
+        source = item.source_range()
+        yield source if source is not None else edi_item_to_line(item)
+
+    ctx.offset = n
+    if (ctx.stats is not None):
+        ctx.stats.segment_count = index
+
+
+def is_format_only(opts: dict) -> bool:
+    return opts.get(OPT_FORMAT) and not opts.get(OPT_FIX_ERRORS) \
+        and not opts.get(OPT_ID_LOOPS)
+
+
+def map_edi_file(filename: str, crlf: bool = False) -> None | mmap.mmap:
+    '''Memory-map `filename` for reading, if it can be read that way.
+
+    Files with carriage returns are left to the text reader, which turns
+    CRLF into LF, so the output doesn't depend on how the file was read.
+    With `crlf` they are mapped too, for byte positions in them.
+    Compressed files are left to the text reader as well, which decompresses
+    them as it goes instead of onto the disk first.
+    '''
+    if (split_compression(filename)[1]):
+        return None
+
+    with open(filename, 'rb') as f:
+        return map_open_file(f, crlf)
+
+
+def map_open_file(f, crlf: bool = False) -> None | mmap.mmap:
+    if (os.fstat(f.fileno()).st_size == 0):
+        return None
+
+    try:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # Pipes, special files
+        return None
+
+    if (not crlf and buffer.find(b"\r") != -1):
+        buffer.close()
+        return None
+
+    return buffer
+
+
+# Reading the umask means setting it, which isn't safe once threads (-jobs,
+# -serve) run, so it is read once here.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def replace_file(tmp_name: str, filename: str) -> None:
+    '''Rename `tmp_name` over `filename`, which keeps its permissions and
+    (where allowed) its owner and group.'''
+
+    if (os.path.exists(filename)):
+        stat = os.stat(filename)
+        os.chmod(tmp_name, stat.st_mode & 0o7777)
+        try:
+            os.chown(tmp_name, stat.st_uid, stat.st_gid)
+        except PermissionError:
+            pass
+    else:
+        os.chmod(tmp_name, 0o666 & ~UMASK)
+
+    os.replace(tmp_name, filename)
+
+
+def open_compressed(file, mode: str, ext: str, newline: None | str = None):
+    '''Open `file` (a name or a binary file) compressed as `ext` says.'''
+
+    if (ext == GZIP_EXT):
+        return gzip.open(file, mode, compresslevel=GZIP_LEVEL,
+                         newline=newline)
+
+    if (zstd is None):
+        raise EdiError(f"Reading or writing {ZSTD_EXT} files needs the "
+                       "zstandard package. Exiting.")
+    return zstd.open(file, mode, newline=newline)
+
+
+def open_input(filename: str, mode: str = 'r'):
+    '''Open `filename` for reading, decompressing .gz and .zst files.
+
+    Text is read with its carriage returns, so the segments know their size
+    in the file (see CrlfSegment).
+    '''
+    ext = split_compression(filename)[1]
+    if ('b' in mode):
+        return (open_compressed(filename, mode, ext) if ext
+                else open(filename, mode))
+
+    if (ext):
+        return open_compressed(filename, 'rt', ext, newline="")
+    return open(filename, mode, newline="")
+
+
+@contextlib.contextmanager
+def open_output_stream(file, mode: str, ext: str):
+    '''Open `file` (a name or a descriptor) for writing through
+    WRITE_BUFFER bytes, compressed as `ext` says.'''
+
+    if (ext):
+        text_mode = mode if 'b' in mode else 'wt'
+        with (open(file, 'wb', buffering=WRITE_BUFFER) as raw,
+              open_compressed(raw, text_mode, ext) as f):
+            yield f
+    else:
+        with open(file, mode, buffering=WRITE_BUFFER) as f:
+            yield f
+
+
+@contextlib.contextmanager
+def open_output(filename: str, mode: str = 'w'):
+    '''Open a file that replaces `filename` once it is closed.
+
+    The output goes to a temporary file next to the destination which is then
+    renamed over it, so writing in-place (-i) never reads a truncated input
+    and a failed run leaves the old file as it was. A symlink is followed,
+    the file it points to is the one replaced. Anything else that isn't a
+    regular file (/dev/null, a FIFO, /dev/stdout) is written to directly.
+    Writes are collected into WRITE_BUFFER bytes, and compressed when
+    `filename` ends in .gz or .zst.
+    '''
+    ext = split_compression(filename)[1]
+
+    if (os.path.exists(filename) and not os.path.isfile(filename)):
+        with open_output_stream(filename, mode, ext) as f:
+            yield f
+        return
+
+    filename = os.path.realpath(filename)
+    fd, tmp_name = tempfile.mkstemp(prefix=".edi-",
+                                    dir=os.path.dirname(filename))
+
+    try:
+        with open_output_stream(fd, mode, ext) as f:
+            yield f
+        replace_file(tmp_name, filename)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def write_edi_lines(filename: str, lines,
+                    stats: None | RunStats = None) -> None:
+    '''Write `lines` to `filename` as they are produced.
+
+    With `stats` the writes are timed one line at a time.
+    '''
+    with open_output(filename) as f:
+        if (stats is None):
+            f.writelines(lines)
+        else:
+            write = stats.timed(f.write, STAGE_WRITE)
+            for line in lines:
+                write(line)
+
+
+def write_edi_items(filename: str, items, buffer,
+                    stats: None | RunStats = None) -> None:
+    '''Write the items of a mapped input `buffer` to `filename`.
+
+    Segments that weren't changed are copied from `buffer`, only the others
+    are turned back into text (see `write_mapped`).
+    '''
+    to_line = edi_item_to_line
+    if (stats is not None):
+        to_line = stats.timed(edi_item_to_line, STAGE_SERIALIZE)
+
+    def pieces():
+        for item in items:
+            source = item.source_range()
+            yield source if source is not None else to_line(item)
+
+    write_mapped(filename, pieces(), buffer, stats)
+
+
+def write_mapped(filename: str, pieces, buffer,
+                 stats: None | RunStats = None) -> None:
+    '''Write `pieces` of output made from a mapped input `buffer`.
+
+    Each piece is either (start, end) positions of bytes to copy from
+    `buffer` or text. Runs of adjacent positions are copied as single
+    memoryview slices.
+    '''
+    run_start = run_end = -1
+
+    with (open_output(filename, 'wb') as f, memoryview(buffer) as view):
+        write = f.write
+        if (stats is not None):
+            write = stats.timed(f.write, STAGE_WRITE)
+
+        for piece in pieces:
+            if (type(piece) is tuple):
+                if (piece[0] == run_end):
+                    run_end = piece[1]
+                    continue
+
+                if (run_end > run_start):
+                    write(view[run_start:run_end])
+                run_start, run_end = piece
+
+            else:
+                if (run_end > run_start):
+                    write(view[run_start:run_end])
+                run_start = run_end = -1
+                write(piece.encode())
+
+        if (run_end > run_start):
+            write(view[run_start:run_end])
+
+
+def index_pattern(delims: Delimiters, at_start: bool = False) -> re.Pattern:
+    '''Regex finding the segments in INDEX_IDS, for the separators `delims`.
+
+    Group 1 is the segment ID. The segment has to follow a terminator or a
+    newline (after whitespace), so IDs inside values aren't taken for one.
+    The pattern `at_start` is for matching at the start of the file instead.
+    '''
+    terminator = re.escape(delims.terminator_bytes)
+    element = re.escape(delims.element_bytes)
+    ids = b"|".join(segment_id.encode() for segment_id in INDEX_IDS
+                    if segment_id != ISA_ID)
+
+    # A class lets the regex skip ahead far quicker than an alternation
+    if (at_start):
+        before = b""
+    elif (len(delims.terminator_bytes) == 1):
+        before = rb"[" + terminator + rb"\n]"
+    else:
+        before = rb"(?:" + terminator + rb"|\n)"
+
+    return re.compile(before + rb"[ \t\r\n]*(" + ISA_BYTES + rb"|(?:" + ids
+                      + rb")(?=" + element + rb"))")
+
+
+class IndexBuilder():
+    '''Finds the entries of the index of a mapped file in one pass.
+
+    An entry is [id, kind, key, start, head, end, trailer, parent]: the
+    segment ID that opens it and the value it is looked up by (ISA13, GS06,
+    ST02, HL01, CLM01), the byte range of the whole interchange, group,
+    transaction set, HL loop or claim, where its first segment ends (None
+    for HL loops and claims), where its IEA, GE or SE segment starts (None
+    without one) and the id of the entry it is part of.
+
+    An HL loop is its own segments, up to the next HL or CLM. Its parent
+    is the loop of the HL its HL02 names, or the transaction set. A claim
+    ends at the next CLM, HL or SE and its parent is the last HL loop.
+    Only the segments in INDEX_IDS are looked at, found with a regex, so
+    the rest of the file is never split or decoded.
+    '''
+
+    def __init__(self, buffer) -> None:
+        self.buffer = buffer
+        self.entries: list[list] = []
+        self.count = 0
+
+        # The open interchange, group and transaction set
+        self.isa = self.gs = self.st = None
+
+        # The HL loop or claim that ends at the next segment found
+        self.pending = None
+
+        # HL01 -> id of its loop, in the open transaction set
+        self.hls: dict[str, int] = {}
+        self.last_hl = None
+
+    def run(self):
+        '''Yield the entries, INDEX_BATCH (or fewer) at a time.'''
+
+        buffer = self.buffer
+        delims = DEFAULT_DELIMS
+        pattern = index_pattern(delims)
+        piece_pattern = segment_pattern(delims.terminator_bytes)
+
+        match = index_pattern(delims, at_start=True).match(buffer)
+        if (match is None):
+            match = pattern.search(buffer)
+
+        while (match is not None):
+            start = match.start(1)
+            segment_id = match.group(1).decode()
+
+            if (segment_id == ISA_ID):
+                isa_delims = read_isa_delimiters(
+                    buffer[start:start + ISA_LENGTH].decode("latin-1"))
+                if (isa_delims is None):
+                    match = pattern.search(buffer, match.end())
+                    continue
+
+                if (isa_delims.element != delims.element
+                        or isa_delims.terminator != delims.terminator):
+                    pattern = index_pattern(isa_delims)
+                    piece_pattern = segment_pattern(
+                        isa_delims.terminator_bytes)
+                delims = isa_delims
+
+            if (segment_id in ("HL", "CLM")):
+                # Nothing ends at these, the end of the body will do
+                body_end = buffer.find(delims.terminator_bytes, start)
+                if (body_end == -1):
+                    body_end = len(buffer)
+                newline = buffer.find(NEWLINE_BYTES, start, body_end)
+                if (newline != -1):
+                    body_end = newline
+                end = body_end
+            else:
+                _, body_end, end, _, _ = next_mapped_piece(
+                    buffer, start, delims, piece_pattern)
+
+            # ISA13 is the last element read
+            elements = buffer[start:body_end].split(delims.element_bytes, 14)
+            self.feed(segment_id, elements, start, end)
+
+            if (len(self.entries) >= INDEX_BATCH):
+                yield self.entries
+                self.entries = []
+
+            # From the terminator, the next segment is found after it
+            match = pattern.search(buffer, body_end)
+
+        self.close_pending(len(buffer))
+        for kind in ("st", "gs", "isa"):
+            self.close(kind, len(buffer))
+        yield self.entries
+
+    def feed(self, segment_id: str, elements: list[bytes], start: int,
+             end: int) -> None:
+        value = self.value
+        self.close_pending(start)
+
+        if (segment_id == "ISA"):
+            for kind in ("st", "gs", "isa"):
+                self.close(kind, start)
+            self.isa = self.new("ISA", value(elements, 13), start, end, None)
+
+        elif (segment_id == "IEA"):
+            for kind in ("st", "gs"):
+                self.close(kind, start)
+            self.close("isa", end, start)
+
+        elif (segment_id == "GS"):
+            for kind in ("st", "gs"):
+                self.close(kind, start)
+            self.gs = self.new("GS", value(elements, 6), start, end, self.isa)
+
+        elif (segment_id == "GE"):
+            self.close("st", start)
+            self.close("gs", end, start)
+
+        elif (segment_id == "ST"):
+            self.close("st", start)
+            self.st = self.new("ST", value(elements, 2), start, end, self.gs)
+
+        elif (segment_id == "SE"):
+            self.close("st", end, start)
+
+        elif (segment_id == "HL"):
+            st_id = self.st[0] if self.st is not None else None
+            self.pending = self.new("HL", value(elements, 1), start, None,
+                                    None)
+            self.pending[7] = self.hls.get(value(elements, 2), st_id)
+            self.hls[value(elements, 1)] = self.last_hl = self.pending[0]
+
+        elif (segment_id == "CLM"):
+            st_id = self.st[0] if self.st is not None else None
+            self.pending = self.new("CLM", value(elements, 1), start, None,
+                                    None)
+            self.pending[7] = self.last_hl or st_id
+
+    @staticmethod
+    def value(elements: list[bytes], i: int) -> str:
+        if (i >= len(elements)):
+            return ""
+        return elements[i].decode(errors="replace").strip()
+
+    def new(self, kind: str, key: str, start: int, head: None | int,
+            parent: None | list) -> list:
+        self.count += 1
+        return [self.count, kind, key, start, head, None, None,
+                parent[0] if parent is not None else None]
+
+    def close(self, kind: str, end: int, trailer: None | int = None) -> None:
+        '''End the open entry `kind` ("isa", "gs" or "st") at `end`.'''
+
+        entry = getattr(self, kind)
+        if (entry is None):
+            return
+
+        entry[5], entry[6] = end, trailer
+        self.entries.append(entry)
+        setattr(self, kind, None)
+
+        if (kind == "st"):
+            self.hls = {}
+            self.last_hl = None
+
+    def close_pending(self, end: int) -> None:
+        if (self.pending is not None):
+            self.pending[5] = end
+            self.entries.append(self.pending)
+            self.pending = None
+
+
+def index_file_for(input_file: str) -> str:
+    return input_file + INDEX_EXT
+
+
+def check_indexable(input_file: str) -> None:
+    '''Raise EdiError if `input_file` can't be indexed.
+
+    The index holds byte offsets into the file as it is on the disk, which
+    a compressed file has none of to seek to.
+    '''
+    if (split_compression(input_file)[1]):
+        raise EdiError(f"{input_file} is compressed, {OPT_INDEX} and "
+                       f"{OPT_EXTRACT} only work on uncompressed files. "
+                       "Exiting.")
+
+
+def build_index(input_file: str, index_file: str) -> None:
+    '''Write the index of `input_file` (see IndexBuilder) to `index_file`.
+
+    The index is an SQLite database, written to a temporary file that is
+    renamed over `index_file` once it is complete.
+    '''
+    check_indexable(input_file)
+    buffer = map_edi_file(input_file, crlf=True)
+    stat = os.stat(input_file)
+
+    index_file = os.path.realpath(index_file)
+    fd, tmp_name = tempfile.mkstemp(prefix=".edi-",
+                                    dir=os.path.dirname(index_file))
+    os.close(fd)
+
+    try:
+        with (contextlib.closing(sqlite3.connect(tmp_name)) as db,
+              buffer if buffer is not None else contextlib.nullcontext()):
+            # Nobody reads it before the rename
+            db.execute("PRAGMA journal_mode=OFF")
+            db.execute("PRAGMA synchronous=OFF")
+            db.execute(f"PRAGMA user_version={INDEX_VERSION}")
+            db.execute(
+                "CREATE TABLE entries (id INTEGER PRIMARY KEY, kind TEXT, "
+                "key TEXT, start INTEGER, head INTEGER, end INTEGER, "
+                "trailer INTEGER, parent INTEGER)")
+            db.execute("CREATE TABLE source (size INTEGER, mtime INTEGER)")
+            db.execute("INSERT INTO source VALUES (?, ?)",
+                       (stat.st_size, stat.st_mtime_ns))
+
+            builder = IndexBuilder(buffer if buffer is not None else b"")
+            for entries in builder.run():
+                db.executemany(
+                    "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    entries)
+
+            # Quicker built once the rows are in
+            db.execute("CREATE INDEX by_key ON entries (kind, key)")
+            db.execute("CREATE INDEX by_parent ON entries (parent)")
+            db.commit()
+
+        replace_file(tmp_name, index_file)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def open_index(input_file: str) -> sqlite3.Connection:
+    '''The index of `input_file`, built first if it's missing or older.'''
+
+    index_file = index_file_for(input_file)
+    stat = os.stat(input_file)
+
+    if (os.path.exists(index_file)):
+        db = sqlite3.connect(index_file)
+        try:
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            source = db.execute("SELECT size, mtime FROM source").fetchone()
+            if (version == INDEX_VERSION
+                    and source == (stat.st_size, stat.st_mtime_ns)):
+                return db
+        except sqlite3.Error:
+            pass
+        db.close()
+
+    print_log(f"Indexing {input_file}...", LOG_INFO)
+    build_index(input_file, index_file)
+    return sqlite3.connect(index_file)
+
+
+def extract_ranges(db: sqlite3.Connection, entry: tuple) -> list[tuple]:
+    '''The byte ranges to copy for the transaction set or claim `entry`.
+
+    Those are the ISA and GS segments it's in, then the transaction set,
+    or for a claim: the segments of its transaction set before the first HL,
+    the HL loops it is under, the claim and the SE segment. Then the GE and
+    IEA segments.
+    '''
+    def get(entry_id: None | int) -> None | tuple:
+        if (entry_id is None):
+            return None
+        return db.execute("SELECT * FROM entries WHERE id = ?",
+                          (entry_id,)).fetchone()
+
+    _, kind, _, start, _, end, _, parent = entry
+    body = [(start, end)]
+
+    if (kind == "CLM"):
+        parent_entry = get(parent)
+        while (parent_entry is not None and parent_entry[1] == "HL"):
+            body.insert(0, (parent_entry[3], parent_entry[5]))
+            parent_entry = get(parent_entry[7])
+
+        st = parent_entry
+        if (st is not None):
+            first_hl = db.execute(
+                "SELECT min(start) FROM entries WHERE parent = ? AND "
+                "kind = 'HL'", (st[0],)).fetchone()[0]
+            body.insert(0, (st[3], first_hl if first_hl is not None
+                            else start))
+            if (st[6] is not None):
+                body.append((st[6], st[5]))
+        parent = st[7] if st is not None else None
+
+    gs = get(parent)
+    isa = get(gs[7]) if gs is not None else None
+
+    ranges = []
+    for envelope in (isa, gs):
+        if (envelope is not None):
+            ranges.append((envelope[3], envelope[4]))
+    ranges += body
+    for envelope in (gs, isa):
+        if (envelope is not None and envelope[6] is not None):
+            ranges.append((envelope[6], envelope[5]))
+
+    return ranges
+
+
+def extract_edi(input_file: str, key: str) -> str:
+    '''The transaction sets with control number `key` in `input_file`, or
+    if there are none its claims with patient account number `key`.
+
+    Each comes with a copy of its envelope, see `extract_ranges`. The
+    index of the file is used to go straight to them.
+    '''
+    check_indexable(input_file)
+    with contextlib.closing(open_index(input_file)) as db:
+        entries = []
+        for kind in ("ST", "CLM"):
+            entries = db.execute(
+                "SELECT * FROM entries WHERE kind = ? AND key = ? "
+                "ORDER BY start", (kind, key)).fetchall()
+            if (entries):
+                break
+
+        if (not entries):
+            raise EdiError(f"There is no transaction set or claim {key} in "
+                           f"{input_file}. Exiting.")
+
+        ranges = []
+        for entry in entries:
+            ranges += extract_ranges(db, entry)
+
+    buffer = map_edi_file(input_file, crlf=True)
+    with buffer:
+        return b"".join(buffer[start:end] for start, end in ranges).decode()
+
+
+def same_delimiters(a: Delimiters, b: Delimiters) -> bool:
+    return a is b or (a.element == b.element and a.component == b.component
+                      and a.repetition == b.repetition
+                      and a.terminator == b.terminator)
+
+
+def redelimit(item: Segment, delims: Delimiters) -> str:
+    '''The line of `item`, with its separators changed to `delims`.'''
+
+    source = item.delims
+    if (item.is_empty or item.is_comment()
+            or same_delimiters(source, delims)):
+        return item.to_line()
+
+    table = str.maketrans({source.component: delims.component,
+                           source.repetition: delims.repetition})
+    elements = [element.translate(table) for element in item.elements]
+
+    end = item.end
+    if (end.startswith(source.terminator)):
+        end = delims.terminator + end[len(source.terminator):]
+
+    return item.start + delims.element.join(elements) + end
+
+
+def envelope_events(items):
+    '''Group a stream of items into its envelope and transaction sets.
+
+    Yields (segment ID, item) for the ISA, GS, GE and IEA segments and
+    ("ST", items) for each transaction set, from its ST to its SE with
+    whatever came before it since the last one (comments, empty lines).
+    Anything after the last transaction set comes as (None, items). Only
+    one transaction set is held at a time.
+    '''
+    held = []
+    in_set = False
+
+    for item in items:
+        segment_id = item.id
+
+        if (not in_set and segment_id in ENVELOPE_IDS):
+            yield segment_id, item
+            continue
+
+        held.append(item)
+
+        if (segment_id == "ST"):
+            in_set = True
+
+        elif (segment_id == "SE" and in_set):
+            yield "ST", held
+            held = []
+            in_set = False
+
+    if (held):
+        yield None, held
+
+
+class EnvelopeWriter():
+    '''Writes transaction sets into a file inside envelopes of its own.
+
+    The ISA and GS set with `interchange` and `group` are written in front
+    of the next transaction set, and closed with a GE and IEA counting what
+    actually went into the file once they end, change or the file is
+    finished. `start` moves on to another file, where they are written
+    again. Each ISA13 and GS06 written is a new number taken from
+    `interchange_numbers` and `group_numbers`, or kept as it is where they
+    are None. Every segment is written with the separators of the ISA.
+    '''
+
+    def __init__(self, interchange_numbers: None | ControlNumbers = None,
+                 group_numbers: None | ControlNumbers = None) -> None:
+        self.numbers = {"ISA": interchange_numbers, "GS": group_numbers}
+        self.f = None
+        self.isa = self.gs = None
+        self.isa_open = self.gs_open = False
+        self.delims = DEFAULT_DELIMS
+
+        # Groups in the open interchange, sets in the open group
+        self.groups = 0
+        self.group_sets = 0
+
+        # Transaction sets and bytes written to the file
+        self.sets = 0
+        self.size = 0
+
+    def start(self, f) -> None:
+        self.f = f
+        self.sets = 0
+        self.size = 0
+
+    def write(self, text: str) -> None:
+        self.f.write(text)
+        self.size += byte_length(text)
+
+    def interchange(self, isa: Segment) -> None:
+        self.close_interchange()
+        self.isa = isa
+        self.delims = isa.delims
+
+    def group(self, gs: Segment) -> None:
+        self.close_group()
+        self.gs = gs
+
+    def end_group(self) -> None:
+        self.close_group()
+        self.gs = None
+
+    def end_interchange(self) -> None:
+        self.close_interchange()
+        self.isa = self.gs = None
+
+    def trailer(self, segment_id: str, count: int, header: Segment) -> str:
+        control = element_at(header.elements, ENVELOPE_CONTROL[header.id])
+        return redelimit(Segment.from_parts(
+            "", [segment_id, str(count), control or ""], header.end,
+            header.delims), self.delims)
+
+    def lines(self, items: list[Segment]) -> list[str]:
+        return [redelimit(item, self.delims) for item in items]
+
+    def number(self, header: Segment, take: bool) -> None:
+        '''Give `header` its next control number, if it gets new ones.
+
+        Without `take` the number is only looked at, for the size of the
+        header, and the same one comes again.
+        '''
+        numbers = self.numbers[header.id]
+        if (numbers is None):
+            return
+
+        position = ENVELOPE_CONTROL[header.id]
+        elements = header.elements
+        elements.extend([""] * (position + 1 - len(elements)))
+        elements[position] = numbers.next() if take else numbers.peek()
+
+    def headers(self, take: bool = False) -> list[str]:
+        '''The ISA and GS lines to write before the next transaction set,
+        with their control numbers taken when `take` is set.'''
+
+        lines = []
+        if (self.isa is not None and not self.isa_open):
+            self.number(self.isa, take)
+            lines.append(self.isa.to_line())
+
+        if (self.gs is not None and not self.gs_open):
+            self.number(self.gs, take)
+            lines.append(redelimit(self.gs, self.delims))
+
+        return lines
+
+    def size_with(self, lines: list[str]) -> int:
+        '''Size of the file once the set `lines` and the trailers are in.'''
+
+        size = self.size + sum(byte_length(line) for line in self.headers())
+        size += sum(byte_length(line) for line in lines)
+
+        if (self.gs is not None):
+            size += byte_length(self.trailer("GE", self.group_sets + 1,
+                                             self.gs))
+        if (self.isa is not None):
+            size += byte_length(self.trailer("IEA", self.groups + 1,
+                                             self.isa))
+        return size
+
+    def write_set(self, lines: list[str]) -> None:
+        headers = self.headers(take=True)
+
+        if (self.isa is not None and not self.isa_open):
+            self.write(headers.pop(0))
+            self.isa_open = True
+            self.groups = 0
+
+        if (self.gs is not None and not self.gs_open):
+            self.write(headers.pop(0))
+            self.gs_open = True
+            self.groups += 1
+            self.group_sets = 0
+
+        for line in lines:
+            self.write(line)
+
+        self.group_sets += 1
+        self.sets += 1
+
+    def close_group(self) -> None:
+        if (self.gs_open):
+            self.write(self.trailer("GE", self.group_sets, self.gs))
+            self.gs_open = False
+
+    def close_interchange(self) -> None:
+        self.close_group()
+        if (self.isa_open):
+            self.write(self.trailer("IEA", self.groups, self.isa))
+            self.isa_open = False
+
+    def finish(self) -> None:
+        '''Close the envelopes left open in the file, to go on in the next.'''
+        self.close_interchange()
+
+
+def split_edi(items, output_file: str, opts: dict) -> list[str]:
+    '''Write the processed `items` into parts of `output_file`.
+
+    A new part is started when the next transaction set would take the
+    current one over -split transaction sets or -split-size kilobytes,
+    envelope included. Each part gets the ISA and GS its sets were in, with
+    new control numbers so no two parts can be taken for the same
+    interchange (unique across runs with -control-file), and GE and IEA
+    counting them. Returns the names of the parts written.
+    '''
+    max_sets = opts[OPT_SPLIT] or sys.maxsize
+    max_size = opts[OPT_SPLIT_SIZE] * 1000 or sys.maxsize
+
+    control_file = opts[OPT_CONTROL_FILE]
+    writer = EnvelopeWriter(ControlNumbers(control_file, "ISA"),
+                            ControlNumbers(control_file, "GS"))
+    events = envelope_events(items)
+    event = next(events, None)
+    parts = []
+
+    while (event is not None or not parts):
+        name = split_part_name(output_file, len(parts) + 1)
+
+        with open_output(name) as f:
+            writer.start(f)
+
+            while (event is not None):
+                segment_id, value = event
+
+                if (segment_id == "ST"):
+                    lines = writer.lines(value)
+                    size = writer.size_with(lines)
+                    if (writer.sets and (writer.sets >= max_sets
+                                         or size > max_size)):
+                        break
+
+                    if (size > max_size):
+                        print_log(f"A transaction set in {name} is bigger "
+                                  f"than {OPT_SPLIT_SIZE} on its own.",
+                                  LOG_WARN)
+                    writer.write_set(lines)
+
+                elif (segment_id == "ISA"):
+                    writer.interchange(value)
+                elif (segment_id == "GS"):
+                    writer.group(value)
+                elif (segment_id == "GE"):
+                    writer.end_group()
+                elif (segment_id == "IEA"):
+                    writer.end_interchange()
+                else:
+                    for line in writer.lines(value):
+                        writer.write(line)
+
+                event = next(events, None)
+
+            writer.finish()
+
+        parts.append(name)
+
+    return parts
+
+
+def merge_edi_files(input_files: list[str], output_file: str,
+                    opts: dict) -> EdiContext:
+    '''Process `input_files` into the one interchange `output_file`.
+
+    It gets the ISA of the first file, which every other one has to have
+    the same sender and receiver (ISA05 to ISA08) as. The groups of all
+    the files go into it in order, numbered from 1, with the separators
+    of that ISA. With -control-file the interchange and the groups get new
+    numbers from it instead. One transaction set is held at a time.
+    '''
+    ctx = EdiContext(dict(opts))
+    control_file = opts[OPT_CONTROL_FILE]
+    writer = EnvelopeWriter(
+        ControlNumbers(control_file, "ISA") if control_file else None,
+        ControlNumbers(control_file, "GS"))
+    first = None
+    diagnostics_file = opts.get(OPT_DIAGNOSTICS)
+
+    with (open(diagnostics_file, 'w') if diagnostics_file
+          else contextlib.nullcontext()) as stream, \
+            open_output(output_file) as f:
+        ctx.diagnostics.stream = stream
+        writer.start(f)
+
+        for input_file in input_files:
+            ctx.opts[OPT_INPUT_FILE] = input_file
+            items = edi_stream_items(read_edi_segments(input_file), ctx)
+
+            for segment_id, value in envelope_events(items):
+                if (segment_id == "ST"):
+                    writer.write_set(writer.lines(value))
+
+                elif (segment_id == "ISA"):
+                    if (first is None):
+                        first = value
+                        writer.interchange(value)
+                    elif (value.elements[5:9] != first.elements[5:9]):
+                        raise EdiError(
+                            f"The ISA of {input_file} has another sender or "
+                            f"receiver than that of {input_files[0]}, they "
+                            "can't be merged into one interchange. Exiting.")
+
+                elif (segment_id == "GS"):
+                    writer.group(value)
+                elif (segment_id == "GE"):
+                    writer.end_group()
+                elif (segment_id is None):
+                    for line in writer.lines(value):
+                        writer.write(line)
+
+        writer.finish()
+
+    if (ctx.stats is not None):
+        ctx.stats.finish()
+    return ctx
+
+
+def process_edi_text(text: str, opts: dict) -> tuple[str, EdiContext]:
+    '''Process EDI `text` held in memory.
+
+    Returns the output text and the context of the run (for its logs).
+    '''
+    ctx = EdiContext(opts)
+    segments = split_edi_segments(io.StringIO(text))
+    output = "".join(edi_stream_lines(segments, ctx))
+
+    if (ctx.stats is not None):
+        ctx.stats.finish()
+    return output, ctx
+
+
+def process_edi_file(input_file: str, output_file: str,
+                     opts: dict) -> EdiContext:
+    '''Process `input_file` into `output_file` with the options `opts`.
+
+    Safe to call from several threads at once, each call gets its own
+    context. Raises EdiError if the input can't be processed.
+    '''
+    ctx = EdiContext(opts)
+    diagnostics_file = opts.get(OPT_DIAGNOSTICS)
+
+    if (opts.get(OPT_INDEX)):
+        build_index(input_file, output_file)
+        return ctx
+
+    with (open(diagnostics_file, 'w') if diagnostics_file
+          else contextlib.nullcontext()) as stream:
+        ctx.diagnostics.stream = stream
+
+        buffer = None
+        cache = None
+        if (not opts.get(OPT_EXTRACT) and not is_split(opts)):
+            cache = open_cache(opts)
+            if (cache is None and opts[OPT_JOBS] <= 1):
+                buffer = map_edi_file(input_file)
+
+        if (is_split(opts)):
+            items = edi_stream_items(read_edi_segments(input_file), ctx)
+            ctx.parts = split_edi(items, output_file, opts)
+
+        elif (opts.get(OPT_EXTRACT)):
+            # Small enough to go the simple way
+            text = extract_edi(input_file, opts[OPT_EXTRACT])
+            # Turns CRLF into LF like reading the file as text does
+            segments = split_edi_segments(io.StringIO(text, newline=None))
+            write_edi_lines(output_file, edi_stream_lines(segments, ctx),
+                            ctx.stats)
+
+        elif (cache is not None):
+            ctx.cache = cache
+            try:
+                write_edi_lines(output_file,
+                                process_edi_cached(input_file, ctx, cache),
+                                ctx.stats)
+            finally:
+                cache.close()
+
+        elif (buffer is not None):
+            with buffer:
+                if (is_format_only(opts)):
+                    pieces = format_mapped(buffer, ctx)
+                    write_mapped(output_file, pieces, buffer, ctx.stats)
+                else:
+                    write_edi_items(output_file, edi_mapped_items(buffer, ctx),
+                                    buffer, ctx.stats)
+
+        else:
+            if (opts[OPT_JOBS] > 1):
+                lines = process_edi_parallel(input_file, ctx, opts[OPT_JOBS])
+            else:
+                lines = edi_stream_lines(read_edi_segments(input_file), ctx)
+
+            write_edi_lines(output_file, lines, ctx.stats)
+
+    if (ctx.stats is not None):
+        ctx.stats.finish()
+    return ctx
+
+
+def process_edi_file_job(opts: dict) -> tuple:
+    '''Process the input file of `opts`, for a batch run.
+
+    Returns (input, output, number of diagnostics, error or None, seconds,
+    stages timed with -stats or None).
+    '''
+    start = time.perf_counter()
+    input_file, output_file = opts[OPT_INPUT_FILE], opts[OPT_OUT_FILE]
+
+    try:
+        ctx = process_edi_file(input_file, output_file, opts)
+    except (EdiError, OSError, ValueError, IndexError) as e:
+        return (input_file, output_file, 0, str(e),
+                time.perf_counter() - start, None)
+
+    if (ctx.parts is not None):
+        output_file = f"{ctx.parts[0]} to {ctx.parts[-1]}"
+
+    stages = ctx.stats.stages if ctx.stats is not None else None
+    return (input_file, output_file, ctx.diagnostics.total, None,
+            time.perf_counter() - start, stages)
+
+
+def process_edi_files(opts: dict) -> list[tuple]:
+    '''Process every input file of `opts` in this one process.
+
+    With -jobs the files are spread over that many worker processes (each
+    file is then processed serially), otherwise they are done in turn.
+    Results are in input order, see `process_edi_file_job`.
+    '''
+    jobs = opts[OPT_JOBS]
+    diagnostics_file = opts[OPT_DIAGNOSTICS]
+    file_opts = []
+    for i, input_file in enumerate(opts[OPT_INPUT_FILES]):
+        single = opts_for_file(opts, input_file)
+        single[OPT_JOBS] = 1
+
+        # Each file writes its own part, joined in input order at the end
+        if (diagnostics_file):
+            single[OPT_DIAGNOSTICS] = f"{diagnostics_file}.{i}.part"
+
+        file_opts.append(single)
+
+    if (jobs <= 1):
+        results = [process_edi_file_job(single) for single in file_opts]
+    else:
+        with ProcessPoolExecutor(jobs) as pool:
+            results = list(pool.map(process_edi_file_job, file_opts))
+
+    if (diagnostics_file):
+        join_files(diagnostics_file,
+                   [single[OPT_DIAGNOSTICS] for single in file_opts])
+
+    return results
+
+
+def join_files(filename: str, parts: list[str], mode: str = 'w') -> None:
+    '''Concatenate the files `parts` into `filename` and remove them.
+
+    With `mode` 'a' they are added to the end of `filename`.
+    '''
+
+    with open(filename, mode) as f:
+        for part in parts:
+            if (not os.path.exists(part)):
+                continue
+
+            with open(part) as part_f:
+                shutil.copyfileobj(part_f, f)
+            os.remove(part)
+
+
+def print_result(result: tuple) -> None:
+    input_file, output_file, log_count, error, seconds, _ = result
+    if (error is None):
+        print(f"{bc.OKGREEN}done{bc.ENDC} {input_file} -> {output_file}"
+              f" :: {log_count} changes ({seconds:.2f}s)")
+    else:
+        print(f"{bc.FAIL}failed{bc.ENDC} {input_file} :: {error}")
+
+
+def print_summary(results: list[tuple]) -> None:
+    print()
+    for result in results:
+        print_result(result)
+
+    failed = sum(1 for result in results if result[3] is not None)
+    print(f"\n{len(results) - failed} of {len(results)} files processed.")
+
+
+def serve_opts_for_file(opts: dict, input_file: str, number: int) -> dict:
+    '''Options for processing one file found by -serve.'''
+
+    single = opts_for_file(dict(opts, **{OPT_OUT_FILE: ""}), input_file)
+    single[OPT_JOBS] = 1
+
+    if (opts[OPT_OUT_FILE]):
+        single[OPT_OUT_FILE] = os.path.join(
+            opts[OPT_OUT_FILE], os.path.basename(single[OPT_OUT_FILE]))
+
+    # Added to the end of the diagnostics file once the file is done
+    if (opts[OPT_DIAGNOSTICS]):
+        single[OPT_DIAGNOSTICS] = f"{opts[OPT_DIAGNOSTICS]}.{number}.part"
+
+    return single
+
+
+class SpoolWatcher():
+    '''Decides which files in the directories watched by -serve are due.
+
+    A file is due when its output is missing or older than it, and it
+    hasn't changed since the last look (so a file still being copied into
+    the directory isn't picked up half way). Files that failed are left
+    alone until they change.
+    '''
+
+    def __init__(self, opts: dict) -> None:
+        self.opts = opts
+        self.settling: dict[str, tuple] = {}
+        self.failed: dict[str, tuple] = {}
+        self.running: set[str] = set()
+        self.count = 0
+
+    def due(self) -> list[dict]:
+        '''Options for each file due, these are then counted as running.'''
+
+        found = []
+        listed = [input_file for directory in self.opts[OPT_WATCH_DIRS]
+                  for input_file in expand_input_path(directory)]
+        written = run_outputs(
+            listed, lambda input_file: serve_opts_for_file(
+                self.opts, input_file, 0)[OPT_OUT_FILE],
+            is_split(self.opts))
+
+        for input_file in listed:
+            if (input_file in self.running or input_file in written):
+                continue
+
+            try:
+                stat = os.stat(input_file)
+            except OSError:
+                # Gone since it was listed
+                continue
+
+            version = (stat.st_size, stat.st_mtime_ns)
+            single = serve_opts_for_file(self.opts, input_file, self.count)
+
+            if (self.failed.get(input_file) == version
+                    or not self.is_stale(single[OPT_OUT_FILE], stat)):
+                self.settling.pop(input_file, None)
+                continue
+
+            if (self.settling.get(input_file) != version):
+                self.settling[input_file] = version
+                continue
+
+            del self.settling[input_file]
+            self.failed.pop(input_file, None)
+            self.running.add(input_file)
+            self.count += 1
+            found.append(single)
+
+        return found
+
+    def is_stale(self, output_file: str, stat: os.stat_result) -> bool:
+        try:
+            return os.stat(output_file).st_mtime_ns < stat.st_mtime_ns
+        except OSError:
+            return True
+
+    def done(self, input_file: str, error: None | str) -> None:
+        self.running.discard(input_file)
+
+        if (error is not None):
+            try:
+                stat = os.stat(input_file)
+                self.failed[input_file] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                pass
+
+
+def ignore_interrupts() -> None:
+    '''Leave Ctrl-C to the main process (run in the -serve workers).'''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+async def serve_directories(opts: dict) -> list[tuple]:
+    '''Process the files put into the watched directories until stopped.
+
+    The directories are looked at every -poll seconds and the files due are
+    handed to a pool of -jobs worker processes, which stay up between files
+    so the loop tables and handlers are only set up once per worker. At
+    most -jobs files are in the pool at a time. On Ctrl-C or SIGTERM the
+    files already started are finished. Returns the results, see
+    `process_edi_file_job`.
+    '''
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows, Ctrl-C ends the run with KeyboardInterrupt there
+            pass
+
+    watcher = SpoolWatcher(opts)
+    slots = asyncio.Semaphore(opts[OPT_JOBS])
+    results = []
+    tasks = set()
+
+    async def process(single: dict) -> None:
+        async with slots:
+            if (stop.is_set()):
+                watcher.done(single[OPT_INPUT_FILE], None)
+                return
+
+            result = await loop.run_in_executor(pool, process_edi_file_job,
+                                                single)
+        watcher.done(result[0], result[3])
+        results.append(result)
+        print_result(result)
+
+        if (opts[OPT_DIAGNOSTICS]):
+            join_files(opts[OPT_DIAGNOSTICS], [single[OPT_DIAGNOSTICS]], 'a')
+
+    with ProcessPoolExecutor(opts[OPT_JOBS],
+                             initializer=ignore_interrupts) as pool:
+        while (not stop.is_set()):
+            for single in watcher.due():
+                task = asyncio.create_task(process(single))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            try:
+                await asyncio.wait_for(stop.wait(), opts[OPT_POLL])
+            except asyncio.TimeoutError:
+                pass
+
+        if (tasks):
+            await asyncio.gather(*tasks)
+
+    return results
+
+
+def main():
+    args = sys.argv
+
+    if ("-help" in args or "--help" in args or len(args) == 1):
+        print_help()
+        exit(0)
+
+    opts = parse_arguments(args)
+    print()
+    print_opts(opts)
+
+    if opts[OPT_ID_LOOPS] and opts[OPT_FORMAT]:
+        opts[OPT_ID_LOOPS] = False
+
+    if (not opts[OPT_YES]):
+        choice = ""
+        while (choice.lower() != "y" and choice.lower() != "n"):
+            print()
+            choice = input("Continue with the above configuration? (Y/N): ")
+            print()
+
+        if (choice == "n"):
+            print_log("Aborted.", LOG_ERROR)
+            sys.exit(1)
+
+    profiler = None
+    if (opts[OPT_PROFILE]):
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        if (opts[OPT_SERVE]):
+            process_serve(opts)
+        elif (opts[OPT_MERGE]):
+            process_merge(opts)
+        elif (len(opts[OPT_INPUT_FILES]) > 1):
+            process_batch(opts)
+        else:
+            process_single(opts)
+    finally:
+        if (profiler is not None):
+            profiler.disable()
+            profiler.dump_stats(opts[OPT_PROFILE])
+            print_log(f"Profile written to {opts[OPT_PROFILE]}", LOG_INFO)
+
+
+def process_batch(opts: dict) -> None:
+    stats = RunStats() if stats_enabled(opts) else None
+
+    with run_control_file(opts) as opts:
+        results = process_edi_files(opts)
+    print_summary(results)
+
+    if (stats is not None):
+        for result in results:
+            if (result[5] is not None):
+                stats.merge(result[5])
+        stats.finish()
+        print_stats(stats, opts)
+
+    if (any(result[3] is not None for result in results)):
+        sys.exit(1)
+
+
+def process_serve(opts: dict) -> None:
+    directories = ", ".join(opts[OPT_WATCH_DIRS])
+    print_log(f"Watching {directories}, Ctrl-C to stop.", LOG_INFO)
+
+    if (opts[OPT_DIAGNOSTICS]):
+        open(opts[OPT_DIAGNOSTICS], 'w').close()
+
+    with run_control_file(opts) as opts:
+        results = asyncio.run(serve_directories(opts))
+
+    failed = sum(1 for result in results if result[3] is not None)
+    print(f"\nStopped. {len(results) - failed} of {len(results)} files "
+          "processed.")
+
+
+def process_merge(opts: dict) -> None:
+    input_files = opts[OPT_INPUT_FILES]
+    try:
+        ctx = merge_edi_files(input_files, opts[OPT_OUT_FILE], opts)
+    except EdiError as e:
+        print_log(str(e), LOG_ERROR)
+        sys.exit(1)
+
+    ctx.diagnostics.print_records()
+    print_log(f"\nMerged {len(input_files)} files into "
+              f"{opts[OPT_OUT_FILE]}.", LOG_INFO)
+
+    if (ctx.stats is not None):
+        print_stats(ctx.stats, opts)
+
+
+def process_single(opts: dict) -> None:
+    try:
+        ctx = process_edi_file(opts[OPT_INPUT_FILE], opts[OPT_OUT_FILE], opts)
+    except EdiError as e:
+        print_log(str(e), LOG_ERROR)
+        sys.exit(1)
 
-    new_lines = edi_array_to_lines(data)
-    with open(opts[OPT_OUT_FILE], 'w') as f:
-        f.writelines(new_lines)
+    ctx.diagnostics.print_records()
 
-    max_comment = 0
-    for _, comment in logs:
-        if (len(comment)) > max_comment:
-            max_comment = len(comment)
+    if (ctx.parts is not None):
+        print_log(f"\nSplit into {len(ctx.parts)} files, {ctx.parts[0]} "
+                  f"to {ctx.parts[-1]}.", LOG_INFO)
 
-    max_comment += 2
+    if (ctx.cache is not None):
+        total = ctx.cache.hits + ctx.cache.misses
+        print_log(f"\n{ctx.cache.hits} of {total} transaction sets taken "
+                  "from the cache.", LOG_INFO)
 
-    for item in logs:
-        print(f"{item[1]}: {'.' * (max_comment - len(item[1]))}"
-              f"{bc.WARNING}{item[0]}{bc.ENDC}")
+    if (ctx.stats is not None):
+        print_stats(ctx.stats, opts)
 
 
 if __name__ == "__main__":